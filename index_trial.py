@@ -0,0 +1,229 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import alembic.command
+import alembic.config
+from sqlalchemy import create_engine, insert, text
+
+from nbexchange import dbutil
+from nbexchange.models import Base
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.assignments import Assignment
+from nbexchange.models.courses import Course
+from nbexchange.models.feedback import Feedback
+from nbexchange.models.notebooks import Notebook
+from nbexchange.models.users import User
+
+"""
+Compare the query plans (and timings) of the exchange's hot finders, before and after the
+composite indexes migration (2026101802).
+
+The database is seeded with a class-sized spread of courses, assignments, students & actions
+(a million actions by default), the migration is downgraded to get the "before" plans, then
+upgraded again for the "after" plans.
+
+    python index_trial.py                     # a scratch sqlite database
+    python index_trial.py -a 10000 -k         # a quick run, keeping the database
+    python index_trial.py -d postgresql://...  # an (empty!) database of your own
+"""
+
+BEFORE = "2026101801"
+AFTER = "2026101802"
+
+
+class nbexchangeIndexTrial:
+    log = logging.getLogger(__name__)
+
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(
+            description="Query plans for nbexchange, before & after the composite indexes."
+        )
+        parser.add_argument(
+            "-d",
+            "--db_url",
+            type=str,
+            default="sqlite:///index_trial.sqlite",
+            help="The database to seed. Defaults to sqlite:///index_trial.sqlite (which is removed first)",
+        )
+        parser.add_argument(
+            "-a", "--actions", type=int, default=1000000, help="How many actions to seed. Defaults to 1000000."
+        )
+        parser.add_argument(
+            "-s", "--students", type=int, default=250, help="How many students per course. Defaults to 250."
+        )
+        parser.add_argument(
+            "-r", "--repeat", type=int, default=100, help="How many times to run each query. Defaults to 100."
+        )
+        parser.add_argument("-k", "--keep", action="store_true", help="Keep the sqlite database afterwards.")
+        return parser.parse_args(args)
+
+    def setup(self):
+        self.args = self.parse_args(sys.argv[1:])
+        self.sqlite_file = None
+        if self.args.db_url.startswith("sqlite:///"):
+            self.sqlite_file = self.args.db_url[len("sqlite:///") :]
+            if os.path.exists(self.sqlite_file):
+                os.remove(self.sqlite_file)
+        self.engine = create_engine(self.args.db_url)
+        # A fresh database is made from the models, which is what the head revision describes
+        Base.metadata.create_all(self.engine)
+        self.alembic(alembic.command.stamp, "head")
+
+    def alembic(self, command, revision):
+        with dbutil._temp_alembic_ini(self.args.db_url) as alembic_ini:
+            command(alembic.config.Config(alembic_ini), revision)
+        # Pooled sqlite connections would keep planning with the old schema
+        self.engine.dispose()
+
+    def seed(self):
+        """A course per 10 assignments, `students` students per course, and actions spread over them all"""
+        students = self.args.students
+        # Every student has a release, fetch, submit, collect, feedback_released & feedback_fetched
+        # per assignment - so this many assignments gets (roughly) the number of actions asked for
+        assignments = max(1, self.args.actions // (students * 6))
+        courses = max(1, assignments // 10)
+        now = datetime.now(timezone.utc)
+        self.log.warning(f"Seeding {courses} courses, {assignments} assignments, {students * courses} students")
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                insert(Course), [{"id": c, "org_id": 1, "course_code": f"course_{c}"} for c in range(1, courses + 1)]
+            )
+            conn.execute(
+                insert(User),
+                [{"id": u, "org_id": 1, "name": f"1-s{u:07d}"} for u in range(1, students * courses + 2)],
+            )
+            conn.execute(
+                insert(Assignment),
+                [
+                    {"id": a, "course_id": (a - 1) % courses + 1, "assignment_code": f"assign_{a}", "active": True}
+                    for a in range(1, assignments + 1)
+                ],
+            )
+            conn.execute(
+                insert(Notebook),
+                [{"id": a, "assignment_id": a, "name": "notebook"} for a in range(1, assignments + 1)],
+            )
+
+            instructor = students * courses + 1
+            actions, feedback = [], []
+            for a in range(1, assignments + 1):
+                course = (a - 1) % courses
+                timestamp = now - timedelta(days=assignments - a)
+                actions.append(
+                    {
+                        "assignment_id": a,
+                        "user_id": instructor,
+                        "action": AssignmentActions.released,
+                        "timestamp": timestamp,
+                    }
+                )
+                for s in range(course * students + 1, (course + 1) * students + 1):
+                    for action in (
+                        AssignmentActions.fetched,
+                        AssignmentActions.submitted,
+                        AssignmentActions.collected,
+                        AssignmentActions.feedback_released,
+                        AssignmentActions.feedback_fetched,
+                    ):
+                        actions.append({"assignment_id": a, "user_id": s, "action": action, "timestamp": timestamp})
+                    feedback.append(
+                        {"notebook_id": a, "student_id": s, "instructor_id": instructor, "timestamp": timestamp}
+                    )
+                if len(actions) > 100000:
+                    conn.execute(insert(Action), actions)
+                    actions = []
+            conn.execute(insert(Action), actions)
+            conn.execute(insert(Feedback), feedback)
+            if self.engine.dialect.name in ("sqlite", "postgresql"):
+                conn.execute(text("ANALYZE"))
+
+        self.assignment_id = assignments // 2
+        self.student_id = ((self.assignment_id - 1) % courses) * students + 1
+        self.course_id = (self.assignment_id - 1) % courses + 1
+        with self.engine.connect() as conn:
+            self.timestamp = conn.execute(
+                text("SELECT timestamp FROM feedback_2 WHERE notebook_id = :assignment_id LIMIT 1"),
+                {"assignment_id": self.assignment_id},
+            ).scalar()
+
+    def queries(self):
+        """The SQL the hot finders run (the values come from `measure`)"""
+        return {
+            "Action.find_most_recent_action": (
+                "SELECT * FROM action WHERE assignment_id = :assignment_id AND action = 'released' "
+                "ORDER BY id DESC LIMIT 1"
+            ),
+            "Action.find_visible_to_user": (
+                "SELECT * FROM action WHERE assignment_id IN (:assignment_id) "
+                "AND (action = 'released' OR user_id = :student_id) ORDER BY id"
+            ),
+            "Action (per user, per action)": (
+                "SELECT * FROM action WHERE assignment_id = :assignment_id AND user_id = :student_id "
+                "AND action = 'submitted'"
+            ),
+            "Feedback.find_notebook_for_student": (
+                "SELECT * FROM feedback_2 WHERE notebook_id = :assignment_id AND student_id = :student_id "
+                "AND timestamp = :timestamp ORDER BY id DESC LIMIT 1"
+            ),
+            "Assignment.find_by_code": (
+                "SELECT * FROM assignment WHERE course_id = :course_id AND assignment_code = 'assign_1' "
+                "AND active = 1"
+            ),
+        }
+
+    def explain(self, conn, sql):
+        if self.engine.dialect.name == "sqlite":
+            rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), self.params).fetchall()
+            return [row[-1] for row in rows]
+        rows = conn.execute(text(f"EXPLAIN {sql}"), self.params).fetchall()
+        return [" | ".join(str(column) for column in row) for row in rows]
+
+    def measure(self):
+        self.params = {
+            "assignment_id": self.assignment_id,
+            "student_id": self.student_id,
+            "course_id": self.course_id,
+            "timestamp": self.timestamp,
+        }
+        results = {}
+        with self.engine.connect() as conn:
+            for name, sql in self.queries().items():
+                plan = self.explain(conn, sql)
+                start = time.perf_counter()
+                for _ in range(self.args.repeat):
+                    conn.execute(text(sql), self.params).fetchall()
+                results[name] = (plan, (time.perf_counter() - start) * 1000 / self.args.repeat)
+        return results
+
+    def report(self, before, after):
+        for name in before:
+            print(f"\n{name}")
+            for label, results in (("before", before), ("after", after)):
+                plan, elapsed = results[name]
+                print(f"  {label}: {elapsed:.3f}ms")
+                for line in plan:
+                    print(f"      {line}")
+
+    def main(self):
+        self.setup()
+        try:
+            self.seed()
+            self.alembic(alembic.command.downgrade, BEFORE)
+            before = self.measure()
+            self.alembic(alembic.command.upgrade, AFTER)
+            after = self.measure()
+            self.report(before, after)
+        finally:
+            self.engine.dispose()
+            if self.sqlite_file and not self.args.keep and os.path.exists(self.sqlite_file):
+                os.remove(self.sqlite_file)
+
+
+if __name__ == "__main__":
+    app = nbexchangeIndexTrial()
+    app.main()
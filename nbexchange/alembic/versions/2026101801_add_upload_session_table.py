@@ -0,0 +1,44 @@
+"""Add the upload_session table, for resumable uploads
+
+Revision ID: 2026101801
+Revises: 2024093001
+Create Date: 2026-10-18 10:00
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2026101801"
+down_revision = "2024093001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "upload_session",
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("session_id", sa.Unicode(36), nullable=False),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id", ondelete="CASCADE")),
+        sa.Column("course_id", sa.Integer, sa.ForeignKey("course.id", ondelete="CASCADE")),
+        sa.Column("assignment_code", sa.Text, nullable=False),
+        sa.Column("action", sa.Unicode(20), nullable=False),
+        sa.Column("filename", sa.Unicode(200), nullable=True),
+        sa.Column("location", sa.Unicode(200), nullable=False),
+        sa.Column("notebooks", sa.Text, nullable=True),
+        sa.Column("timestamp", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("size", sa.BigInteger, nullable=True),
+        sa.Column("received", sa.BigInteger, nullable=False, default=0),
+        sa.Column("created_at", sa.DateTime(timezone=True)),
+        sa.Column("updated_at", sa.DateTime(timezone=True)),
+    )
+    op.create_index("ix_upload_session_session_id", "upload_session", ["session_id"], unique=True)
+    op.create_index("ix_upload_session_user_id", "upload_session", ["user_id"])
+    op.create_index("ix_upload_session_course_id", "upload_session", ["course_id"])
+    op.create_index("ix_upload_session_updated_at", "upload_session", ["updated_at"])
+
+
+def downgrade():
+    op.drop_table("upload_session")
@@ -0,0 +1,31 @@
+"""Add composite indexes for the action & feedback finders
+
+Revision ID: 2026101802
+Revises: 2026101801
+Create Date: 2026-10-18 14:00
+
+The `assignment` table doesn't need one: the (course_id, assignment_code, active) unique constraint
+already gives `Assignment.find_by_code` its index.
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2026101802"
+down_revision = "2026101801"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_action_assignment_id_action_id", "action", ["assignment_id", "action", "id"])
+    op.create_index("ix_action_assignment_id_user_id_action", "action", ["assignment_id", "user_id", "action"])
+    op.create_index(
+        "ix_feedback_2_notebook_id_student_id_timestamp", "feedback_2", ["notebook_id", "student_id", "timestamp"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_feedback_2_notebook_id_student_id_timestamp", table_name="feedback_2")
+    op.drop_index("ix_action_assignment_id_user_id_action", table_name="action")
+    op.drop_index("ix_action_assignment_id_action_id", table_name="action")
@@ -0,0 +1,46 @@
+"""Add action.location_hash, so files can be looked up by their location through an index
+
+Revision ID: 2026101803
+Revises: 2026101802
+Create Date: 2026-10-18 16:00
+
+"""
+
+import hashlib
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2026101803"
+down_revision = "2026101802"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("action") as batch_op:
+        batch_op.add_column(sa.Column("location_hash", sa.Unicode(length=64), nullable=True))
+        batch_op.create_index("ix_action_location_hash", ["location_hash"])
+
+    # Back-fill the existing actions (see nbexchange.models.actions.hash_location)
+    action = sa.table("action", sa.column("id", sa.Integer), sa.column("location", sa.Unicode))
+    location_hash = sa.table("action", sa.column("id", sa.Integer), sa.column("location_hash", sa.Unicode))
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(action.c.id, action.c.location).where(action.c.location.is_not(None)))
+    updates = [
+        {"_id": row.id, "location_hash": hashlib.sha256(row.location.encode("utf-8")).hexdigest()} for row in rows
+    ]
+    if updates:
+        connection.execute(
+            location_hash.update()
+            .where(location_hash.c.id == sa.bindparam("_id"))
+            .values(location_hash=sa.bindparam("location_hash")),
+            updates,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("action") as batch_op:
+        batch_op.drop_index("ix_action_location_hash")
+        batch_op.drop_column("location_hash")
@@ -0,0 +1,41 @@
+"""Add the assignment_state table: the latest action of each kind, per user per assignment
+
+Revision ID: 2026101804
+Revises: 2026101803
+Create Date: 2026-10-18 18:00
+
+The table starts empty: fill it from the existing actions with `nbexchange --rebuild-assignment-state`
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2026101804"
+down_revision = "2026101803"
+branch_labels = None
+depends_on = None
+
+POINTERS = ["released_id", "fetched_id", "submitted_id", "collected_id", "feedback_released_id", "feedback_fetched_id"]
+
+
+def upgrade():
+    op.create_table(
+        "assignment_state",
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("assignment_id", sa.Integer, sa.ForeignKey("assignment.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id", ondelete="CASCADE"), nullable=False),
+        *[
+            sa.Column(pointer, sa.Integer, sa.ForeignKey("action.id", ondelete="SET NULL"), nullable=True)
+            for pointer in POINTERS
+        ],
+        sa.Column("updated_at", sa.DateTime(timezone=True)),
+        sa.UniqueConstraint("assignment_id", "user_id"),
+    )
+    op.create_index("ix_assignment_state_assignment_id", "assignment_state", ["assignment_id"])
+    op.create_index("ix_assignment_state_user_id", "assignment_state", ["user_id"])
+
+
+def downgrade():
+    op.drop_table("assignment_state")
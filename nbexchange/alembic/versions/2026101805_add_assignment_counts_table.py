@@ -0,0 +1,41 @@
+"""Add the assignment_counts table: how many of each action each assignment has had
+
+Revision ID: 2026101805
+Revises: 2026101804
+Create Date: 2026-10-18 20:00
+
+The table starts empty: it's filled from the existing actions by the app's first reconciliation
+(see NbExchange.assignment_counts_reconcile_interval)
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2026101805"
+down_revision = "2026101804"
+branch_labels = None
+depends_on = None
+
+COUNTS = ["released", "fetched", "submitted", "submitters", "collected", "feedback_released", "feedback_fetched"]
+
+
+def upgrade():
+    op.create_table(
+        "assignment_counts",
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column(
+            "assignment_id",
+            sa.Integer,
+            sa.ForeignKey("assignment.id", ondelete="CASCADE"),
+            nullable=False,
+            unique=True,
+        ),
+        *[sa.Column(count, sa.Integer, nullable=False, server_default="0") for count in COUNTS],
+        sa.Column("updated_at", sa.DateTime(timezone=True)),
+    )
+
+
+def downgrade():
+    op.drop_table("assignment_counts")
@@ -0,0 +1,45 @@
+"""Add the action_archive table: actions moved out of `action` once their assignment is closed
+
+Revision ID: 2026101806
+Revises: 2026101805
+Create Date: 2026-10-18 22:00
+
+Nothing is archived until NbExchange.action_archive_after_days is set
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "2026101806"
+down_revision = "2026101805"
+branch_labels = None
+depends_on = None
+
+ACTIONS = ["released", "fetched", "submitted", "removed", "collected", "feedback_released", "feedback_fetched"]
+
+# The `action` table's enum type - which already exists, on postgres
+action_type = sa.Enum(*ACTIONS, name="assignmentactions").with_variant(
+    postgresql.ENUM(*ACTIONS, name="assignmentactions", create_type=False), "postgresql"
+)
+
+
+def upgrade():
+    op.create_table(
+        "action_archive",
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id", ondelete="CASCADE"), index=True),
+        sa.Column("assignment_id", sa.Integer, sa.ForeignKey("assignment.id", ondelete="CASCADE"), index=True),
+        sa.Column("action", action_type, nullable=False),
+        sa.Column("location", sa.Unicode(200), nullable=True),
+        sa.Column("location_hash", sa.Unicode(64), nullable=True),
+        sa.Column("checksum", sa.Unicode(200), nullable=True),
+        sa.Column("timestamp", sa.DateTime(timezone=True)),
+        sa.Column("archived_at", sa.DateTime(timezone=True)),
+    )
+
+
+def downgrade():
+    op.drop_table("action_archive")
@@ -1,7 +1,9 @@
+import asyncio
 import logging
 import os
+import signal
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from getpass import getuser
 
 import sentry_sdk
@@ -11,16 +13,21 @@ from sentry_sdk.integrations.tornado import TornadoIntegration
 from sqlalchemy.exc import OperationalError
 from tornado import web
 from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import LogFormatter, access_log, app_log, gen_log
 from tornado_prometheus import MetricsHandler, PrometheusMixIn
-from traitlets import Bool, Dict, Integer, Type, Unicode, default
+from traitlets import Bool, Dict, Enum, Float, Integer, Type, Unicode, default
 from traitlets.config import Application, catch_config_error
 
 import nbexchange.dbutil
-from nbexchange import dbutil, handlers
+from nbexchange import database, dbutil, handlers
+from nbexchange.audit import AuditQueue
 from nbexchange.handlers import base
 from nbexchange.handlers.auth.user_handler import BaseUserHandler
+from nbexchange.handlers.upload_session import remove_expired_upload_sessions
+from nbexchange.models.action_archive import ActionArchive
+from nbexchange.models.assignment_counts import AssignmentCounts
+from nbexchange.models.assignment_states import AssignmentState
 
 ROOT = os.path.dirname(__file__)
 STATIC_FILES_DIR = os.path.join(ROOT, "static")
@@ -45,6 +52,10 @@ flags = {
         Only SQLite database files will be backed up automatically.
         """,
     ),
+    "rebuild-assignment-state": (
+        {"NbExchange": {"rebuild_assignment_state": True}},
+        "Recompute the assignment_state table from the actions on startup.",
+    ),
 }
 
 
@@ -65,6 +76,11 @@ class NbExchange(PrometheusMixIn, Application):
 
     flags = Dict(flags)
 
+    upload_session_cleanup = None
+    audit_flusher = None
+    counts_reconciler = None
+    action_archiver = None
+
     config_file = Unicode("/etc/config/nbexchange_config.py", help="The config file to load", config=True)
 
     timezone = Unicode("UTC", help="Timezone for recording timestamps").tag(config=True)
@@ -105,6 +121,65 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
         """,
     )
 
+    db_pool_size = Integer(
+        5, config=True, help="How many database connections the pool keeps open (not used for SQLite in memory)"
+    )
+    db_max_overflow = Integer(
+        10, config=True, help="How many connections the pool may open beyond db_pool_size, when they're all busy"
+    )
+    db_pool_timeout = Integer(
+        30, config=True, help="How many seconds to wait for a connection from the pool before giving up"
+    )
+    db_pool_recycle = Integer(
+        None,
+        allow_none=True,
+        config=True,
+        help="""Replace pooled connections older than this many seconds.
+
+        Defaults to None (never), or 60 seconds for MySQL.
+        """,
+    )
+    db_pool_pre_ping = Bool(True, config=True, help="Test each connection as it's taken from the pool")
+
+    db_replica_url = Unicode(
+        "",
+        config=True,
+        help="""A read replica of the database, for the listings (assignments, collections, history & feedback.)
+        Defaults to '' (no replica: everything uses db_url.) It uses the same db_pool_* settings.
+        """,
+    )
+    db_replica_staleness = Float(
+        5.0,
+        config=True,
+        help="""For how many seconds after a user writes to the database their listings come from the primary
+        rather than the replica (so they see their changes, however far behind the replica is.)
+        """,
+    )
+
+    db_threads = Integer(
+        5,
+        config=True,
+        help="""How many threads the listing handlers (assignments, collections, history & assignment_counts) run
+        their database work on, so a slow query doesn't hold up the other requests. Each uses a pooled connection,
+        so keep it no more than db_pool_size + db_max_overflow. 0 runs it all on the IOLoop thread, as the other
+        handlers do. An in-memory SQLite database has the one connection, so always runs on the IOLoop thread
+        """,
+    )
+
+    sqlite_profile = Bool(
+        False,
+        config=True,
+        help="""Tune a SQLite database for production: WAL journalling, synchronous=NORMAL, a 5s busy timeout,
+        and a larger mmap & page cache (see nbexchange.database.SQLITE_PROFILE)
+        """,
+    )
+    sqlite_pragmas = Dict(
+        config=True,
+        help="""PRAGMAs to set on each SQLite connection, eg {"busy_timeout": 10000}.
+        These are added to (or override) the sqlite_profile ones.
+        """,
+    )
+
     upgrade_db = Bool(
         False,
         config=True,
@@ -117,11 +192,146 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
 
     reset_db = Bool(False, config=True, help="Purge and reset the database.")
     debug_db = Bool(False, config=True, help="log all database transactions. This has A LOT of output")
+    rebuild_assignment_state = Bool(
+        False,
+        config=True,
+        help="""Recompute the latest-state-per-student table (assignment_state) from the actions on startup.
+        Needed once after upgrading to a database with the table, as it starts out empty.
+        """,
+    )
 
     max_buffer_size = Integer(
         5253530000, config=True, help="The maximum size, in bytes, of an upload (defaults to 5GB)"
     )
 
+    max_release_size = Integer(
+        config=True,
+        help="""The maximum size, in bytes, of a released assignment (defaults to max_buffer_size).
+
+        Larger releases are rejected with a 413 before any of the upload is read.
+        """,
+    )
+
+    @default("max_release_size")
+    def _max_release_size_default(self):
+        return self.max_buffer_size
+
+    max_submission_size = Integer(
+        config=True,
+        help="""The maximum size, in bytes, of a submission (defaults to max_buffer_size).
+
+        Larger submissions are rejected with a 413 before any of the upload is read.
+        """,
+    )
+
+    @default("max_submission_size")
+    def _max_submission_size_default(self):
+        return self.max_buffer_size
+
+    max_feedback_size = Integer(
+        100 * 1024 * 1024,
+        config=True,
+        help="""The maximum size, in bytes, of a feedback file (defaults to 100MB).
+
+        Larger feedback is rejected with a 413 before any of the upload is read.
+        """,
+    )
+
+    download_chunk_size = Integer(
+        64 * 1024,
+        config=True,
+        help="The size, in bytes, of the chunks files are downloaded in (defaults to 64KB)",
+    )
+
+    upload_session_timeout = Integer(
+        24 * 60 * 60,
+        config=True,
+        help="""The time, in seconds, a resumable upload session can be idle before it expires (defaults to a day).
+
+        Expired sessions, and their partial files, are removed.
+        """,
+    )
+
+    upload_session_cleanup_interval = Integer(
+        60 * 60,
+        config=True,
+        help="How often, in seconds, expired upload sessions are removed (defaults to an hour). 0 disables the cleanup",
+    )
+
+    assignment_counts_reconcile_interval = Integer(
+        24 * 60 * 60,
+        config=True,
+        help="""How often, in seconds, the assignment counts are recounted from the actions, correcting any drift
+        (defaults to a day.) 0 disables the reconciliation
+        """,
+    )
+
+    action_archive_after_days = Integer(
+        0,
+        config=True,
+        help="""Move a deleted (inactive) assignment's actions to the `action_archive` table once it's had no
+        actions for this many days, keeping the `action` table (and its indexes) small. 0 (the default) disables
+        archiving
+        """,
+    )
+
+    action_archive_batch_size = Integer(
+        1000,
+        config=True,
+        help="How many actions are archived in each transaction",
+    )
+
+    action_archive_interval = Integer(
+        60 * 60,
+        config=True,
+        help="How often, in seconds, closed assignments are archived (defaults to an hour)",
+    )
+
+    audit_write_behind = Bool(
+        False,
+        config=True,
+        help="""Queue the audit actions (`fetched`, `feedback_fetched`, and `collected`), and write them in batches.
+
+        Downloads then don't wait for their action to be committed. The cost is that the actions appear in the
+        listings up to `audit_flush_interval` seconds later, and any still queued are lost if the process dies
+        (they're written when the app is stopped cleanly.)
+        """,
+    )
+
+    audit_batch_size = Integer(
+        100,
+        config=True,
+        help="With audit_write_behind, the queue is written once it has this many actions (defaults to 100)",
+    )
+
+    audit_flush_interval = Integer(
+        5,
+        config=True,
+        help="With audit_write_behind, how often, in seconds, the queue is written (defaults to 5)",
+    )
+
+    file_offload = Enum(
+        ["none", "x-accel-redirect", "x-sendfile"],
+        "none",
+        config=True,
+        help="""How downloaded files are sent to the client.
+
+        'none' (the default): nbexchange streams the file itself.
+        'x-accel-redirect': nbexchange returns an X-Accel-Redirect header, and nginx sends the file.
+        'x-sendfile': nbexchange returns an X-Sendfile header, and Apache (mod_xsendfile) sends the file.
+
+        The request is still authorised, and the action recorded, by nbexchange.
+        """,
+    )
+
+    file_offload_prefix = Unicode(
+        "/protected/",
+        config=True,
+        help="""The (internal) url prefix that maps to base_storage_location in the front proxy.
+        Only used with file_offload = 'x-accel-redirect'. Defaults to '/protected/'
+        """,
+    )
+
     user_plugin_class = Type(
         MockUserHandler,
         # NaasUserHandler,
@@ -207,6 +417,25 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
         if os.path.exists(path) and not os.access(path, os.W_OK):
             self.log.error(f"{user} cannot edit {path}")
 
+    def db_engine_kwargs(self):
+        """The create_engine kwargs: the pool settings, overridden by anything in db_kwargs"""
+        kwargs = {
+            "echo": self.debug_db,
+            "pool_size": self.db_pool_size,
+            "max_overflow": self.db_max_overflow,
+            "pool_timeout": self.db_pool_timeout,
+            "pool_recycle": self.db_pool_recycle,
+            "pool_pre_ping": self.db_pool_pre_ping,
+        }
+        kwargs.update(self.db_kwargs)
+        return kwargs
+
+    def db_sqlite_pragmas(self):
+        """The PRAGMAs for a SQLite database: the sqlite_profile (if set), overridden by sqlite_pragmas"""
+        pragmas = dict(database.SQLITE_PROFILE) if self.sqlite_profile else {}
+        pragmas.update(self.sqlite_pragmas)
+        return pragmas
+
     def init_db(self):
         """Initialize the nbexchange database"""
         self.log.debug(f"app.py.init_db: db_url = {self.db_url}")
@@ -217,10 +446,15 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
             nbexchange.dbutil.setup_db(
                 self.db_url,
                 reset=self.reset_db,
-                echo=self.debug_db,
                 log=self.log,
-                **self.db_kwargs,
+                sqlite_pragmas=self.db_sqlite_pragmas(),
+                **self.db_engine_kwargs(),
+            )
+            database.configure_replica_engine(
+                self.db_replica_url or None, staleness=self.db_replica_staleness, **self.db_engine_kwargs()
             )
+            # An in-memory database is the one connection, which can't be used on two threads at once
+            database.configure_db_executor(0 if self.db_url.endswith(":memory:") else self.db_threads)
         except OperationalError as e:
             self.log.error(f"Failed to connect to db: {self.db_url}")
             self.log.debug(f"Database error was: {e}", exc_info=True)
@@ -239,6 +473,10 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
         except nbexchange.dbutil.DatabaseSchemaMismatch as e:
             self.exit(e)
 
+        if self.rebuild_assignment_state:
+            with database.scoped_session() as session:
+                AssignmentState.rebuild(db=session, log=self.log)
+
     def init_tornado_settings(self):
         """Initialize tornado config"""
 
@@ -258,6 +496,14 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
             base_storage_location=self.base_storage_location,
             # naas_url=self.naas_url,
             max_buffer_size=self.max_buffer_size,
+            max_release_size=self.max_release_size,
+            max_submission_size=self.max_submission_size,
+            max_feedback_size=self.max_feedback_size,
+            download_chunk_size=self.download_chunk_size,
+            file_offload=self.file_offload,
+            file_offload_prefix=self.file_offload_prefix,
+            upload_session_timeout=self.upload_session_timeout,
+            audit_queue=AuditQueue(batch_size=self.audit_batch_size, log=self.log) if self.audit_write_behind else None,
             user_plugin=self.user_plugin_class(),
             version_hash=version_hash,
             xsrf_cookies=False,
@@ -310,7 +556,66 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
         self.init_tornado_application()
         logging.info("app.initialisze init_tornado_application completed")
 
+    def remove_expired_upload_sessions(self):
+        try:
+            remove_expired_upload_sessions(max_age=self.upload_session_timeout, log=self.log)
+        except Exception as e:
+            self.log.error(f"Failed to remove expired upload sessions: {e}")
+
+    def _reconcile_assignment_counts(self):
+        with database.scoped_session() as session:
+            AssignmentCounts.reconcile(db=session, log=self.log)
+
+    async def reconcile_assignment_counts(self):
+        """Recount the assignment counts, on a database thread (it counts every action)"""
+        try:
+            await database.run_in_db_thread(self._reconcile_assignment_counts)
+        except Exception as e:
+            self.log.error(f"Failed to reconcile the assignment counts: {e}")
+
+    async def archive_actions(self):
+        """Archive the actions of every closed assignment, a batch (and a transaction) at a time - letting
+        the IOLoop get on with requests between batches
+        """
+        before = datetime.now(timezone.utc) - timedelta(days=self.action_archive_after_days)
+        archived = 0
+        try:
+            with database.scoped_session() as session:
+                closed = ActionArchive.find_closed_assignments(db=session, before=before, log=self.log)
+            for assignment_id in closed:
+                moved = self.action_archive_batch_size
+                while moved == self.action_archive_batch_size:
+                    with database.scoped_session() as session:
+                        moved = ActionArchive.archive_batch(
+                            db=session,
+                            assignment_id=assignment_id,
+                            batch_size=self.action_archive_batch_size,
+                            log=self.log,
+                        )
+                    archived += moved
+                    await asyncio.sleep(0)
+        except Exception as e:
+            self.log.error(f"Failed to archive actions: {e}")
+        if archived:
+            self.log.info(f"Archived {archived} actions, from {len(closed)} assignments")
+        return archived
+
+    def flush_audit_queue(self):
+        audit_queue = self.tornado_settings.get("audit_queue")
+        if audit_queue is not None:
+            audit_queue.flush()
+
     def stop(self):
+        if self.upload_session_cleanup:
+            self.upload_session_cleanup.stop()
+        if self.audit_flusher:
+            self.audit_flusher.stop()
+        if self.counts_reconciler:
+            self.counts_reconciler.stop()
+        if self.action_archiver:
+            self.action_archiver.stop()
+        # Drain the queue, so no audit actions are lost
+        self.flush_audit_queue()
         self.http_server.stop()
 
     def start(self, run_loop=True):
@@ -324,9 +629,35 @@ Defaults to 'sqlite:///:memory:' (an in-memory SQLite database)
         # we _also_ do size-checks in code (both plugin & exchange side)
         self.http_server = HTTPServer(self.tornado_application, xheaders=True, max_buffer_size=self.max_buffer_size)
         self.http_server.listen(self.port, address=self.ip)
+        if self.upload_session_cleanup_interval > 0:
+            self.upload_session_cleanup = PeriodicCallback(
+                self.remove_expired_upload_sessions, self.upload_session_cleanup_interval * 1000
+            )
+            self.upload_session_cleanup.start()
+        if self.assignment_counts_reconcile_interval > 0:
+            self.counts_reconciler = PeriodicCallback(
+                self.reconcile_assignment_counts, self.assignment_counts_reconcile_interval * 1000
+            )
+            self.counts_reconciler.start()
+            # ... and once straight away, which fills the table after an upgrade
+            IOLoop.current().add_callback(self.reconcile_assignment_counts)
+        if self.action_archive_after_days > 0:
+            self.action_archiver = PeriodicCallback(self.archive_actions, self.action_archive_interval * 1000)
+            self.action_archiver.start()
+        if self.audit_write_behind:
+            # Full batches can be queued from the db threads, but are flushed here
+            self.tornado_settings["audit_queue"].io_loop = IOLoop.current()
+            self.audit_flusher = PeriodicCallback(self.flush_audit_queue, self.audit_flush_interval * 1000)
+            self.audit_flusher.start()
         logging.info("app.start about to hit the IOLoop start")
         if run_loop:
-            IOLoop.current().start()
+            if self.audit_write_behind:
+                # Turn a SIGTERM into an exit, so the finally below gets to drain the audit queue
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                IOLoop.current().start()
+            finally:
+                self.flush_audit_queue()
 
 
 if __name__ == "__main__":
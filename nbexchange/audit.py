@@ -0,0 +1,95 @@
+"""Write-behind queue for the audit actions.
+
+`fetched`, `feedback_fetched`, and `collected` actions are a record of who downloaded what - nothing
+in the exchange waits for them. Rather than each download committing its own action before it's
+sent, they can be queued, and written to the database in batches.
+
+The queue is flushed when it reaches `batch_size`, by the app every `audit_flush_interval`
+seconds, and when the app stops. Actions are queued by the handlers' database threads (see
+nbexchange.database.run_in_db_thread), but the queue is always flushed on the IOLoop.
+"""
+
+import threading
+from datetime import datetime
+
+from prometheus_client import Gauge
+from tornado.ioloop import IOLoop
+
+from nbexchange.database import scoped_session
+from nbexchange.models.actions import Action, AssignmentActions
+
+AUDIT_ACTIONS = (AssignmentActions.fetched, AssignmentActions.feedback_fetched, AssignmentActions.collected)
+
+audit_queue_depth = Gauge(
+    namespace="nbexchange",
+    subsystem="audit",
+    name="queue_depth",
+    documentation="Audit actions waiting to be written to the database",
+)
+
+
+class AuditQueue:
+    """Actions waiting to be written
+
+    queue = AuditQueue(batch_size=100, log=self.log)
+    queue.put(user_id=1, assignment_id=2, action=AssignmentActions.fetched, location=path)
+    queue.flush()
+    """
+
+    def __init__(self, batch_size=100, log=None):
+        self.batch_size = batch_size
+        self.log = log
+        self.pending = []
+        # The IOLoop a full batch is flushed on, set by the app when it starts. None is the current one
+        self.io_loop = None
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+        audit_queue_depth.set_function(lambda: len(self.pending))
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, user_id, assignment_id, action, location, student_id=None):
+        """Queue an action. The timestamp is now, not when it gets written"""
+        if action not in AUDIT_ACTIONS:
+            raise ValueError(f"{action} is not an audit action")
+        with self._lock:
+            self.pending.append(
+                {
+                    "user_id": user_id,
+                    "assignment_id": assignment_id,
+                    "action": action,
+                    "location": location,
+                    "student_id": student_id,
+                    "timestamp": datetime.now(Action.tz),
+                }
+            )
+            schedule = len(self.pending) >= self.batch_size and not self._flush_scheduled
+            if schedule:
+                self._flush_scheduled = True
+        # A full batch is written once the current request has had its turn
+        if schedule:
+            (self.io_loop or IOLoop.current()).add_callback(self.flush)
+
+    def flush(self):
+        """Write everything queued, in one transaction.
+
+        If the write fails, the actions are put back on the queue for the next flush
+        """
+        with self._lock:
+            self._flush_scheduled = False
+            batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        try:
+            with scoped_session() as session:
+                session.add_all([Action(**action) for action in batch])
+        except Exception as e:
+            if self.log:
+                self.log.error(f"Failed to write {len(batch)} audit actions: {e}")
+            with self._lock:
+                self.pending = batch + self.pending
+            return 0
+        if self.log:
+            self.log.debug(f"Wrote {len(batch)} audit actions")
+        return len(batch)
@@ -5,27 +5,246 @@ Notes:
      best practice to ensure the session gets closed
      and reduces noise in code by not having to manually
      commit or rollback the db if a exception occurs.
+
+     There is one engine (and so one connection pool) for the whole exchange. It starts out pointing
+     at `NBEX_DB_URL` (an in-memory SQLite database if that's not set), and is replaced with one built
+     from the application config (`NbExchange.db_url` & the `db_pool_*` settings) by `configure_engine`
+
+     Read-only handler work can use the read_session contextmanager instead, which goes to the
+     read replica (`NbExchange.db_replica_url`) if there is one. A user's reads go to the primary for
+     `replica_staleness` seconds after they've written, so they see their own changes.
+
+     Handlers can run their database work on a thread (`run_in_db_thread`), so a slow query doesn't
+     hold up every other request on the IOLoop.
 """
 
+import asyncio
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 
-from sqlalchemy import create_engine
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
 from nbexchange.models import Base
 
-engine = create_engine(os.environ.get("NBEX_DB_URL", "sqlite:///:memory:"))
-Base.metadata.create_all(engine)
+pool_checkout_seconds = Histogram(
+    namespace="nbexchange",
+    subsystem="db_pool",
+    name="checkout_seconds",
+    documentation="Time spent waiting for a database connection from the pool",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+pool_checked_out = Gauge(
+    namespace="nbexchange",
+    subsystem="db_pool",
+    name="checked_out",
+    documentation="Database connections currently in use",
+)
+
+# The SQLite production profile: concurrent readers with a writer (WAL), fsync only at checkpoints,
+# wait up to 5s for a lock rather than failing with "database is locked", and more of the file in memory
+SQLITE_PROFILE = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # milliseconds
+    "mmap_size": 268435456,  # 256MB
+    "cache_size": -65536,  # negative is in KiB: 64MB
+}
 
 # Session to be used throughout app.
-Session = sessionmaker(bind=engine)
+Session = sessionmaker()
+engine = None
+_engine_config = None
+
+# Sessions for read-only work: bound to the replica, if there is one, else the primary
+ReadSession = sessionmaker(info={"read_only": True})
+replica_engine = None
+_replica_config = None
+
+# Who the current request is for (set by the handlers), and when each writer last committed a change
+current_writer = ContextVar("current_writer", default=None)
+replica_staleness = 5.0
+_recent_writes = OrderedDict()
+# Commits happen on the db threads (see run_in_db_thread), so every use of _recent_writes holds this
+_recent_writes_lock = threading.Lock()
+
+# The threads handlers run their database work on (see run_in_db_thread.) None runs it on the IOLoop thread
+db_executor = None
+_db_threads = 0
+
+
+def register_sqlite_pragmas(engine, pragmas):
+    """set the PRAGMAs (a dict of name: value) on each new connection"""
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def engine_kwargs(url, **kwargs):
+    """The create_engine arguments for `url`: the given kwargs, plus our defaults for the database type.
+
+    Pool sizing (`pool_size`, `max_overflow`, `pool_timeout`) is dropped for in-memory SQLite, which
+    uses a single shared connection.
+    """
+    kwargs.setdefault("echo", False)
+    kwargs.setdefault("pool_pre_ping", True)
+    if url.startswith("sqlite"):
+        kwargs.setdefault("connect_args", {"check_same_thread": False})
+    elif url.startswith("mysql"):
+        if kwargs.get("pool_recycle") is None:
+            kwargs["pool_recycle"] = 60
+
+    if url.endswith(":memory:"):
+        # If we're using an in-memory database, ensure that only one connection
+        # is ever created.
+        kwargs.setdefault("poolclass", StaticPool)
+    if kwargs.get("poolclass", QueuePool) is not QueuePool:
+        for arg in ("pool_size", "max_overflow", "pool_timeout"):
+            kwargs.pop(arg, None)
+    if kwargs.get("pool_recycle") is None:
+        kwargs.pop("pool_recycle", None)
+    return kwargs
+
+
+def configure_engine(url, sqlite_pragmas=None, **kwargs):
+    """Point the exchange's sessions at `url`, returning the engine.
+
+    kwargs are passed to sqlalchemy.create_engine (see `engine_kwargs`.) For SQLite, `sqlite_pragmas`
+    are set on each connection (see `SQLITE_PROFILE`.) If the url and settings are the same as the
+    current engine's, the current engine is kept - so an in-memory database survives the app being
+    initialised again.
+    """
+    global engine, _engine_config
+
+    kwargs = engine_kwargs(url, **kwargs)
+    sqlite_pragmas = dict(sqlite_pragmas or {}) if url.startswith("sqlite") else {}
+    if engine is not None and _engine_config == (url, kwargs, sqlite_pragmas):
+        return engine
+    if engine is not None:
+        engine.dispose()
+
+    engine = create_engine(url, **kwargs)
+    _engine_config = (url, kwargs, sqlite_pragmas)
+    if sqlite_pragmas:
+        register_sqlite_pragmas(engine, sqlite_pragmas)
+    Session.configure(bind=engine)
+    if replica_engine is None:
+        ReadSession.configure(bind=engine)
+    pool_checked_out.set_function(lambda: getattr(engine.pool, "checkedout", lambda: 0)())
+    return engine
+
+
+def configure_replica_engine(url=None, staleness=5.0, **kwargs):
+    """Point the read_session sessions at the read replica `url` (or back at the primary, if it's None.)
+
+    kwargs are as for `configure_engine`. A writer's reads go to the primary for `staleness` seconds
+    after they commit a change.
+    """
+    global replica_engine, _replica_config, replica_staleness
+
+    replica_staleness = staleness
+    kwargs = engine_kwargs(url, **kwargs) if url else {}
+    if _replica_config == (url, kwargs):
+        return replica_engine
+    if replica_engine is not None:
+        replica_engine.dispose()
+
+    replica_engine = create_engine(url, **kwargs) if url else None
+    _replica_config = (url, kwargs)
+    ReadSession.configure(bind=replica_engine if replica_engine is not None else engine)
+    return replica_engine
+
+
+def configure_db_executor(threads):
+    """Run `run_in_db_thread` work on `threads` threads (or on the IOLoop thread, if it's 0.)
+
+    Each thread holds a pooled connection while it works, so there's no point in more threads than
+    the pool has connections.
+    """
+    global db_executor, _db_threads
+
+    if threads == _db_threads:
+        return db_executor
+    if db_executor is not None:
+        db_executor.shutdown(wait=False)
+    db_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="nbexchange-db") if threads else None
+    _db_threads = threads
+    return db_executor
+
+
+async def run_in_db_thread(fn, *args, **kwargs):
+    """Run `fn(*args, **kwargs)` - blocking database work - on a database thread, and return its result.
+
+    The IOLoop carries on with other requests meanwhile. `fn` runs in a copy of the current context
+    (so it has the `current_writer`), and a `current_writer` it sets is carried back. It must make (and
+    close) its own sessions, and shouldn't return ORM objects that would load anything more.
+    """
+    context = copy_context()
+    if db_executor is None:
+        result = context.run(fn, *args, **kwargs)
+    else:
+        result = await asyncio.get_running_loop().run_in_executor(db_executor, lambda: context.run(fn, *args, **kwargs))
+    current_writer.set(context.get(current_writer))
+    return result
+
+
+def record_write(writer):
+    """Note that `writer` has just committed a change"""
+    with _recent_writes_lock:
+        now = time.monotonic()
+        _recent_writes[writer] = now
+        _recent_writes.move_to_end(writer)
+        # Oldest first, so we can stop at the first one still within the staleness window
+        while _recent_writes:
+            oldest, written = next(iter(_recent_writes.items()))
+            if now - written < replica_staleness:
+                break
+            del _recent_writes[oldest]
+
+
+def wrote_recently(writer):
+    """Has `writer` committed a change in the last `replica_staleness` seconds?"""
+    with _recent_writes_lock:
+        written = _recent_writes.get(writer)
+    return written is not None and time.monotonic() - written < replica_staleness
+
+
+@event.listens_for(Session, "after_flush")
+def _note_flush(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _note_commit(session):
+    writer = current_writer.get()
+    if session.info.pop("wrote", False) and writer is not None:
+        record_write(writer)
+
+
+@event.listens_for(ReadSession, "before_flush")
+def _refuse_flush(session, flush_context, instances):
+    raise RuntimeError("read_session is read-only: write with scoped_session")
 
 
 @contextmanager
 def scoped_session():
     session = Session()
     try:
+        # Get the connection up front, so we know how long the pool made us wait for it
+        start = time.perf_counter()
+        session.connection()
+        pool_checkout_seconds.observe(time.perf_counter() - start)
         yield session
         session.commit()
     except Exception:
@@ -33,3 +252,26 @@ def scoped_session():
         raise
     finally:
         session.close()
+
+
+@contextmanager
+def read_session():
+    """A session for read-only work: on the read replica, unless the current writer (see
+    `current_writer`) wrote recently - in which case it's a primary session, so they see their changes.
+
+    Nothing is committed (and flushing any changes raises an error.)
+    """
+    writer = current_writer.get()
+    if replica_engine is not None and writer is not None and wrote_recently(writer):
+        session = ReadSession(bind=engine)
+    else:
+        session = ReadSession()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+
+
+configure_engine(os.environ.get("NBEX_DB_URL", "sqlite:///:memory:"))
+Base.metadata.create_all(engine)
@@ -14,8 +14,8 @@ import alembic.config
 from alembic.script import ScriptDirectory
 from sqlalchemy import create_engine, event, exc, inspect, select, text
 from sqlalchemy.orm import Session, interfaces, object_session
-from sqlalchemy.pool import StaticPool
 
+from nbexchange import database
 from nbexchange.models import Base
 
 _here = os.path.abspath(os.path.dirname(__file__))
@@ -193,16 +193,6 @@ def _expire_relationship(target, relationship_prop):
             session.expire(obj, [relationship_prop.back_populates])
 
 
-def register_foreign_keys(engine):
-    """register PRAGMA foreign_keys=on on connection"""
-
-    @event.listens_for(engine, "connect")
-    def connect(dbapi_con, con_record):
-        cursor = dbapi_con.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.close()
-
-
 @event.listens_for(Session, "persistent_to_deleted")
 def _notify_deleted_relationships(session, obj):
     """Expire relationships when an object becomes deleted
@@ -343,25 +333,13 @@ def add_row_format(base):
         t.dialect_kwargs["mysql_ROW_FORMAT"] = "DYNAMIC"
 
 
-def setup_db(url="sqlite:///:memory:", reset=False, log=None, **kwargs):
+def setup_db(url="sqlite:///:memory:", reset=False, log=None, sqlite_pragmas=None, **kwargs):
     """Check database revision and create all models"""
 
     log.info(f"dbutil.setup_db: db_url:{url}, reset:{reset}")
-    if url.startswith("sqlite"):
-        kwargs.setdefault("connect_args", {"check_same_thread": False})
 
-    elif url.startswith("mysql"):
-        kwargs.setdefault("pool_recycle", 60)
-
-    if url.endswith(":memory:"):
-        # If we're using an in-memory database, ensure that only one connection
-        # is ever created.
-        kwargs.setdefault("poolclass", StaticPool)
-
-    # From sqlalchemy 2.0, testing pools is now built in
-    engine = create_engine(url, pool_pre_ping=True, **kwargs)
-    if url.startswith("sqlite"):
-        register_foreign_keys(engine)
+    # The one engine the exchange uses (see nbexchange.database)
+    engine = database.configure_engine(url, sqlite_pragmas=sqlite_pragmas, **kwargs)
 
     # not needed: https://docs.sqlalchemy.org/en/20/core/pooling.html#disconnect-handling-pessimistic
     # # enable pessimistic disconnect handling
@@ -373,6 +351,8 @@ def setup_db(url="sqlite:///:memory:", reset=False, log=None, **kwargs):
     if mysql_large_prefix_check(engine):  # if mysql is allows large indexes
         add_row_format(Base)  # set format on the tables
     # check the db revision (will raise, pointing to `upgrade-db` if version doesn't match)
-    check_db_revision(engine, log)
+    # An in-memory database is always new - and alembic would be looking at a different one
+    if not url.endswith(":memory:"):
+        check_db_revision(engine, log)
 
     Base.metadata.create_all(engine)
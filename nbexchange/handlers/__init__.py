@@ -1,18 +1,25 @@
 from nbexchange.handlers.assignment import Assignment, Assignments
 from nbexchange.handlers.collection import Collection, Collections
-from nbexchange.handlers.feedback import FeedbackHandler
+from nbexchange.handlers.counts import AssignmentCounts
+from nbexchange.handlers.feedback import FeedbackBatch, FeedbackFile, FeedbackHandler
 from nbexchange.handlers.history import History
 from nbexchange.handlers.pages import HomeHandler
 from nbexchange.handlers.submission import Submission, Submissions
+from nbexchange.handlers.upload_session import UploadSession, UploadSessions
 
 default_handlers = [
     Assignment,
     Assignments,
+    AssignmentCounts,
     Collection,
     Collections,
     Submission,
     Submissions,
     HomeHandler,
     FeedbackHandler,
+    FeedbackFile,
+    FeedbackBatch,
     History,
+    UploadSession,
+    UploadSessions,
 ]
@@ -3,10 +3,12 @@ import os
 import time
 import uuid
 
+from sqlalchemy.orm import selectinload
 from tornado import httputil, web
 
-from nbexchange.database import scoped_session
+from nbexchange.database import read_session, run_in_db_thread, scoped_session
 from nbexchange.handlers.base import BaseHandler, authenticated
+from nbexchange.handlers.upload import UploadHandler
 from nbexchange.models.actions import Action, AssignmentActions
 from nbexchange.models.assignments import Assignment as AssignmentModel
 from nbexchange.models.courses import Course
@@ -21,10 +23,77 @@ This relys on users being logged in, and the user-object having additional data:
 """
 
 
+def release_location(base_storage_location, org_id, course_code, assignment_code, filename):
+    """Releases are stored in $path/release/$course_code/$assignment_code/<timestamp>/<uuid>.<extn>
+
+    Note - this means we can have multiple versions of the same release on the system
+    """
+    # This should be abstracted, so it can be overloaded to store in other manners (eg AWS)
+    return os.path.join(
+        base_storage_location,
+        str(org_id),
+        AssignmentActions.released.value,
+        course_code,
+        assignment_code,
+        str(int(time.time())),
+        str(uuid.uuid4()) + os.path.splitext(filename)[1],
+    )
+
+
+def record_release(session, course, assignment_code, user_id, location, notebooks, timestamp, log, checksum=None):
+    """Record the release of the file at `location` (whose sha256 is `checksum`).
+
+    Finds the assignment (re-activating it, if it had been unreleased) or makes a new one, records
+    its notebooks, and adds the `released` action.
+
+    Used by Assignment.post, and when finalizing an UploadSession. Returns the assignment.
+    """
+    # We need to find this assignment, or make a new one.
+    assignment = AssignmentModel.find_by_code(db=session, code=assignment_code, course_id=course.id)
+
+    if assignment is None:
+        # Look for inactive assignments
+        assignment = AssignmentModel.find_by_code(db=session, code=assignment_code, course_id=course.id, active=False)
+
+    if assignment is None:
+        log.info(f"New Assignment details: assignment_code:{assignment_code}, course_id:{course.id}")
+        # defaults active
+        assignment = AssignmentModel(assignment_code=assignment_code, course_id=course.id)
+        session.add(assignment)
+
+    # Set assignment to active
+    assignment.active = True
+
+    # now commit the assignment, and get it back to find the id
+    assignment = AssignmentModel.find_by_code(db=session, code=assignment_code, course_id=course.id)
+
+    # Record the notebooks associated with this assignment
+    for notebook in notebooks:
+        log.debug(f"Adding notebook {notebook}")
+        new_notebook = Notebook(name=notebook)
+        assignment.notebooks.append(new_notebook)
+
+    # Record the action.
+    # Note we record the path to the files.
+    log.info(f"Adding action {AssignmentActions.released.value} for user {user_id} against assignment {assignment.id}")
+    action = Action(
+        user_id=user_id,
+        assignment_id=assignment.id,
+        action=AssignmentActions.released,
+        location=location,
+        checksum=checksum,
+        timestamp=timestamp,
+    )
+    session.add(action)
+    return assignment
+
+
 class Assignments(BaseHandler):
     """.../assignments/
     parmas:
         course_id: course_code
+        limit: page size - optional. If provided, only this many actions are listed, with a "next_cursor"
+        cursor: the "next_cursor" from the previous page - optional
 
     GET: gets list of assignments for $course_code
     """
@@ -32,9 +101,7 @@ class Assignments(BaseHandler):
     urls = ["assignments"]
 
     @authenticated
-    def get(self):
-        models = []
-
+    async def get(self):
         [course_code] = self.get_params(["course_id"])
 
         if not course_code:
@@ -43,8 +110,14 @@ class Assignments(BaseHandler):
             self.finish({"success": False, "note": note, "value": []})
             return
 
+        limit, cursor, note = self.get_page_params()
+        if note:
+            self.log.info(note)
+            self.finish({"success": False, "note": note, "value": []})
+            return
+
         # Who is my user?
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
 
         self.log.debug(f"User: {this_user.get('name')}")
         # For what course do we want to see the assignments?
@@ -56,63 +129,86 @@ class Assignments(BaseHandler):
             self.finish({"success": False, "note": note, "value": []})
             return
 
+        self.finish(await run_in_db_thread(self.list_assignments, this_user, course_code, limit, cursor))
+
+    def list_assignments(self, this_user, course_code, limit, cursor):
+        """The database work of `get` (which runs it on a database thread): returns the response"""
+        models = []
+
         # Find the course being referred to
-        with scoped_session() as session:
+        with read_session() as session:
             course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
             if not course:
                 note = f"Course {course_code} does not exist"
                 self.log.info(note)
-                self.finish({"success": False, "note": note, "value": []})
-                return
-
-            assignments = AssignmentModel.find_for_course(db=session, course_id=course.id, log=self.log)
+                return {"success": False, "note": note, "value": []}
+
+            # A fixed number of queries, however many assignments, actions & notebooks there are:
+            # the assignments (with their notebooks), the actions this user sees, and this user's feedback
+            assignments = (
+                AssignmentModel.find_for_course(db=session, course_id=course.id, log=self.log)
+                .options(selectinload(AssignmentModel.notebooks))
+                .all()
+            )
+            visible_actions = Action.find_visible_to_user(
+                db=session,
+                assignment_ids=[assignment.id for assignment in assignments],
+                user_id=this_user.get("id"),
+                after_id=cursor,
+                limit=limit + 1 if limit else None,
+                log=self.log,
+            )
+            if limit:
+                next_cursor = self.next_cursor([action.id for action in visible_actions], limit)
+                visible_actions = visible_actions[:limit]
+            actions_by_assignment = {}
+            for action in visible_actions:
+                actions_by_assignment.setdefault(action.assignment_id, []).append(action)
+            feedback_by_notebook = {}
+            for feedback in Feedback.find_all_for_student_notebooks(
+                db=session,
+                student_id=this_user.get("id"),
+                notebook_ids=[notebook.id for assignment in assignments for notebook in assignment.notebooks],
+                log=self.log,
+            ):
+                feedback_by_notebook.setdefault(feedback.notebook_id, []).append(feedback)
 
             for assignment in assignments:
                 self.log.debug("==========")
                 self.log.debug(f"Assignment: {assignment}")
+                actions = actions_by_assignment.get(assignment.id, [])
 
                 # To maintain backward compatibility we need to test to see if any feedback timestamps match any
                 #   submission timestamps. New code will, old code won't.
                 # New code matches feedback to submission on timestamp
                 # Old code adds latest feedback to all submissions
                 # To test old vs new, we check to see if any submit timestamps exist in the set of feedback timestamps
-                #   .... if any do, we're new stylee.... and thus _include_ the timestamp in the feedback query.
-                feedback_timestamps = set()
-                notebook_ids = [notebook.id for notebook in assignment.notebooks]
+                #   .... if any do, we're new stylee.... and thus _include_ the timestamp in the feedback match.
+                feedback_timestamps = {
+                    feedback.timestamp
+                    for notebook in assignment.notebooks
+                    for feedback in feedback_by_notebook.get(notebook.id, [])
+                }
                 submit_timestamps = [
                     action.timestamp
-                    for action in assignment.actions
+                    for action in actions
                     if action.action == AssignmentActions.submitted and this_user.get("id") == action.user_id
                 ]
-
-                for f in session.query(Feedback).filter(
-                    Feedback.notebook_id.in_(notebook_ids), Feedback.timestamp.in_(submit_timestamps)
-                ):
-                    feedback_timestamps.add(f.timestamp)
                 new_stylee = [sub_ts for sub_ts in submit_timestamps if sub_ts in feedback_timestamps]
                 # End of new_stylee discovery
 
-                for action in assignment.actions:
-                    # For every action that is not "released" checked if the user id matches
-                    if action.action != AssignmentActions.released and this_user.get("id") != action.user_id:
-                        self.log.debug(f"ormuser: {this_user.get('id')} - actionUser {action.user_id}")
-                        self.log.debug("Action does not belong to user, skip action")
-                        continue
+                for action in actions:
                     notebooks = []
                     action_timestamp = self.check_timezone(action.timestamp)
                     for notebook in assignment.notebooks:
                         feedback_available = False
                         feedback_timestamp = None
                         if action.action == AssignmentActions.submitted:
-                            query_params = {
-                                "db": session,
-                                "notebook_id": notebook.id,
-                                "student_id": this_user.get("id"),
-                                "log": self.log,
-                            }
-                            if new_stylee:
-                                query_params["timestamp"] = action_timestamp
-                            feedback = Feedback.find_notebook_for_student(**query_params)
+                            # The most recent feedback for the notebook (for this submission, if new stylee)
+                            feedback = None
+                            for candidate in feedback_by_notebook.get(notebook.id, []):
+                                if not new_stylee or candidate.timestamp == action.timestamp:
+                                    feedback = candidate
                             if feedback:
                                 feedback_available = bool(feedback)
                                 feedback_timestamp = self.check_timezone(feedback.timestamp).strftime(
@@ -130,23 +226,26 @@ class Assignments(BaseHandler):
                         {
                             "assignment_id": assignment.assignment_code,
                             "student_id": action.user_id,
-                            "course_id": assignment.course.course_code,
+                            "course_id": course.course_code,
                             "status": action.action.value,  # currently called 'action' in our db
                             "path": action.location,
+                            "checksum": action.checksum,
                             "notebooks": notebooks,
                             "timestamp": action_timestamp.strftime(self.timestamp_format),
                         }
                     )
 
         self.log.debug(f"Assignments: {models}")
-        self.finish({"success": True, "value": models})
+        if limit:
+            return {"success": True, "value": models, "next_cursor": next_cursor}
+        return {"success": True, "value": models}
 
     # This has no authentiction wrapper, so false implication os service
     def post(self):
         raise web.HTTPError(501)
 
 
-class Assignment(BaseHandler):
+class Assignment(UploadHandler):
     """.../assignment/
     parmas:
         course_id: course_code
@@ -160,7 +259,7 @@ class Assignment(BaseHandler):
     urls = ["assignment"]
 
     @authenticated
-    def get(self):  # def get(self, course_code, assignment_code=None):
+    async def get(self):  # def get(self, course_code, assignment_code=None):
         [course_code, assignment_code] = self.get_params(["course_id", "assignment_id"])
 
         if not (course_code and assignment_code):
@@ -169,7 +268,7 @@ class Assignment(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
 
         if course_code not in this_user["courses"]:
             note = f"User not subscribed to course {course_code}"
@@ -177,80 +276,135 @@ class Assignment(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
-        # Find the course being referred to
-        with scoped_session() as session:
-            course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
-            if course is None:
-                note = f"Course {course_code} does not exist"
-                self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return  # needs a proper 'fail' here
-
-            note = ""
-            self.log.debug(f"Course:{course_code} assignment:{assignment_code}")
-
-            # The location for the data-object is actually held in the 'released' action for the given assignment
-            # We want the last one...
-            assignment = AssignmentModel.find_by_code(
-                db=session,
-                code=assignment_code,
-                course_id=course.id,
-                action=AssignmentActions.released.value,
-            )
+        note, handle, etag, last_modified = await run_in_db_thread(
+            self.fetch_release, this_user, course_code, assignment_code
+        )
+        if note:
+            self.finish({"success": False, "note": note})
+            return
+        self.log.info("record of fetch action made")
 
-            if assignment is None:
-                note = f"Assignment {assignment_code} does not exist"
-                self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return  # needs a proper 'fail' here
+        self._headers = httputil.HTTPHeaders(
+            {
+                "Content-Type": "application/gzip",
+                "Date": httputil.format_timestamp(time.time()),
+            }
+        )
+        # Everyone fetching this release gets the same file, so repeat fetches can be answered with a 304
+        if self.check_not_modified(etag=etag, last_modified=last_modified):
+            handle.close()
+            self.set_status(304)
+            self.finish()
+            return
 
-            self._headers = httputil.HTTPHeaders(
-                {
-                    "Content-Type": "application/gzip",
-                    "Date": httputil.format_timestamp(time.time()),
-                }
-            )
+        # The action is committed before we start sending, so we don't hold a db connection during the download
+        await self.stream_file(handle)
+
+    def fetch_release(self, this_user, course_code, assignment_code):
+        """Open the latest release of the assignment, and record the fetch (run on a db thread, see get)
+
+        Returns (note, handle, etag, last_modified): note says why there's nothing to fetch, or is None
+        """
+        # The file is opened before the fetch is recorded (so we don't record one that can't be sent), and
+        # closed again if recording it fails
+        handle = None
+        try:
+            # Find the course being referred to
+            with scoped_session() as session:
+                course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
+                if course is None:
+                    note = f"Course {course_code} does not exist"
+                    self.log.info(note)
+                    return note, None, None, None
+
+                self.log.debug(f"Course:{course_code} assignment:{assignment_code}")
+
+                # The location for the data-object is actually held in the 'released' action for the given assignment
+                # We want the last one...
+                assignment = AssignmentModel.find_by_code(
+                    db=session,
+                    code=assignment_code,
+                    course_id=course.id,
+                    action=AssignmentActions.released.value,
+                )
 
-            data = b""
+                if assignment is None:
+                    note = f"Assignment {assignment_code} does not exist"
+                    self.log.info(note)
+                    return note, None, None, None
 
-            release_file = None
+                action = Action.find_most_recent_action(
+                    db=session,
+                    assignment_id=assignment.id,
+                    action=AssignmentActions.released,
+                    log=self.log,
+                )
+                if action is None:
+                    raise web.HTTPError(404, f"Assignment {assignment_code} has no release")
+                release_file = action.location
 
-            action = Action.find_most_recent_action(
-                db=session,
-                assignment_id=assignment.id,
-                action=AssignmentActions.released,
-                log=self.log,
-            )
-            release_file = action.location
+                if not release_file:
+                    raise web.HTTPError(500, f"assignment get handler found no release file {release_file}")
 
-            if release_file:
                 try:
                     # Hmmm this seems to raise it's own 500: No such file or directory if not present
-                    with open(release_file, "r+b") as handle:
-                        data = handle.read()
+                    handle = open(release_file, "r+b")
                 except Exception as e:
                     raise web.HTTPError(500, f"assignment get handler unable to open '{release_file}': {e}")
+                etag, last_modified = self.release_etag(action, handle), action.timestamp
 
                 self.log.info(
                     f"Adding action {AssignmentActions.fetched.value} for user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
                 )
-                action = Action(
+                self.record_audit_action(
+                    session,
                     user_id=this_user["id"],
                     assignment_id=assignment.id,
                     action=AssignmentActions.fetched,
                     location=release_file,
                 )
-                session.add(action)
-                self.log.info("record of fetch action committed")
-                self.finish(data)
-            else:
-                raise web.HTTPError(500, f"assignment get handler found no release file {release_file}")
+        except BaseException:
+            if handle:
+                handle.close()
+            raise
+        return None, handle, etag, last_modified
+
+    @staticmethod
+    def release_etag(action, handle):
+        """A strong ETag for a released file
+
+        Each release is a new action (& file), so the action id identifies the content; the stored checksum
+        (or, failing that, the size & modification time) guards against the file being replaced on disk.
+        """
+        if action.checksum:
+            return f"{action.id}-{action.checksum}"
+        stat = os.fstat(handle.fileno())
+        return f"{action.id}-{stat.st_size}-{stat.st_mtime_ns}"
+
+    def max_body_size(self):
+        # Only instructors release assignments
+        return self.max_release_size if self.is_instructor else self.max_unprivileged_size
+
+    def upload_location(self, name, filename):
+        """Where a released assignment is streamed to (see release_location)"""
+        [course_code, assignment_code] = self.get_params(["course_id", "assignment_id"])
+        user = self.current_user
+        # Only instructors release assignments: anything else is validated (and rejected) by `post`
+        if not (name == "assignment" and course_code and assignment_code and user):
+            return None
+        if not self.is_instructor:
+            return None
+
+        location = release_location(
+            self.base_storage_location, user.get("org_id", 1), course_code, assignment_code, filename
+        )
+        return self.storage_location(location, course_code, assignment_code)
 
     # This is releasing an **assignment**, not a student submission
     @authenticated
-    def post(self):
-        # Reminder: the `max_buffer_size` we have set is in config is the size given to the underlying HTTPServer
-        # Oversized content is rejected by the underlying HTTPServer, and never gets here.
+    async def post(self):
+        # Oversized content is rejected (with a 413) before the body is read, and never gets here (see max_body_size)
+        # The body is streamed to disk as it arrives (see UploadHandler), so is never held in memory.
 
         [course_code, assignment_code] = self.get_params(["course_id", "assignment_id"])
         self.log.debug(
@@ -262,7 +416,7 @@ class Assignment(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
 
         if course_code not in this_user["courses"]:
             note = f"User not subscribed to course {course_code}"
@@ -276,115 +430,68 @@ class Assignment(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
-        # The course will exist: the user object creates it if it doesn't exist
-        #  - and we know the user is subscribed to the course as an instructor (above)
-        with scoped_session() as session:
-            course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
-
-            # We need to find this assignment, or make a new one.
-            assignment = AssignmentModel.find_by_code(db=session, code=assignment_code, course_id=course.id)
-
-            if assignment is None:
-                # Look for inactive assignments
-                assignment = AssignmentModel.find_by_code(
-                    db=session, code=assignment_code, course_id=course.id, active=False
-                )
-
-            if assignment is None:
-                self.log.info(f"New Assignment details: assignment_code:{assignment_code}, course_id:{course.id}")
-                # defaults active
-                assignment = AssignmentModel(assignment_code=assignment_code, course_id=course.id)
-                session.add(assignment)
-                # deliberately no commit: we need to be able to roll-back if there's no data!
-
-            # Set assignment to active
-            assignment.active = True
-
-            # storage is dynamically in $path/release/$course_code/$assignment_code/<timestamp>/
-            # Note - this means we can have multiple versions of the same release on the system
-            release_file = os.path.join(
-                self.base_storage_location,
-                str(this_user["org_id"]),
-                AssignmentActions.released.value,
-                course_code,
-                assignment_code,
-                str(int(time.time())),
-            )
-
-            if not self.request.files:
-                # self.log.warning("Error: No file supplied in upload")  # TODO: improve error message
-                raise web.HTTPError(412, "assignment handler upload: No file supplied in upload")  # precondition failed
-
-            try:
-                # Write the uploaded file to the desired location
-                file_info = self.request.files["assignment"][0]
-
-                filename, content_type = (
-                    file_info["filename"],
-                    file_info["content_type"],
-                )
-                note = f"Received file {filename}, of type {content_type}"
-                self.log.info(note)
-                extn = os.path.splitext(filename)[1]
-                cname = str(uuid.uuid4()) + extn
-
-                # store to disk.
-                # This should be abstracted, so it can be overloaded to store in other manners (eg AWS)
-                release_file = release_file + "/" + cname
-                # Ensure the directory exists
-                os.makedirs(os.path.dirname(release_file), exist_ok=True)
-                with open(release_file, "w+b") as handle:
-                    handle.write(file_info["body"])
-
-            except Exception as e:  # TODO: exception handling
-                raise web.HTTPError(500, f"assignment handler Upload failed: {e}")
-
-            # Check the file exists on disk
-            if not (
-                os.path.exists(release_file) and os.access(release_file, os.R_OK) and os.path.getsize(release_file) > 0
-            ):
-                note = "File upload failed."
-                self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return
-
-            # We shouldn't get here, but a double-check is good
-            if os.path.getsize(release_file) > self.max_buffer_size:
-                os.remove(release_file)
-                note = "File upload oversize, and rejected. Please reduce the contents of the assignment, re-generate, and re-release"  # noqa: E501
-                self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return
+        # The file has already been streamed to $path/release/$course_code/$assignment_code/<timestamp>/
+        # (see upload_location)
+        if self.upload_error:
+            self.raise_upload_error("assignment handler Upload failed: ")
+
+        if "assignment" not in self.uploaded_files:
+            # self.log.warning("Error: No file supplied in upload")  # TODO: improve error message
+            raise web.HTTPError(412, "assignment handler upload: No file supplied in upload")  # precondition failed
+
+        file_info = self.uploaded_files["assignment"][0]
+        note = f"Received file {file_info['filename']}, of type {file_info['content_type']}"
+        self.log.info(note)
+        release_file = file_info["path"]
+
+        # Check the file exists on disk
+        if not (
+            os.path.exists(release_file) and os.access(release_file, os.R_OK) and os.path.getsize(release_file) > 0
+        ):
+            note = "File upload failed."
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
 
-            # now commit the assignment, and get it back to find the id
-            assignment = AssignmentModel.find_by_code(db=session, code=assignment_code, course_id=course.id)
+        # We shouldn't get here, but a double-check is good
+        if os.path.getsize(release_file) > self.max_release_size:
+            os.remove(release_file)
+            note = "File upload oversize, and rejected. Please reduce the contents of the assignment, re-generate, and re-release"  # noqa: E501
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
 
-            # Record the notebooks associated with this assignment
-            notebooks = self.get_arguments("notebooks")
+        timestamp = self.get_timestamp()  # this is a string object
+        await run_in_db_thread(
+            self.add_release,
+            this_user,
+            course_code,
+            assignment_code,
+            file_info,
+            self.get_arguments("notebooks"),
+            datetime.datetime.strptime(timestamp, self.timestamp_format),  # database wants a datetime object
+        )
+        self.keep_upload(file_info)
 
-            for notebook in notebooks:
-                self.log.debug(f"Adding notebook {notebook}")
-                new_notebook = Notebook(name=notebook)
-                assignment.notebooks.append(new_notebook)
+        self.finish({"success": True, "note": "Released"})
 
-            # Record the action.
-            # Note we record the path to the files.
-            self.log.info(
-                f"Adding action {AssignmentActions.released.value} for user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
-            )
-            timestamp = self.get_timestamp()  # this is a string object
-            action = Action(
+    def add_release(self, this_user, course_code, assignment_code, file_info, notebooks, timestamp):
+        """Record the uploaded release (run on a db thread, see post)"""
+        # The course will exist: the user object creates it if it doesn't exist
+        #  - and we know the user is subscribed to the course as an instructor (see post)
+        with scoped_session() as session:
+            course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
+            record_release(
+                session,
+                course=course,
+                assignment_code=assignment_code,
                 user_id=this_user["id"],
-                assignment_id=assignment.id,
-                action=AssignmentActions.released,
-                location=release_file,
-                timestamp=datetime.datetime.strptime(
-                    timestamp, self.timestamp_format
-                ),  # database wants a datetime object
+                location=file_info["path"],
+                notebooks=notebooks,
+                timestamp=timestamp,
+                log=self.log,
+                checksum=file_info["checksum"],
             )
-            session.add(action)
-
-            self.finish({"success": True, "note": "Released"})
 
     # This is unreleasing an assignment
     @authenticated
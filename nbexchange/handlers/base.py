@@ -1,15 +1,19 @@
+import email.utils
 import functools
+import os
 import re
 from datetime import datetime
 from typing import Awaitable, Callable, Optional
-from urllib.parse import unquote, unquote_plus
+from urllib.parse import quote, unquote, unquote_plus
 from zoneinfo import ZoneInfo
 
 from dateutil.tz import gettz
-from tornado import web
+from jupyter_server.utils import url_path_join as ujoin
+from tornado import httputil, iostream, web
 from tornado.log import app_log
 
-from nbexchange.database import scoped_session
+from nbexchange.database import current_writer, run_in_db_thread, scoped_session
+from nbexchange.models.actions import Action
 from nbexchange.models.courses import Course
 from nbexchange.models.subscriptions import Subscription
 from nbexchange.models.users import User
@@ -75,6 +79,95 @@ class BaseHandler(web.RequestHandler):
     def max_buffer_size(self):
         return self.settings["max_buffer_size"]
 
+    # Per-route upload limits (see UploadHandler.max_body_size)
+    # Users who may not upload a file to a route still get to send a (small) request, and be told why not
+    max_unprivileged_size = 1024 * 1024
+
+    @property
+    def max_release_size(self):
+        return self.settings.get("max_release_size", self.max_buffer_size)
+
+    @property
+    def max_submission_size(self):
+        return self.settings.get("max_submission_size", self.max_buffer_size)
+
+    @property
+    def max_feedback_size(self):
+        return self.settings.get("max_feedback_size", 100 * 1024 * 1024)
+
+    @property
+    def is_instructor(self):
+        """Whether the current user is an instructor - from the request alone, so can be used in `prepare`"""
+        user = self.current_user or {}
+        return (user.get("course_role") or "").casefold() == "instructor"
+
+    def storage_location(self, location, *components):
+        """`location`, if it's safe to write an upload to: None if any of the (request-supplied) path
+        `components` would step into another directory - eg a course code of `../other` - or the path ends
+        up outside `base_storage_location`
+
+        Codes can be anything else (`Made up`, `PHYS101.2024`, ..): they're only ever one directory name
+        """
+        separators = [sep for sep in (os.sep, os.altsep) if sep]
+        if not all(
+            component and component not in (".", "..") and not any(sep in component for sep in separators)
+            for component in components
+        ):
+            self.log.info(f"Upload path components {components} rejected")
+            return None
+        base = os.path.realpath(self.base_storage_location)
+        if os.path.commonpath([base, os.path.realpath(location)]) != base:
+            self.log.info(f"Upload location {location} is outside {base}, and rejected")
+            return None
+        return location
+
+    @property
+    def download_chunk_size(self):
+        return self.settings.get("download_chunk_size", 64 * 1024)
+
+    @property
+    def file_offload(self):
+        return self.settings.get("file_offload", "none")
+
+    @property
+    def file_offload_prefix(self):
+        return self.settings.get("file_offload_prefix", "/protected/")
+
+    @property
+    def audit_queue(self):
+        return self.settings.get("audit_queue")
+
+    def record_audit_action(self, session, user_id, assignment_id, action, location, student_id=None):
+        """Record a download (a `fetched`, `feedback_fetched`, or `collected` action)
+
+        With `audit_write_behind`, the action is queued (see nbexchange.audit), and the
+        download doesn't wait on it being written. Otherwise it's added to `session` - or, for
+        a read_session, written in a session of its own.
+
+        student_id is who a `collected` action is for (see Action.student_id)
+        """
+        action = dict(
+            user_id=user_id, assignment_id=assignment_id, action=action, location=location, student_id=student_id
+        )
+        self.record_audit_actions(session, [action])
+
+    def record_audit_actions(self, session, actions):
+        """Record several downloads at once: `actions` is a list of `record_audit_action` kwargs (less `session`)
+
+        For a read_session, they're all written in the one session (& transaction) of their own
+        """
+        if self.audit_queue is not None:
+            for action in actions:
+                self.audit_queue.put(**action)
+            return
+        actions = [Action(**action) for action in actions]
+        if session.info.get("read_only"):
+            # A read_session (which may be on the replica) can't write
+            with scoped_session() as write_session:
+                write_session.add_all(actions)
+        else:
+            session.add_all(actions)
+
     def get_current_user(self):
         return self.user_plugin.get_current_user(self)
 
@@ -98,6 +191,8 @@ class BaseHandler(web.RequestHandler):
             raise ValueError(note)
 
         self.org_id = org_id
+        # So a read_session knows whose writes it should be able to see
+        current_writer.set(f"{org_id}/{hub_username}")
 
         with scoped_session() as session:
             user = User.find_by_name(db=session, name=hub_username, log=self.log)
@@ -146,11 +241,125 @@ class BaseHandler(web.RequestHandler):
             }
         return model
 
+    async def get_nbex_user(self):
+        """`nbex_user`, with its database work on a database thread (see `run_in_db_thread`)"""
+        return await run_in_db_thread(lambda: self.nbex_user)
+
     @property
     def log(self):
         """I can't seem to avoid typing self.log"""
         return self.settings.get("log", app_log)
 
+    def check_not_modified(self, etag, last_modified=None):
+        """Set the cache validators for a download, and check them against the request.
+
+        `etag` should identify the exact content being sent (it's sent as a strong ETag), and
+        `last_modified` is an optional datetime.
+
+        Returns True if the client's copy is current, and the caller can just send a 304.
+        """
+        self.set_header("Etag", f'"{etag}"')
+        if last_modified:
+            self.set_header("Last-Modified", last_modified)
+
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.1.3)
+        if self.request.headers.get("If-None-Match"):
+            return self.check_etag_header()
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since and last_modified:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return self.check_timezone(last_modified).replace(microsecond=0) <= self.check_timezone(since)
+        return False
+
+    def offload_file(self, path):
+        """Hand sending `path` to the front proxy (see `NbExchange.file_offload`).
+
+        x-accel-redirect maps the file onto `file_offload_prefix`, relative to `base_storage_location`.
+        x-sendfile uses the path as is.
+
+        Returns False (ie, send it ourselves) if the file can't be mapped
+        """
+        path = os.path.abspath(path)
+        if self.file_offload == "x-sendfile":
+            self.set_header("X-Sendfile", path)
+            return True
+
+        relative_path = os.path.relpath(path, os.path.abspath(self.base_storage_location))
+        if relative_path.startswith(os.pardir):
+            self.log.warning(f"Unable to offload {path}: it is not in {self.base_storage_location}")
+            return False
+        self.set_header("X-Accel-Redirect", ujoin(self.file_offload_prefix, quote(relative_path)))
+        return True
+
+    async def stream_file(self, handle):
+        """Send an open file to the client, and finish the request.
+
+        The file is sent in `download_chunk_size` chunks, and we wait for each chunk to be flushed
+        to the client before reading the next - so only one chunk per download is ever in memory.
+
+        A single `Range: bytes=...` is honoured (with a 206 Partial Content), so interrupted downloads can
+        be resumed. Multiple ranges aren't supported, and get the whole file. `If-Range` is checked against
+        any validators already set by `check_not_modified`.
+
+        If `file_offload` is configured, we just send the header telling the front proxy which file to send.
+        The handle is closed once we're done.
+        """
+        if self.file_offload != "none" and self.offload_file(handle.name):
+            handle.close()
+            self.finish()
+            return
+
+        size = os.fstat(handle.fileno()).st_size
+        start, end = 0, size
+        self.set_header("Accept-Ranges", "bytes")
+
+        # Same range handling as tornado.web.StaticFileHandler
+        range_header = self.request.headers.get("Range")
+        # If-Range: only send the range if the client's partial copy is of the current file
+        if_range = self.request.headers.get("If-Range")
+        if if_range and if_range not in (self._headers.get("Etag"), self._headers.get("Last-Modified")):
+            range_header = None
+        request_range = httputil._parse_request_range(range_header) if range_header else None
+        if request_range:
+            start, end = request_range
+            if start is None:
+                start = 0
+            elif start < 0:
+                start = max(start + size, 0)
+            if end is None or end > size:
+                end = size
+            if start >= end:
+                handle.close()
+                self.set_status(416)  # Range Not Satisfiable
+                self.set_header("Content-Type", "text/plain")
+                self.set_header("Content-Range", f"bytes */{size}")
+                self.finish()
+                return
+            if end - start != size:
+                self.set_status(206)  # Partial Content
+                self.set_header("Content-Range", httputil._get_content_range(start, end, size))
+        self.set_header("Content-Length", end - start)
+
+        try:
+            handle.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = handle.read(min(self.download_chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                await self.flush()
+        except iostream.StreamClosedError:
+            self.log.info(f"Client closed the connection while downloading {handle.name}")
+            return
+        finally:
+            handle.close()
+        self.finish()
+
     def param_decode(self, value):
         unquote(value) if re.search("%20", value) else unquote_plus(value)
         return value
@@ -164,6 +373,36 @@ class BaseHandler(web.RequestHandler):
             return_params.append(value)
         return return_params
 
+    def get_flag(self, param):
+        """A true/false param: true if it's given, unless it's "false", "0", "no", or "off" (any case)"""
+        [value] = self.get_params([param])
+        return value is not None and value.strip().casefold() not in ("false", "0", "no", "off")
+
+    def get_page_params(self):
+        """The `limit` & `cursor` params of a paginated listing, as (limit, cursor, note).
+
+        limit is None when the listing isn't paginated (it's everything, as nbgrader expects.) cursor is the
+        `next_cursor` from the previous page: the id of the last action on it. note says what's wrong with the
+        params, or is None.
+        """
+        [limit, cursor] = self.get_params(["limit", "cursor"])
+        if limit is None:
+            if cursor is not None:
+                return None, None, "cursor needs a limit"
+            return None, None, None
+        if not limit.isdigit() or int(limit) < 1:
+            return None, None, f"limit {limit} is not a positive number"
+        if cursor is not None and not cursor.isdigit():
+            return None, None, f"cursor {cursor} is not a number"
+        return int(limit), int(cursor) if cursor is not None else None, None
+
+    @staticmethod
+    def next_cursor(action_ids, limit):
+        """The cursor for the page after this one (None if this is the last), given the action ids of a page
+        fetched with `limit + 1` - so we know if there's more without another query.
+        """
+        return action_ids[limit - 1] if len(action_ids) > limit else None
+
 
 class Template404(BaseHandler):
     """Render nbexchange's 404 template"""
@@ -1,11 +1,11 @@
 from tornado import web
 
-from nbexchange.database import scoped_session
+from nbexchange.database import read_session, run_in_db_thread, scoped_session
 from nbexchange.handlers.base import BaseHandler, authenticated
 from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.assignment_states import AssignmentState
 from nbexchange.models.assignments import Assignment as AssignmentModel
 from nbexchange.models.courses import Course
-from nbexchange.models.users import User
 
 """
 All URLs relative to /services/nbexchange
@@ -21,6 +21,10 @@ class Collections(BaseHandler):
         course_id: course_code
         assignment_id: assignment_code
         user_id: user_id - optional
+        latest_only: true/false - optional. If true, only each student's latest submission is listed
+            (read from the assignment_state table, one row per student)
+        limit: page size - optional. If provided, only this many submissions are returned, with a "next_cursor"
+        cursor: the "next_cursor" from the previous page - optional
 
     GET: gets list of actions for the assignment
 
@@ -28,7 +32,8 @@ class Collections(BaseHandler):
 
     {'success': True,
      'value': [
-           {'assignment_id': <assignment_code>,
+           {'submission_id': <an id for the submission, for .../collection/>,
+            'assignment_id': <assignment_code>,
             'course_id': <course_code?,
             'full_name': user_id.full_name,
             'email': user_id.email,
@@ -40,17 +45,17 @@ class Collections(BaseHandler):
             'timestamp': <timestamp of action>.strftime("%Y-%m-%d %H:%M:%S.%f %Z")
            },
            {....}, ....
-        ]
+        ],
+     'next_cursor': <the cursor for the next page, or None if this is the last - only if 'limit' is given>
     }
     """
 
     urls = ["collections"]
 
     @authenticated
-    def get(self):
-        models = []
-
+    async def get(self):
         [course_code, assignment_code, user_id] = self.get_params(["course_id", "assignment_id", "user_id"])
+        latest_only = self.get_flag("latest_only")
 
         if not (course_code and assignment_code):
             note = "Collections call requires both a course code and an assignment code"
@@ -58,8 +63,14 @@ class Collections(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
+        limit, cursor, note = self.get_page_params()
+        if note:
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
         # Who is my user?
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
 
         self.log.debug(f"User: {this_user.get('name')}")
         # For what course do we want to see the assignments?
@@ -76,14 +87,23 @@ class Collections(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
+        self.finish(
+            await run_in_db_thread(
+                self.list_submissions, this_user, course_code, assignment_code, user_id, latest_only, limit, cursor
+            )
+        )
+
+    def list_submissions(self, this_user, course_code, assignment_code, user_id, latest_only, limit, cursor):
+        """The database work of `get` (which runs it on a database thread): returns the response"""
+        models = []
+
         # Find the course being referred to
-        with scoped_session() as session:
+        with read_session() as session:
             course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
             if not course:
                 note = f"Course {course_code} does not exist"
                 self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return
+                return {"success": False, "note": note}
 
             assignment = AssignmentModel.find_by_code(
                 db=session,
@@ -96,41 +116,52 @@ class Collections(BaseHandler):
             if not assignment:
                 note = f"Assignment {assignment_code} does not exist"
                 self.log.info(note)
-                self.finish({"success": True, "value": []})
-                return
+                return {"success": True, "value": []}
 
             self.log.debug(f"Assignment: {assignment}")
 
-            filters = [
-                Action.assignment_id == assignment.id,
-                Action.action == AssignmentActions.submitted.value,
-            ]
-
-            if user_id:
-                student = session.query(User).filter(User.name == user_id).first()
-                filters.append(Action.user_id == student.id)
-
-            actions = session.query(Action).filter(*filters)
-
-            for action in actions:
+            # user_id is a user name, which is only unique within the course's org
+            find_args = {
+                "db": session,
+                "assignment_id": assignment.id,
+                "user_name": user_id,
+                "org_id": course.org_id,
+                "after_id": cursor,
+                "limit": limit + 1 if limit else None,
+                "log": self.log,
+            }
+            if latest_only:
+                rows = AssignmentState.find_latest_submissions(**find_args)
+            else:
+                rows = Action.find_all_with_users(action=AssignmentActions.submitted.value, **find_args)
+            if limit:
+                next_cursor = self.next_cursor([row[0] for row in rows], limit)
+                rows = rows[:limit]
+
+            # 'name' in db, 'notebook_id' id nbgrader
+            notebooks = [{"notebook_id": x.name} for x in assignment.notebooks]
+            for submission_id, name, full_name, email, lms_user_id, action, location, checksum, timestamp in rows:
                 models.append(
                     {
-                        "student_id": action.user.name,
-                        "full_name": action.user.full_name,
-                        "email": action.user.email,
-                        "lms_user_id": action.user.lms_user_id,
+                        "submission_id": submission_id,
+                        "student_id": name,
+                        "full_name": full_name,
+                        "email": email,
+                        "lms_user_id": lms_user_id,
                         "assignment_id": assignment.assignment_code,
-                        "course_id": assignment.course.course_code,
-                        "status": action.action.value,  # currently called 'action' in our db
-                        "path": action.location,
-                        # 'name' in db, 'notebook_id' id nbgrader
-                        "notebooks": [{"notebook_id": x.name} for x in assignment.notebooks],
-                        "timestamp": self.check_timezone(action.timestamp).strftime(self.timestamp_format),
+                        "course_id": course.course_code,
+                        "status": action.value,  # currently called 'action' in our db
+                        "path": location,
+                        "checksum": checksum,
+                        "notebooks": notebooks,
+                        "timestamp": self.check_timezone(timestamp).strftime(self.timestamp_format),
                     }
                 )
 
             self.log.debug(f"Assignments: {models}")
-        self.finish({"success": True, "value": models})
+        if limit:
+            return {"success": True, "value": models, "next_cursor": next_cursor}
+        return {"success": True, "value": models}
 
     # This has no authentiction wrapper, so false implication os service
     def post(self):
@@ -143,6 +174,7 @@ class Collection(BaseHandler):
         course_id: course_code
         assignment_id: assignment_code
         path: url_encoded_path
+        submission_id: the `submission_id` from .../collections/ - can be given instead of the path
 
     GET: Downloads the specified file (checking that it's "submitted", for this course/assignment,
     and the user has access to do so)
@@ -151,17 +183,19 @@ class Collection(BaseHandler):
     urls = ["collection"]
 
     @authenticated
-    def get(self):
-        [course_code, assignment_code, path] = self.get_params(["course_id", "assignment_id", "path"])
+    async def get(self):
+        [course_code, assignment_code, path, submission_id] = self.get_params(
+            ["course_id", "assignment_id", "path", "submission_id"]
+        )
 
-        if not (course_code and assignment_code and path):
+        if not (course_code and assignment_code and (path or submission_id)):
             note = "Collection call requires a course code, an assignment code, and a path"
             self.log.info(note)
             self.finish({"success": False, "note": note})
             return
 
         # Who is my user?
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
 
         self.log.debug(f"User: {this_user.get('name')}")
         # For what course do we want to see the assignments?
@@ -180,49 +214,82 @@ class Collection(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
-        # Find the course being referred to
-        with scoped_session() as session:
-            course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
-            if not course:
-                note = f"Course {course_code} does not exist"
-                self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return
-
-            # We need to key off the assignment, but we're actually looking
-            # for the action with a action and a specific path
-            assignments = AssignmentModel.find_for_course(
-                db=session,
-                course_id=course.id,
-                log=self.log,
-                action=AssignmentActions.submitted.value,
-                path=path,
-            )
-
-            self.set_header("Content-Type", "application/gzip")
+        if submission_id and not submission_id.isdigit():
+            note = f"Submission id {submission_id} is not a number"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
 
-            # I do not want to assume there will just be one.
-            for assignment in assignments:
-                self.log.debug(f"Assignment: {assignment}")
-                try:
-                    with open(path, "r+b") as handle:
-                        data = handle.read()
-                except Exception as e:
-                    raise web.HTTPError(500, f"collection handler unable to open '{path}': {e}")
+        note, handle = await run_in_db_thread(
+            self.collect_submission,
+            this_user,
+            course_code,
+            assignment_code,
+            int(submission_id) if submission_id else None,
+            path,
+        )
+        if note:
+            self.finish({"success": False, "note": note})
+            return
 
-                self.log.info(
-                    f"Adding action {AssignmentActions.collected.value} for user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
-                )
-                action = Action(
-                    user_id=this_user["id"],
-                    assignment_id=assignment.id,
-                    action=AssignmentActions.collected,
-                    location=path,
+        self.set_header("Content-Type", "application/gzip")
+        # The action is committed before we start sending, so we don't hold a db connection during the download
+        if handle:
+            await self.stream_file(handle)
+
+    def collect_submission(self, this_user, course_code, assignment_code, submission_id, path):
+        """Open the submission, and record its collection (run on a db thread, see get)
+
+        Returns (note, handle): note says why there's nothing to collect, or is None. The handle is None if
+        there's no such submission
+        """
+        # The file is opened before the collection is recorded (so we don't record one that can't be sent), and
+        # closed again if recording it fails
+        handle = None
+        try:
+            # Find the course being referred to
+            with scoped_session() as session:
+                course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
+                if not course:
+                    note = f"Course {course_code} does not exist"
+                    self.log.info(note)
+                    return note, None
+
+                # The submission (and its assignment) are found by the action's id, or the hash of its path
+                submission = AssignmentModel.find_submission(
+                    db=session,
+                    course_id=course.id,
+                    assignment_code=assignment_code,
+                    submission_id=submission_id,
+                    path=path,
+                    log=self.log,
                 )
-                session.add(action)
 
-                self.finish(data)
-                return
+                if submission:
+                    assignment, submitted = submission
+                    self.log.debug(f"Assignment: {assignment}")
+                    path = submitted.location
+                    try:
+                        handle = open(path, "r+b")
+                    except Exception as e:
+                        raise web.HTTPError(500, f"collection handler unable to open '{path}': {e}")
+
+                    self.log.info(
+                        f"Adding action {AssignmentActions.collected.value} for user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
+                    )
+                    self.record_audit_action(
+                        session,
+                        user_id=this_user["id"],
+                        assignment_id=assignment.id,
+                        action=AssignmentActions.collected,
+                        location=path,
+                        student_id=submitted.user_id,
+                    )
+        except BaseException:
+            if handle:
+                handle.close()
+            raise
+        return None, handle
 
     # This has no authentiction wrapper, so false implication os service
     def post(self):
@@ -0,0 +1,95 @@
+from tornado import web
+
+from nbexchange.database import read_session, run_in_db_thread
+from nbexchange.handlers.base import BaseHandler, authenticated
+from nbexchange.models.assignment_counts import (
+    AssignmentCounts as AssignmentCountsModel,
+)
+from nbexchange.models.courses import Course
+
+"""
+All URLs relative to /services/nbexchange
+
+This relys on users being logged in, and the user-object having additional data:
+'role' (as per LTI)
+"""
+
+
+class AssignmentCounts(BaseHandler):
+    """.../assignment_counts/
+    parmas:
+        course_id: course_code
+        assignment_id: assignment_code - optional. If provided, just that assignment is listed
+
+    GET: the action counts for each of a course's assignments - read from the assignment_counts table,
+    not counted from the actions. Instructors only.
+
+    returns:
+
+    {'success': True,
+     'value': [
+           {'assignment_id': <assignment_code>,
+            'released': Int,
+            'fetched': Int,
+            'submitted': Int,
+            'submitters': Int,  # students with a submission
+            'collected': Int,
+            'feedback_released': Int,
+            'feedback_fetched': Int,
+           },
+           {....}, ....
+        ]
+    }
+    """
+
+    urls = ["assignment_counts"]
+
+    @authenticated
+    async def get(self):
+        [course_code, assignment_code] = self.get_params(["course_id", "assignment_id"])
+
+        if not course_code:
+            note = "Assignment counts call requires a course code"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        this_user = await self.get_nbex_user()
+
+        if course_code not in this_user["courses"]:
+            note = f"User not subscribed to course {course_code}"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+        if not "instructor" == this_user["current_role"].casefold():
+            note = f"User not an instructor to course {course_code}"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        self.finish(await run_in_db_thread(self.list_counts, this_user, course_code, assignment_code))
+
+    def list_counts(self, this_user, course_code, assignment_code):
+        """The database work of `get` (which runs it on a database thread): returns the response"""
+        models = []
+        with read_session() as session:
+            course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
+            if not course:
+                note = f"Course {course_code} does not exist"
+                self.log.info(note)
+                return {"success": False, "note": note}
+
+            for code, counts in AssignmentCountsModel.find_for_course(
+                db=session, course_id=course.id, assignment_code=assignment_code, log=self.log
+            ):
+                model = {"assignment_id": code}
+                if counts is None:
+                    model.update({column: 0 for column in AssignmentCountsModel.columns})
+                else:
+                    model.update(counts.as_dict())
+                models.append(model)
+        return {"success": True, "value": models}
+
+    # This has no authentiction wrapper, so false implication os service
+    def post(self):
+        raise web.HTTPError(501)
@@ -1,13 +1,14 @@
 import base64
+import json
 import os
-import tempfile
 import time
 
 from dateutil import parser
 from tornado import web
 
-from nbexchange.database import scoped_session
+from nbexchange.database import read_session, run_in_db_thread, scoped_session
 from nbexchange.handlers.base import BaseHandler, authenticated
+from nbexchange.handlers.upload import UploadHandler
 from nbexchange.models.actions import Action, AssignmentActions
 from nbexchange.models.assignments import Assignment as AssignmentModel
 from nbexchange.models.courses import Course
@@ -23,7 +24,21 @@ This relys on users being logged in, and the user-object having additional data:
 """
 
 
-class FeedbackHandler(BaseHandler):
+def feedback_location(base_storage_location, org_id, course_code, assignment_code, checksum):
+    """Feedback is stored in $path/feedback/$course_code/$assignment_code/<timestamp>/<checksum>.html"""
+    # This should be abstracted, so it can be overloaded to store in other manners (eg AWS)
+    return os.path.join(
+        base_storage_location,
+        str(org_id),
+        "feedback",
+        course_code,
+        assignment_code,
+        str(int(time.time())),
+        checksum + ".html",
+    )
+
+
+class FeedbackHandler(UploadHandler):
     """.../feedback/
     parmas:
         course_id: course_code
@@ -36,10 +51,29 @@ class FeedbackHandler(BaseHandler):
 
     urls = ["feedback"]
 
+    def max_body_size(self):
+        # Only instructors release feedback - and feedback is an html file, far smaller than an assignment
+        return self.max_feedback_size if self.is_instructor else self.max_unprivileged_size
+
+    def upload_location(self, name, filename):
+        """Where a feedback file is streamed to (see feedback_location)"""
+        [course_code, assignment_code, checksum] = self.get_params(["course_id", "assignment_id", "checksum"])
+        user = self.current_user
+        # Anything else is validated (and rejected) by `post`
+        if not (name == "feedback" and course_code and assignment_code and checksum and user and self.is_instructor):
+            return None
+        location = feedback_location(
+            self.base_storage_location, user.get("org_id", 1), course_code, assignment_code, checksum
+        )
+        return self.storage_location(location, course_code, assignment_code, checksum)
+
     # Fetch feedback
+    # With `manifest`, just the details of each feedback file are listed: the files are then downloaded
+    # individually (see FeedbackFile), rather than all being base64-encoded into this response
     @authenticated
-    def get(self):
+    async def get(self):
         [course_id, assignment_id] = self.get_params(["course_id", "assignment_id"])
+        manifest = self.get_flag("manifest")
 
         if not assignment_id or not course_id:
             note = "Feedback call requires an assignment id and a course id"
@@ -49,9 +83,14 @@ class FeedbackHandler(BaseHandler):
 
         self.log.debug(f"checking for feedback for {assignment_id} on {course_id}")
 
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
 
-        with scoped_session() as session:
+        feedbacks = await run_in_db_thread(self.list_feedback, this_user, course_id, assignment_id, manifest)
+        self.finish({"success": True, "feedback": feedbacks})
+
+    def list_feedback(self, this_user, course_id, assignment_id, manifest):
+        """The user's feedback for the assignment, recording the fetches (run on a db thread, see get)"""
+        with read_session() as session:
             course = Course.find_by_code(db=session, code=course_id, org_id=this_user["org_id"], log=self.log)
             if not course:
                 note = f"Course {course_id} not found"
@@ -71,6 +110,7 @@ class FeedbackHandler(BaseHandler):
                 log=self.log,
             )
             feedbacks = []
+            fetches = []
             for r in res:
                 f = {}
                 notebook = Notebook.find_by_pk(db=session, pk=r.notebook_id, log=self.log)
@@ -78,27 +118,39 @@ class FeedbackHandler(BaseHandler):
                     feedback_name = "{0}.html".format(notebook.name)
                 else:
                     feedback_name = os.path.basename(r.location)
-                with open(r.location, "r+b") as fp:
-                    f["content"] = base64.b64encode(fp.read()).decode("utf-8")
                 f["filename"] = feedback_name
 
                 # This matches self.timestamp_format
                 f["timestamp"] = self.check_timezone(r.timestamp).strftime(self.timestamp_format)
                 f["checksum"] = r.checksum
+
+                if manifest:
+                    # The fetch is recorded when the file is downloaded
+                    f["feedback_id"] = r.id
+                    f["size"] = os.path.getsize(r.location) if os.path.exists(r.location) else None
+                    feedbacks.append(f)
+                    continue
+
+                with open(r.location, "r+b") as fp:
+                    f["content"] = base64.b64encode(fp.read()).decode("utf-8")
                 feedbacks.append(f)
 
-                # Add action
-                self.log.info(
-                    f"Adding action {AssignmentActions.feedback_fetched.value} by user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
+                fetches.append(
+                    dict(
+                        user_id=this_user["id"],
+                        assignment_id=assignment.id,
+                        action=AssignmentActions.feedback_fetched,
+                        location=r.location,
+                    )
                 )
-                action = Action(
-                    user_id=this_user["id"],
-                    assignment_id=assignment.id,
-                    action=AssignmentActions.feedback_fetched,
-                    location=r.location,
+
+            # Add actions - together, so a read_session only needs the one write transaction for them
+            if fetches:
+                self.log.info(
+                    f"Adding {len(fetches)} {AssignmentActions.feedback_fetched.value} actions by user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
                 )
-                session.add(action)
-            self.finish({"success": True, "feedback": feedbacks})
+                self.record_audit_actions(session, fetches)
+        return feedbacks
 
     @authenticated
     def post(self) -> None:
@@ -177,46 +229,19 @@ class FeedbackHandler(BaseHandler):
             if not student:
                 raise web.HTTPError(404, f"Could not find requested resource student {student_id}")
 
+            # The file has already been streamed to $path/feedback/$course_code/$assignment_code/<timestamp>/
+            # (see upload_location)
+            if self.upload_error:
+                self.raise_upload_error("Could not save file. \n ")
+
             # Check whether there is an HTML file attached to the request
-            if not self.request.files:
+            if "feedback" not in self.uploaded_files:
                 raise web.HTTPError(412, "Error: No file supplied in upload")
 
-            try:
-                # Grab the file
-                file_info = self.request.files["feedback"][0]
-                filename, content_type = (
-                    file_info["filename"],
-                    file_info["content_type"],
-                )
-                note = f"Received file {filename}, of type {content_type}"
-                self.log.info(note)
-                fbfile = tempfile.NamedTemporaryFile()
-                fbfile.write(file_info["body"])
-                fbfile.seek(0)
-
-            except Exception as e:
-                # Could not grab the feedback file
-                raise web.HTTPError(412, f"Error: {e}")
-
-            location = os.path.join(
-                self.base_storage_location,
-                str(this_user["org_id"]),
-                "feedback",
-                notebook.assignment.course.course_code,
-                notebook.assignment.assignment_code,
-                str(int(time.time())),
-            )
-
-            # This should be abstracted, so it can be overloaded to store in other manners (eg AWS)
-            feedback_file = location + "/" + checksum + ".html"
-
-            try:
-                # Ensure the directory exists
-                os.makedirs(os.path.dirname(feedback_file), exist_ok=True)
-                with open(feedback_file, "w+b") as handle:
-                    handle.write(file_info["body"])
-            except Exception as e:
-                raise web.HTTPError(500, f"Could not save file. \n {e}")
+            file_info = self.uploaded_files["feedback"][0]
+            note = f"Received file {file_info['filename']}, of type {file_info['content_type']}"
+            self.log.info(note)
+            feedback_file = file_info["path"]
 
             # convert to datetime object & ensure it's got a timezone
             timestamp = self.check_timezone(parser.parse(timestamp))  #
@@ -240,7 +265,245 @@ class FeedbackHandler(BaseHandler):
                 assignment_id=notebook.assignment.id,
                 action=AssignmentActions.feedback_released,
                 location=feedback_file,
+                student_id=student.id,
             )
             session.add(action)
+            self.keep_upload(file_info)
 
         self.finish({"success": True, "note": "Feedback released"})
+
+
+class FeedbackFile(BaseHandler):
+    """.../feedback_file/
+    parmas:
+        feedback_id: the `feedback_id`, from the feedback manifest (GET /feedback?...&manifest=true)
+
+    GET: downloads a single feedback (html) file - streamed, and supporting `Range` requests, as for
+    assignment downloads. Students can only download their own feedback.
+    """
+
+    urls = ["feedback_file"]
+
+    @authenticated
+    async def get(self):
+        [feedback_id] = self.get_params(["feedback_id"])
+
+        try:
+            feedback_id = int(feedback_id)
+        except (TypeError, ValueError):
+            note = "Feedback download requires a feedback id"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        this_user = await self.get_nbex_user()
+
+        handle, etag, notebook_name = await run_in_db_thread(self.fetch_feedback, this_user, feedback_id)
+
+        self.set_header("Content-Type", "text/html")
+        self.set_header("Content-Disposition", f'attachment; filename="{notebook_name}.html"')
+        if self.check_not_modified(etag=etag):
+            handle.close()
+            self.set_status(304)
+            self.finish()
+            return
+
+        await self.stream_file(handle)
+
+    def fetch_feedback(self, this_user, feedback_id):
+        """Open the feedback file, and record the fetch (run on a db thread, see get)
+
+        Returns (handle, etag, notebook name)
+        """
+        handle = None
+        try:
+            with scoped_session() as session:
+                feedback = Feedback.find_by_pk(db=session, pk=feedback_id, log=self.log)
+                # We don't let on whether someone else's feedback exists
+                if feedback is None or feedback.student_id != this_user["id"]:
+                    raise web.HTTPError(404, f"Could not find requested resource feedback {feedback_id}")
+
+                assignment = feedback.notebook.assignment
+                if assignment.course.course_code not in this_user["courses"]:
+                    raise web.HTTPError(404, f"Could not find requested resource feedback {feedback_id}")
+
+                try:
+                    handle = open(feedback.location, "r+b")
+                except Exception as e:
+                    raise web.HTTPError(500, f"feedback get handler unable to open '{feedback.location}': {e}")
+
+                # A piece of feedback is never re-written: new feedback is a new record (& file)
+                stat = os.fstat(handle.fileno())
+                etag = f"{feedback.id}-{stat.st_size}-{stat.st_mtime_ns}"
+                notebook_name = feedback.notebook.name
+
+                self.log.info(
+                    f"Adding action {AssignmentActions.feedback_fetched.value} by user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
+                )
+                self.record_audit_action(
+                    session,
+                    user_id=this_user["id"],
+                    assignment_id=assignment.id,
+                    action=AssignmentActions.feedback_fetched,
+                    location=feedback.location,
+                )
+        except BaseException:
+            if handle:
+                handle.close()
+            raise
+        return handle, etag, notebook_name
+
+
+class FeedbackBatch(UploadHandler):
+    """.../feedback_batch/
+    parmas:
+        course_id: course_code
+        assignment_id: assignment_code
+
+    POST: (role=instructor): releases many pieces of feedback, for the whole class, in one request.
+        The body is multipart/form-data, with
+            manifest: a json list of {"notebook": .., "student": .., "timestamp": .., "checksum": ..}
+                (the same details as POST /feedback takes, for each piece of feedback)
+            and the html file for each entry, in a field named after its checksum
+
+    Either all the feedback is released, or (if any entry is wrong) none of it is.
+    returns
+        {"success": True, "note": "Feedback released", "count": <number released>}
+    """
+
+    urls = ["feedback_batch"]
+
+    # The manifest has an entry for every piece of feedback in the batch
+    max_field_size = 4 * 1024 * 1024
+
+    def max_body_size(self):
+        # A batch is many pieces of feedback, so is allowed to be as big as a release
+        return self.max_release_size if self.is_instructor else self.max_unprivileged_size
+
+    def upload_location(self, name, filename):
+        """Each file is stored where POST /feedback would put it (see feedback_location)"""
+        [course_code, assignment_code] = self.get_params(["course_id", "assignment_id"])
+        user = self.current_user
+        # The field name is the checksum, which becomes the filename
+        if not (course_code and assignment_code and user and self.is_instructor):
+            return None
+        location = feedback_location(
+            self.base_storage_location, user.get("org_id", 1), course_code, assignment_code, name
+        )
+        return self.storage_location(location, course_code, assignment_code, name)
+
+    @authenticated
+    def post(self):
+        [course_id, assignment_id, manifest] = self.get_params(["course_id", "assignment_id", "manifest"])
+
+        if not (course_id and assignment_id and manifest):
+            note = "Feedback batch call requires a course id, an assignment id, and a manifest."
+            self.log.debug(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        try:
+            entries = json.loads(manifest)
+            if not isinstance(entries, list) or not all(
+                isinstance(entry, dict) and {"notebook", "student", "timestamp", "checksum"} <= set(entry)
+                for entry in entries
+            ):
+                raise ValueError("each entry needs a notebook, student, timestamp and checksum")
+        except ValueError as e:
+            note = f"Feedback batch manifest is not valid: {e}"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        this_user = self.nbex_user
+
+        if course_id not in this_user["courses"]:
+            note = f"User not subscribed to course {course_id}"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        if "instructor" != this_user["current_role"].casefold():
+            note = f"User not an instructor to course {course_id}"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        if self.upload_error:
+            self.raise_upload_error("Could not save file. \n ")
+
+        with scoped_session() as session:
+            course = Course.find_by_code(db=session, code=course_id, org_id=this_user["org_id"], log=self.log)
+            if not course:
+                raise web.HTTPError(404, f"Could not find requested resource course {course_id}")
+
+            assignment = AssignmentModel.find_by_code(
+                db=session,
+                code=assignment_id,
+                course_id=course.id,
+                action=AssignmentActions.released.value,
+            )
+            if not assignment:
+                raise web.HTTPError(404, f"Could not find requested resource assignment {assignment_id}")
+
+            # Everything the batch refers to is found in a couple of queries, not a few per entry
+            notebooks = {}
+            for notebook in Notebook.find_all_by_names(
+                db=session,
+                names={entry["notebook"] for entry in entries},
+                assignment_id=assignment.id,
+                log=self.log,
+            ):
+                notebooks.setdefault(notebook.name, notebook)
+            students = {
+                student.name: student
+                for student in User.find_all_by_names(
+                    db=session, names={entry["student"] for entry in entries}, log=self.log
+                )
+            }
+
+            problems = []
+            for entry in entries:
+                if entry["notebook"] not in notebooks:
+                    problems.append(f"notebook {entry['notebook']} not found")
+                if entry["student"] not in students:
+                    problems.append(f"student {entry['student']} not found")
+                if entry["checksum"] not in self.uploaded_files:
+                    problems.append(f"no file supplied for {entry['checksum']}")
+                try:
+                    entry["timestamp"] = self.check_timezone(parser.parse(entry["timestamp"]))
+                except (TypeError, ValueError, OverflowError):
+                    problems.append(f"timestamp {entry['timestamp']} not valid")
+            if problems:
+                note = f"Feedback batch rejected: {'; '.join(sorted(set(problems)))}"
+                self.log.info(note)
+                self.finish({"success": False, "note": note})
+                return
+
+            self.log.info(
+                f"Adding {len(entries)} pieces of feedback, and {AssignmentActions.feedback_released.value} actions, by user {this_user['id']} against assignment {assignment.id}"  # noqa: E501
+            )
+            for entry in entries:
+                file_info = self.uploaded_files[entry["checksum"]][0]
+                session.add(
+                    Feedback(
+                        notebook_id=notebooks[entry["notebook"]].id,
+                        checksum=entry["checksum"],
+                        location=file_info["path"],
+                        student_id=students[entry["student"]].id,
+                        instructor_id=this_user.get("id"),
+                        timestamp=entry["timestamp"],
+                    )
+                )
+                session.add(
+                    Action(
+                        user_id=this_user["id"],
+                        assignment_id=assignment.id,
+                        action=AssignmentActions.feedback_released,
+                        location=file_info["path"],
+                        student_id=students[entry["student"]].id,
+                    )
+                )
+                self.keep_upload(file_info)
+
+        self.finish({"success": True, "note": "Feedback released", "count": len(entries)})
@@ -2,10 +2,11 @@
 # import time
 # import uuid
 
+from sqlalchemy.orm import joinedload
 from tornado import web
 
 import nbexchange.models.subscriptions
-from nbexchange.database import scoped_session
+from nbexchange.database import read_session, run_in_db_thread
 from nbexchange.handlers.base import BaseHandler, authenticated
 from nbexchange.models.actions import AssignmentActions
 
@@ -23,6 +24,13 @@ class History(BaseHandler):
         action: action string - optional. If provided, only returns actions of this type.
         course_id: course code string - optional
         course_code: course code string - optional. Depreciated.
+        summary_only: true/false - optional. If true, only the "action_summary" for each assignment is
+            returned (there's no "actions" list), and the counts are made in the database.
+        limit: page size - optional. If provided, only this many actions are returned (across all the courses),
+            with a "next_cursor". A page only lists the assignments with actions on it. Not used with summary_only.
+        cursor: the "next_cursor" from the previous page - optional
+        include_archived: true/false - optional. If true, the archived actions (see
+            nbexchange.models.action_archive), and the deleted assignments they're for, are included too.
 
     "action string" must be one of the values in nbexchange.models.actions.AssignmentActions
 
@@ -82,11 +90,10 @@ class History(BaseHandler):
 
     # want to add in stuff so "customer-admin" users see all courses for their org.
     @authenticated
-    def get(self):
-
-        models = {}
-
+    async def get(self):
         [action_param, course_id_param, course_code_param] = self.get_params(["action", "course_id", "course_code"])
+        summary_only = self.get_flag("summary_only")
+        include_archived = self.get_flag("include_archived")
         self.log.info("History called")
         if course_code_param:
             self.log.info(
@@ -102,13 +109,42 @@ class History(BaseHandler):
             self.finish({"success": False, "note": note, "value": []})
             return
 
+        limit, cursor, note = self.get_page_params()
+        if note:
+            self.log.info(note)
+            self.finish({"success": False, "note": note, "value": []})
+            return
+        if summary_only:
+            limit = cursor = None
+
         # Who is my user?
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
         self.log.debug(f"History authenticated User: {this_user.get('name')}")
 
+        self.finish(
+            await run_in_db_thread(
+                self.list_history,
+                this_user,
+                course_id_param,
+                action_param,
+                summary_only,
+                include_archived,
+                limit,
+                cursor,
+            )
+        )
+
+    def list_history(self, this_user, course_id_param, action_param, summary_only, include_archived, limit, cursor):
+        """The database work of `get` (which runs it on a database thread): returns the response"""
+        models = {}
+
         # Find all the course_codes this user should be able to see
-        with scoped_session() as session:
-            subscriptions_query = session.query(nbexchange.models.Subscription).filter_by(user_id=this_user["id"])
+        with read_session() as session:
+            subscriptions_query = (
+                session.query(nbexchange.models.Subscription)
+                .options(joinedload(nbexchange.models.Subscription.course))
+                .filter_by(user_id=this_user["id"])
+            )
             if course_id_param:
                 subscriptions_query = subscriptions_query.filter(
                     nbexchange.models.Subscription.course.has(course_code=course_id_param)
@@ -135,60 +171,83 @@ class History(BaseHandler):
                 if subscription.role == "Instructor":
                     models[subscription.course.id]["isInstructor"] = True
                 self.log.debug(
-                    (
-                        f"       ... course: {models[subscription.course.id]['course_id']} | ",
-                        f"{models[subscription.course.id]['course_code']}",
-                    )
+                    f"       ... course: {models[subscription.course.id]['course_id']} | "
+                    f"{models[subscription.course.id]['course_code']}"
                 )
 
-                temp_dict = dict()
-                for assignment in subscription.course.assignments:
-                    self.log.debug(f"           ... assignment: {assignment}")
-
-                    if assignment.active:
-                        if assignment.id not in temp_dict:
-                            temp_dict[assignment.id] = {
-                                "assignment_id": assignment.id,
-                                "assignment_code": assignment.assignment_code,
-                                "actions": list(),
-                                "action_summary": dict(),
-                            }
-
-                            for action in assignment.actions:
-                                # You see releases, your own actions, or anything if you're an isntructor
-                                if (
-                                    action.action == AssignmentActions.released
-                                    or action.user_id == this_user["id"]  # noqa: W503
-                                    or models[subscription.course.id]["isInstructor"] is True  # noqa: W503
-                                ):
-                                    this_action = dict()
-                                    action_string = str(action.action).replace("AssignmentActions.", "")
-                                    if action_param and action_string != action_param:
-                                        self.log.debug(
-                                            (
-                                                f"History: ignoring action {action_string} because it ",
-                                                f"isn't of type {action_param}",
-                                            )
-                                        )
-                                        continue
-                                    if action_string not in temp_dict[assignment.id]["action_summary"]:
-                                        temp_dict[assignment.id]["action_summary"][action_string] = 0
-                                    temp_dict[assignment.id]["action_summary"][action_string] += 1
-                                    this_action["action"] = str(action.action)
-                                    self.log.debug(f"action: {action}")
-                                    this_action["timestamp"] = self.check_timezone(action.timestamp).strftime(
-                                        self.timestamp_format
-                                    )
-                                    # Adding path info to action as we want it for the buttons in the history view
-                                    this_action["path"] = action.location
-
-                                    # I thought about this - and actually, there is merit in students knowing
-                                    # _which_ instructor released an assignment when
-                                    user = nbexchange.models.users.User.find_by_pk(db=session, pk=action.user_id)
-                                    this_action["user"] = user.name
-                                    temp_dict[assignment.id]["actions"].append(this_action)
-                    models[subscription.course.id]["assignments"] = list(temp_dict.values())
-        self.finish({"success": True, "value": sorted(models.values(), key=lambda x: (x["course_id"]))})
+            # One query per course. You see releases, your own actions, or anything if you're an instructor
+            rows_by_course = {}
+            for course_id, model in models.items():
+                history_args = {
+                    "db": session,
+                    "course_id": course_id,
+                    "user_id": None if model["isInstructor"] else this_user["id"],
+                    "action": AssignmentActions[action_param] if action_param else None,
+                    "archived": include_archived,
+                    "log": self.log,
+                }
+                if summary_only:
+                    model["assignments"] = self.summarise_history(
+                        nbexchange.models.Assignment.find_history_summary_for_course(**history_args)
+                    )
+                    continue
+                if limit:
+                    history_args.update({"after_id": cursor, "limit": limit + 1})
+                rows_by_course[course_id] = nbexchange.models.Assignment.find_history_for_course(**history_args)
+
+            if limit:
+                # A page is the first `limit` actions after the cursor, whichever courses they're in
+                action_ids = sorted(row[-1] for rows in rows_by_course.values() for row in rows)
+                next_cursor = self.next_cursor(action_ids, limit)
+                if next_cursor is not None:
+                    for course_id, rows in rows_by_course.items():
+                        rows_by_course[course_id] = [row for row in rows if row[-1] <= next_cursor]
+
+            for course_id, rows in rows_by_course.items():
+                model = models[course_id]
+                assignments = dict()
+                for assignment_id, assignment_code, action, timestamp, location, user_name, _ in rows:
+                    if assignment_id not in assignments:
+                        assignments[assignment_id] = {
+                            "assignment_id": assignment_id,
+                            "assignment_code": assignment_code,
+                            "actions": list(),
+                            "action_summary": dict(),
+                        }
+                    if action is None:
+                        continue
+                    action_summary = assignments[assignment_id]["action_summary"]
+                    action_summary[action.name] = action_summary.get(action.name, 0) + 1
+                    assignments[assignment_id]["actions"].append(
+                        {
+                            "action": str(action),
+                            "timestamp": self.check_timezone(timestamp).strftime(self.timestamp_format),
+                            # Adding path info to action as we want it for the buttons in the history view
+                            "path": location,
+                            # I thought about this - and actually, there is merit in students knowing
+                            # _which_ instructor released an assignment when
+                            "user": user_name,
+                        }
+                    )
+                model["assignments"] = list(assignments.values())
+        value = sorted(models.values(), key=lambda x: (x["course_id"]))
+        if limit:
+            return {"success": True, "value": value, "next_cursor": next_cursor}
+        return {"success": True, "value": value}
+
+    def summarise_history(self, rows):
+        """Turn (assignment_id, assignment_code, action, count) rows into the assignments list, sans actions"""
+        assignments = dict()
+        for assignment_id, assignment_code, action, count in rows:
+            if assignment_id not in assignments:
+                assignments[assignment_id] = {
+                    "assignment_id": assignment_id,
+                    "assignment_code": assignment_code,
+                    "action_summary": dict(),
+                }
+            if action is not None:
+                assignments[assignment_id]["action_summary"][action.name] = count
+        return list(assignments.values())
 
     # This has no authentiction wrapper, so false implication os service
     def post(self):
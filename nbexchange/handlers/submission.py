@@ -4,8 +4,9 @@ import uuid
 from dateutil import parser
 from tornado import web
 
-from nbexchange.database import scoped_session
+from nbexchange.database import run_in_db_thread, scoped_session
 from nbexchange.handlers.base import BaseHandler, authenticated
+from nbexchange.handlers.upload import UploadHandler
 from nbexchange.models.actions import Action, AssignmentActions
 from nbexchange.models.assignments import Assignment
 from nbexchange.models.courses import Course
@@ -18,7 +19,25 @@ This relys on users being logged in, and the user-object having additional data:
 """
 
 
-class Submission(BaseHandler):
+def submission_location(base_storage_location, org_id, course_code, assignment_code, username, timestamp, filename):
+    """Submissions are stored in $path/submitted/$course_code/$assignment_code/$username/<timestamp>/<uuid>.<extn>
+
+    Note - this means that a user can submit multiple times, and we have all copies
+    """
+    # This should be abstracted, so it can be overloaded to store in other manners (eg AWS)
+    return os.path.join(
+        base_storage_location,
+        str(org_id),
+        AssignmentActions.submitted.value,
+        course_code,
+        assignment_code,
+        username,
+        str(int(timestamp.timestamp())),  # this is a daterime rendition (eg '1738054326')
+        str(uuid.uuid4()) + os.path.splitext(filename)[1],
+    )
+
+
+class Submission(UploadHandler):
     """.../submisssion/
     parmas:
         course_id: course_code [eg 'cool course']
@@ -33,21 +52,45 @@ class Submission(BaseHandler):
     def get(self):
         raise web.HTTPError(501)
 
+    def max_body_size(self):
+        return self.max_submission_size
+
+    def prepare(self):
+        # The submission's timestamp is fixed before any of the file arrives: the path it's streamed to
+        # (see upload_location) and the action (see post) must both have the same one
+        [timestamp] = self.get_params(["timestamp"])
+        self.timestamp_given = bool(timestamp)
+        self.submission_timestamp = timestamp or self.get_timestamp()
+        super().prepare()
+
+    def upload_location(self, name, filename):
+        """Where a submission is streamed to (see submission_location)"""
+        [course_code, assignment_code] = self.get_params(["course_id", "assignment_id"])
+        user = self.current_user
+        if not (name == "assignment" and course_code and assignment_code and user):
+            return None
+        timestamp = self.check_timezone(parser.parse(self.submission_timestamp))
+        location = submission_location(
+            self.base_storage_location,
+            user.get("org_id", 1),
+            course_code,
+            assignment_code,
+            user["name"],
+            timestamp,
+            filename,
+        )
+        return self.storage_location(location, course_code, assignment_code)
+
     # This is a student submitting an assignment, not an instructor "release"
+    # The body is streamed to disk as it arrives (see UploadHandler), so is never held in memory.
     @authenticated
-    def post(self):
-        # if "Content-Length" in self.request.headers and int(self.request.headers["Content-Length"]) > int(
-        #     self.max_buffer_size
-        # ):
-        #     note = "File upload oversize, and rejected. Please reduce the files in your submission and try again."
-        #     self.log.info(note)
-        #     self.finish({"success": False, "note": note})
-        #     return
-
-        [course_code, assignment_code, timestamp] = self.get_params(["course_id", "assignment_id", "timestamp"])
+    async def post(self):
+        # Oversized content is rejected (with a 413) before the body is read, and never gets here (see max_body_size)
+        [course_code, assignment_code] = self.get_params(["course_id", "assignment_id"])
+        timestamp = self.submission_timestamp
         self.log.debug(
-            f"Called POST /submission with arguments: course {course_code} and ",
-            f"assignment {assignment_code}, giving a timestamp of {timestamp}",
+            f"Called POST /submission with arguments: course {course_code} and "
+            f"assignment {assignment_code}, giving a timestamp of {timestamp}"
         )
         if not (course_code and assignment_code):
             note = "Submission call requires a course code and an assignment code"
@@ -56,12 +99,11 @@ class Submission(BaseHandler):
             return
 
         # If this happens, then any feedback isn't going to sync with this submission
-        if not timestamp:
-            timestamp = self.get_timestamp()
+        if not self.timestamp_given:
             note = f"Submission was posted without a timestamp. We've set it to {timestamp}, but feedback will not sync to this."  # noqa: E501
             self.log.info(note)
 
-        this_user = self.nbex_user
+        this_user = await self.get_nbex_user()
 
         if course_code not in this_user["courses"]:
             note = f"User not subscribed to course {course_code}"
@@ -69,8 +111,21 @@ class Submission(BaseHandler):
             self.finish({"success": False, "note": note})
             return
 
+        note, file_info = await run_in_db_thread(self.record_submission, this_user, course_code, assignment_code)
+        if note:
+            self.finish({"success": False, "note": note})
+            return
+        self.keep_upload(file_info)
+
+        self.finish({"success": True, "note": "Submitted"})
+
+    def record_submission(self, this_user, course_code, assignment_code):
+        """Check the uploaded submission, and record it (run on a db thread, see post)
+
+        Returns (note, file_info): note says why the submission was rejected, or is None
+        """
         # The course will exist: the user object creates it if it doesn't exist
-        #  - and we know the user is subscribed to the course as an instructor (above)
+        #  - and we know the user is subscribed to the course (see post)
         with scoped_session() as session:
             course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
 
@@ -79,52 +134,23 @@ class Submission(BaseHandler):
             if assignment is None:
                 note = f"User not fetched assignment {assignment_code}"
                 self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return
+                return note, None
 
             # validate timestamp: convert to datetime object & ensure it's got a timezone
-            timestamp = self.check_timezone(parser.parse(timestamp))
-
-            # storage is dynamically in $path/submitted/$course_code/$assignment_code/$username/<timestamp>/
-            # Note - this means that a user can submit multiple times, and we have all copies
-            release_file = os.path.join(
-                self.base_storage_location,
-                str(this_user["org_id"]),
-                AssignmentActions.submitted.value,
-                course_code,
-                assignment_code,
-                this_user["name"],
-                str(int(timestamp.timestamp())),  # this is a daterime rendition (eg '1738054326')
-            )
-
-            if not self.request.files:
-                raise web.HTTPError(412, "submission handler post: No file supplied in upload")  # precondition failed
-
-            try:
-                # Write the uploaded file to the desired location
-                file_info = self.request.files["assignment"][0]
+            timestamp = self.check_timezone(parser.parse(self.submission_timestamp))
 
-                filename, content_type = (
-                    file_info["filename"],
-                    file_info["content_type"],
-                )
-                note = f"Received file {filename}, of type {content_type}"
-                self.log.info(note)
-                extn = os.path.splitext(filename)[1]
-                cname = str(uuid.uuid4()) + extn
+            # The file has already been streamed to
+            # $path/submitted/$course_code/$assignment_code/$username/<timestamp>/ (see upload_location)
+            if self.upload_error:
+                self.raise_upload_error("submission handler Upload failed: ")
 
-                # store to disk.
-                # This should be abstracted, so it can be overloaded to store in other manners (eg AWS)
-                release_file = release_file + "/" + cname
-                # Ensure the directory exists
-                os.makedirs(os.path.dirname(release_file), exist_ok=True)
-
-                # Hmmm this seems to raise it's own 500: No such file or directory if not present
-                with open(release_file, "w+b") as handle:
-                    handle.write(file_info["body"])
+            if "assignment" not in self.uploaded_files:
+                raise web.HTTPError(412, "submission handler post: No file supplied in upload")  # precondition failed
 
-            except Exception as e:  # TODO: exception handling
-                raise web.HTTPError(500, f"submission handler Upload failed: {e}")
+            file_info = self.uploaded_files["assignment"][0]
+            note = f"Received file {file_info['filename']}, of type {file_info['content_type']}"
+            self.log.info(note)
+            release_file = file_info["path"]
 
             # Check the file exists on disk
             if not (
@@ -132,16 +158,14 @@ class Submission(BaseHandler):
             ):
                 note = "File upload failed."
                 self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return
+                return note, None
 
             # We shouldn't need this, but it's good to double-check
-            if os.path.getsize(release_file) > self.max_buffer_size:
+            if os.path.getsize(release_file) > self.max_submission_size:
                 os.remove(release_file)
                 note = "File upload oversize, and rejected. Please reduce the files in your submission and try again."
                 self.log.info(note)
-                self.finish({"success": False, "note": note})
-                return
+                return note, None
 
             # now commit the assignment, and get it back to find the id
             assignment = Assignment.find_by_code(db=session, code=assignment_code, course_id=course.id)
@@ -158,11 +182,11 @@ class Submission(BaseHandler):
                 assignment_id=assignment.id,
                 action=AssignmentActions.submitted,
                 location=release_file,
+                checksum=file_info["checksum"],
                 timestamp=timestamp,
             )
             session.add(action)
-
-        self.finish({"success": True, "note": "Submitted"})
+        return None, file_info
 
 
 class Submissions(BaseHandler):
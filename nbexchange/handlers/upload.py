@@ -0,0 +1,293 @@
+import hashlib
+import os
+
+from tornado import httputil, web
+
+from nbexchange.handlers.base import BaseHandler
+
+"""
+Streaming (multipart/form-data) uploads.
+
+Tornado normally buffers the whole request body in memory before a handler gets to see it. For
+the upload handlers (releases & submissions) this means every in-flight upload costs its full size
+in RAM. Handlers that sub-class UploadHandler get the body fed to them in chunks, and any file parts
+are written straight to their final storage location as they arrive.
+
+Each file's checksum (sha256) is computed as it's written, so nothing needs to read the file back.
+"""
+
+
+def file_checksum(path, chunk_size=64 * 1024):
+    """The checksum of a file already on disk - the same one the upload parser computes as it writes"""
+    checksum = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class MultipartStreamParser:
+    """An incremental multipart/form-data parser.
+
+    Chunks of the body are passed to `data_received` as they arrive. File parts are written straight
+    to the path returned by `upload_location(name, filename)` (or discarded, if that returns None), so
+    we only ever hold a chunk (plus a delimiter's worth of look-behind) in memory.
+    Ordinary form fields are small, and are collected in `arguments`.
+
+    parser = MultipartStreamParser(boundary, upload_location=self.upload_location)
+    parser.data_received(chunk)
+    ...
+    parser.files  # {"assignment": [{"filename": .., "content_type": .., "path": .., "size": .., "checksum": ..}]}
+    """
+
+    # Limits on the bits we _do_ hold in memory
+    max_header_size = 16 * 1024
+    max_field_size = 64 * 1024
+
+    PREAMBLE, DELIMITER, HEADERS, BODY, EPILOGUE = range(5)
+
+    def __init__(self, boundary, upload_location):
+        self.upload_location = upload_location
+        self.files = {}
+        self.arguments = {}
+
+        self._first_delimiter = b"--" + boundary
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = b""
+        self._state = self.PREAMBLE
+        self._part = None
+        self._handle = None
+        self._checksum = None
+        self._value = None
+
+    @property
+    def complete(self):
+        return self._state == self.EPILOGUE
+
+    def data_received(self, chunk):
+        self._buffer += chunk
+        while self._parse():
+            pass
+
+    def _parse(self):
+        """Consume as much of the buffer as we can. Returns True if the state changed"""
+        if self._state == self.PREAMBLE:
+            idx = self._buffer.find(self._first_delimiter)
+            if idx == -1:
+                self._buffer = self._buffer[-(len(self._first_delimiter) - 1) :]
+                return False
+            self._buffer = self._buffer[idx + len(self._first_delimiter) :]
+            self._state = self.DELIMITER
+            return True
+
+        if self._state == self.DELIMITER:
+            if len(self._buffer) < 2:
+                return False
+            if self._buffer[:2] == b"--":
+                self._buffer = b""
+                self._state = self.EPILOGUE
+                return False
+            if self._buffer[:2] != b"\r\n":
+                raise web.HTTPError(400, "Invalid multipart/form-data: malformed boundary")
+            self._buffer = self._buffer[2:]
+            self._state = self.HEADERS
+            return True
+
+        if self._state == self.HEADERS:
+            idx = self._buffer.find(b"\r\n\r\n")
+            if idx == -1:
+                if len(self._buffer) > self.max_header_size:
+                    raise web.HTTPError(400, "Invalid multipart/form-data: part headers too large")
+                return False
+            self._start_part(self._buffer[:idx].decode("utf-8"))
+            self._buffer = self._buffer[idx + 4 :]
+            self._state = self.BODY
+            return True
+
+        if self._state == self.BODY:
+            idx = self._buffer.find(self._delimiter)
+            if idx == -1:
+                # Hold back enough to match a delimiter that's split across two chunks
+                keep = len(self._delimiter) - 1
+                if len(self._buffer) > keep:
+                    self._write(self._buffer[:-keep])
+                    self._buffer = self._buffer[-keep:]
+                return False
+            self._write(self._buffer[:idx])
+            self._end_part()
+            self._buffer = self._buffer[idx + len(self._delimiter) :]
+            self._state = self.DELIMITER
+            return True
+
+        # EPILOGUE: anything after the closing delimiter is ignored
+        self._buffer = b""
+        return False
+
+    def _start_part(self, header_text):
+        headers = httputil.HTTPHeaders.parse(header_text)
+        disposition, params = httputil._parse_header(headers.get("Content-Disposition", ""))
+        if disposition != "form-data" or not params.get("name"):
+            raise web.HTTPError(400, "Invalid multipart/form-data: missing Content-Disposition name")
+        name = params["name"]
+
+        if "filename" not in params:
+            self._part = {"name": name}
+            self._value = bytearray()
+            return
+
+        self._part = {
+            "name": name,
+            "filename": params["filename"],
+            "content_type": headers.get("Content-Type", "application/unknown"),
+            "path": self.upload_location(name, params["filename"]),
+            "size": 0,
+        }
+        if self._part["path"]:
+            os.makedirs(os.path.dirname(self._part["path"]), exist_ok=True)
+            self._handle = open(self._part["path"], "w+b")
+            self._checksum = hashlib.sha256()
+
+    def _write(self, data):
+        if not data:
+            return
+        if self._value is not None:
+            if len(self._value) + len(data) > self.max_field_size:
+                raise web.HTTPError(400, f"Form field {self._part['name']} is too large")
+            self._value += data
+            return
+        self._part["size"] += len(data)
+        if self._handle:
+            self._handle.write(data)
+            self._checksum.update(data)
+
+    def _end_part(self):
+        part, self._part = self._part, None
+        if self._value is not None:
+            self.arguments.setdefault(part["name"], []).append(bytes(self._value))
+            self._value = None
+            return
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+            part["checksum"] = self._checksum.hexdigest()
+            self._checksum = None
+        # Discarded parts are not reported
+        if part["path"]:
+            self.files.setdefault(part.pop("name"), []).append(part)
+
+    def abort(self):
+        """Stop parsing, and remove any partially written file"""
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+            if os.path.exists(self._part["path"]):
+                os.remove(self._part["path"])
+        self._part = None
+        self._state = self.EPILOGUE
+
+
+@web.stream_request_body
+class UploadHandler(BaseHandler):
+    """A handler that accepts file uploads without buffering them in memory.
+
+    Sub-classes define `upload_location(name, filename)`, which returns the path a file part should
+    be written to (or None to discard it.) By the time `post` is called, the files are already on disk:
+
+        self.uploaded_files = {
+            "assignment": [{"filename": .., "content_type": .., "path": .., "size": .., "checksum": <sha256>}]
+        }
+        self.upload_error = None, or the Exception that stopped the upload (see raise_upload_error)
+
+    Any uploaded file the handler doesn't explicitly `keep_upload` is deleted once the request finishes,
+    so validation failures don't leave orphaned files in the exchange.
+
+    Sub-classes also define `max_body_size()`, the largest body the route accepts for the current user.
+    Anything bigger gets a 413 before any of the body is read.
+    """
+
+    # The largest (non-file) form field the route accepts - these are held in memory
+    max_field_size = MultipartStreamParser.max_field_size
+
+    def prepare(self):
+        self.uploaded_files = {}
+        self.upload_error = None
+        self._kept_uploads = set()
+        self._parser = None
+
+        max_body_size = self.max_body_size()
+        try:
+            content_length = int(self.request.headers.get("Content-Length", 0))
+        except ValueError:
+            raise web.HTTPError(400, "Invalid Content-Length header")
+        if content_length > max_body_size:
+            self.log.info(f"Upload of {content_length} bytes to {self.request.path} rejected: limit is {max_body_size}")
+            raise web.HTTPError(413, f"Upload oversize: the limit is {max_body_size} bytes")
+        # Stops a body without a (truthful) Content-Length, eg a chunked one, part-way through
+        self.request.connection.set_max_body_size(max_body_size)
+
+        content_type = self.request.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            # Same boundary handling as tornado.httputil.parse_body_arguments
+            for field in content_type.split(";"):
+                k, sep, v = field.strip().partition("=")
+                if k == "boundary" and v:
+                    if v.startswith('"') and v.endswith('"'):
+                        v = v[1:-1]
+                    self._parser = MultipartStreamParser(v.encode("latin1"), self.upload_location)
+                    self._parser.max_field_size = self.max_field_size
+                    break
+
+    def max_body_size(self):
+        """The largest request body, in bytes, this route accepts from the current user"""
+        return self.max_buffer_size
+
+    def upload_location(self, name, filename):
+        """Where to write the uploaded file `filename`, from form field `name`. None discards the file"""
+        return None
+
+    def data_received(self, chunk):
+        # Errors raised here would just drop the connection, so we record them for the handler to report
+        if self._parser is None or self.upload_error:
+            return
+        try:
+            self._parser.data_received(chunk)
+        except Exception as e:
+            self.log.info(f"Upload failed: {e}")
+            self.upload_error = e
+            self._parser.abort()
+            return
+        # Keep the same view of the data as tornado would give us for a buffered body
+        self.uploaded_files = self._parser.files
+        if self._parser.complete:
+            for name, values in self._parser.arguments.items():
+                self.request.body_arguments.setdefault(name, []).extend(values)
+                self.request.arguments.setdefault(name, []).extend(values)
+
+    def raise_upload_error(self, message):
+        """Report the upload_error: as it is, if it's already an HTTP error (eg a malformed body's 400), or
+        as a 500 - the upload couldn't be written - with `message`
+        """
+        if isinstance(self.upload_error, web.HTTPError):
+            raise self.upload_error
+        raise web.HTTPError(500, f"{message}{self.upload_error}")
+
+    def keep_upload(self, file_info):
+        """Mark an uploaded file as being kept, once it's been recorded"""
+        self._kept_uploads.add(file_info["path"])
+
+    def _remove_unkept_uploads(self):
+        if getattr(self, "_parser", None) is not None:
+            self._parser.abort()
+        kept = getattr(self, "_kept_uploads", set())
+        for file_infos in getattr(self, "uploaded_files", {}).values():
+            for file_info in file_infos:
+                if file_info["path"] not in kept and os.path.exists(file_info["path"]):
+                    self.log.debug(f"Removing unused upload {file_info['path']}")
+                    os.remove(file_info["path"])
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self._remove_unkept_uploads()
+
+    def on_finish(self):
+        self._remove_unkept_uploads()
@@ -0,0 +1,388 @@
+import json
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+from tornado import web
+
+from nbexchange.database import scoped_session
+from nbexchange.handlers.assignment import record_release, release_location
+from nbexchange.handlers.base import BaseHandler, authenticated
+from nbexchange.handlers.submission import submission_location
+from nbexchange.handlers.upload import file_checksum
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.assignments import Assignment as AssignmentModel
+from nbexchange.models.courses import Course
+from nbexchange.models.upload_sessions import UploadSession as UploadSessionModel
+
+"""
+All URLs relative to /services/nbexchange
+
+This relys on users being logged in, and the user-object having additional data:
+'role' (as per LTI)
+
+Resumable uploads: rather than POSTing the whole file to /assignment or /submission in one go, a
+client can create an upload session, PUT the file in chunks, and then finalize the session. If the
+connection drops, the client asks the session how much it has, and only sends the rest.
+"""
+
+
+def remove_upload_session(session, upload_session, log):
+    """Delete an upload session, and the partial file it was writing"""
+    log.info(f"Removing {upload_session}")
+    if upload_session.location and os.path.exists(upload_session.location):
+        os.remove(upload_session.location)
+    session.delete(upload_session)
+
+
+def max_upload_size(handler, action):
+    """The largest file the handler's user may upload to a session for `action` - the same limits as
+    POST /assignment and /submission (see UploadHandler.max_body_size)"""
+    if action == AssignmentActions.released.value:
+        return handler.max_release_size if handler.is_instructor else handler.max_unprivileged_size
+    return handler.max_submission_size
+
+
+def remove_expired_upload_sessions(max_age, log):
+    """Garbage-collect the upload sessions that haven't been touched for `max_age` seconds"""
+    with scoped_session() as session:
+        for upload_session in UploadSessionModel.find_expired(db=session, max_age=max_age, log=log):
+            remove_upload_session(session, upload_session, log)
+
+
+class UploadSessions(BaseHandler):
+    """.../upload_sessions/
+    parmas:
+        course_id: course_code
+        assignment_id: assignment_code
+        kind: 'assignment' (a release) or 'submission'
+        timestamp: The timestamp in timestamp.txt (submissions only) [eg '2020-01-01 00:00:00.0 UTC']
+        size: the size of the file, in bytes - optional
+        filename: the name of the file being uploaded [eg 'assignment.tar.gz'] - optional
+        notebooks: the notebooks in the assignment (releases only)
+
+    POST: creates an upload session. The same checks are made as for POST /assignment or /submission
+
+    returns
+        {"success": True, "session_id": <session_id>, "offset": 0}
+    """
+
+    urls = ["upload_sessions"]
+
+    @authenticated
+    def post(self):
+        [course_code, assignment_code, kind, timestamp, size, filename] = self.get_params(
+            ["course_id", "assignment_id", "kind", "timestamp", "size", "filename"]
+        )
+
+        if not (course_code and assignment_code and kind in ("assignment", "submission")):
+            note = (
+                "Upload session requires a course code, an assignment code, and a kind of 'assignment' or 'submission'"
+            )
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        action = AssignmentActions.released.value if kind == "assignment" else AssignmentActions.submitted.value
+        try:
+            size = int(size) if size else None
+        except ValueError:
+            size = -1
+        if size is not None and not 0 < size <= max_upload_size(self, action):
+            note = (
+                "File upload oversize, and rejected." if size > 0 else "Upload session size must be a positive number"
+            )
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        this_user = self.nbex_user
+
+        if course_code not in this_user["courses"]:
+            note = f"User not subscribed to course {course_code}"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        if kind == "assignment" and not "instructor" == this_user["current_role"].casefold():
+            note = f"User not an instructor to course {course_code}"
+            self.log.info(note)
+            self.finish({"success": False, "note": note})
+            return
+
+        filename = filename or "assignment.tar.gz"
+        with scoped_session() as session:
+            course = Course.find_by_code(db=session, code=course_code, org_id=this_user["org_id"], log=self.log)
+
+            if kind == "assignment":
+                location = release_location(
+                    self.base_storage_location, this_user["org_id"], course_code, assignment_code, filename
+                )
+                submission_timestamp = None
+            else:
+                assignment = AssignmentModel.find_by_code(db=session, code=assignment_code, course_id=course.id)
+                if assignment is None:
+                    note = f"User not fetched assignment {assignment_code}"
+                    self.log.info(note)
+                    self.finish({"success": False, "note": note})
+                    return
+                if not timestamp:
+                    timestamp = self.get_timestamp()
+                    self.log.info(f"Upload session created without a timestamp. We've set it to {timestamp}")
+                submission_timestamp = self.check_timezone(parser.parse(timestamp))
+                location = submission_location(
+                    self.base_storage_location,
+                    this_user["org_id"],
+                    course_code,
+                    assignment_code,
+                    this_user["name"],
+                    submission_timestamp,
+                    filename,
+                )
+
+            if self.storage_location(location, course_code, assignment_code) is None:
+                note = f"Upload session can't be stored for course {course_code} and assignment {assignment_code}"
+                self.log.info(note)
+                self.finish({"success": False, "note": note})
+                return
+
+            # The file is written to its final location, as the chunks arrive
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            open(location, "w+b").close()
+
+            upload_session = UploadSessionModel(
+                session_id=str(uuid.uuid4()),
+                user_id=this_user["id"],
+                course_id=course.id,
+                assignment_code=assignment_code,
+                action=action,
+                filename=filename,
+                location=location,
+                notebooks=json.dumps(self.get_arguments("notebooks")),
+                timestamp=submission_timestamp,
+                size=size,
+                received=0,
+            )
+            session.add(upload_session)
+            self.log.info(f"Created {upload_session}")
+            session_id = upload_session.session_id
+
+        self.finish({"success": True, "session_id": session_id, "offset": 0})
+
+
+@web.stream_request_body
+class UploadSession(BaseHandler):
+    """.../upload_session/
+    parmas:
+        session_id: the id returned when the session was created
+        offset: where in the file this chunk starts (PUT only)
+
+    GET: how much of the file has been received
+        {"success": True, "session_id": <session_id>, "offset": <bytes received>, "size": <expected size>}
+    PUT: (with the chunk as the body) writes the chunk at `offset`.
+        The offset must be what the session has received so far, else it's a 409 (Conflict)
+        {"success": True, "session_id": <session_id>, "offset": <bytes received>}
+    POST: finalizes the session - the file is recorded as a release or submission, and the session removed
+        {"success": True, "note": "Released"} or {"success": True, "note": "Submitted"}
+    DELETE: abandons the session, removing the partial file
+
+    Sessions not touched for `upload_session_timeout` seconds expire, and are removed.
+    """
+
+    urls = ["upload_session"]
+
+    def prepare(self):
+        self._handle = None
+        self._offset = 0
+        self._written = 0
+        if self.request.method != "PUT":
+            return
+
+        # Check the chunk _before_ any of it is read
+        if not self.current_user:
+            raise web.HTTPError(403)
+        [session_id, offset] = self.get_params(["session_id", "offset"])
+        try:
+            self._offset = int(offset)
+        except (TypeError, ValueError):
+            raise web.HTTPError(400, "Upload session chunks require a numeric offset")
+        try:
+            length = int(self.request.headers.get("Content-Length", 0))
+        except ValueError:
+            raise web.HTTPError(400, "Invalid Content-Length header")
+
+        with scoped_session() as session:
+            upload_session = self.find_upload_session(session, session_id)
+            if self._offset != upload_session.received:
+                raise web.HTTPError(409, f"Chunk offset {self._offset} does not match {upload_session.received}")
+            limit = max_upload_size(self, upload_session.action)
+            if upload_session.size:
+                limit = min(limit, upload_session.size)
+            if self._offset + length > limit:
+                raise web.HTTPError(413, f"Chunk would take the upload past {limit} bytes")
+            location = upload_session.location
+        self.request.connection.set_max_body_size(limit - self._offset)
+
+        self._handle = open(location, "r+b")
+        self._handle.seek(self._offset)
+        self._handle.truncate()
+
+    def data_received(self, chunk):
+        if self._handle:
+            self._handle.write(chunk)
+            self._written += len(chunk)
+
+    def find_upload_session(self, session, session_id):
+        """Find the current user's upload session, raising a 404 if it doesn't exist (or has expired)"""
+        if not session_id:
+            raise web.HTTPError(400, "Upload session calls require a session_id")
+        upload_session = UploadSessionModel.find_by_session_id(db=session, session_id=session_id, log=self.log)
+        if upload_session is None or upload_session.user.name != self.current_user.get("name"):
+            raise web.HTTPError(404, f"Upload session {session_id} not found")
+        updated_at = upload_session.updated_at
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        if updated_at < datetime.now(timezone.utc) - timedelta(seconds=self.upload_session_timeout):
+            remove_upload_session(session, upload_session, self.log)
+            session.commit()
+            raise web.HTTPError(404, f"Upload session {session_id} has expired")
+        return upload_session
+
+    @property
+    def upload_session_timeout(self):
+        return self.settings.get("upload_session_timeout", 86400)
+
+    def _record_progress(self):
+        """Close the chunk, and record how much of the file we now have"""
+        if self._handle is None:
+            return None
+        self._handle.close()
+        self._handle = None
+        [session_id] = self.get_params(["session_id"])
+        with scoped_session() as session:
+            upload_session = UploadSessionModel.find_by_session_id(db=session, session_id=session_id, log=self.log)
+            upload_session.received = self._offset + self._written
+            upload_session.updated_at = datetime.now(timezone.utc)
+            return upload_session.received
+
+    def on_connection_close(self):
+        # The bytes we did get are kept: the client can resume from there
+        super().on_connection_close()
+        self._record_progress()
+
+    @authenticated
+    def get(self):
+        [session_id] = self.get_params(["session_id"])
+        with scoped_session() as session:
+            upload_session = self.find_upload_session(session, session_id)
+            model = {
+                "success": True,
+                "session_id": upload_session.session_id,
+                "offset": upload_session.received,
+                "size": upload_session.size,
+            }
+        self.finish(model)
+
+    @authenticated
+    def put(self):
+        [session_id] = self.get_params(["session_id"])
+        received = self._record_progress()
+        self.finish({"success": True, "session_id": session_id, "offset": received})
+
+    # Finalize the upload
+    @authenticated
+    def post(self):
+        [session_id] = self.get_params(["session_id"])
+
+        this_user = self.nbex_user
+
+        with scoped_session() as session:
+            upload_session = self.find_upload_session(session, session_id)
+            course = upload_session.course
+
+            if course.course_code not in this_user["courses"]:
+                note = f"User not subscribed to course {course.course_code}"
+                self.log.info(note)
+                self.finish({"success": False, "note": note})
+                return
+
+            if upload_session.size is not None and upload_session.received != upload_session.size:
+                note = f"Upload incomplete: received {upload_session.received} of {upload_session.size} bytes"
+                self.log.info(note)
+                self.finish({"success": False, "note": note, "offset": upload_session.received})
+                return
+
+            if not upload_session.received:
+                note = "File upload failed."
+                self.log.info(note)
+                self.finish({"success": False, "note": note})
+                return
+
+            # The chunks were checked as they arrived, but the limit (eg the user's role) may have changed since
+            if upload_session.received > max_upload_size(self, upload_session.action):
+                note = "File upload oversize, and rejected."
+                self.log.info(note)
+                remove_upload_session(session, upload_session, self.log)
+                self.finish({"success": False, "note": note})
+                return
+
+            location = upload_session.location
+            # The chunks may have arrived over several requests (and processes), so this has to read the file back
+            checksum = file_checksum(location, self.download_chunk_size)
+            if upload_session.action == AssignmentActions.released.value:
+                if not "instructor" == this_user["current_role"].casefold():
+                    note = f"User not an instructor to course {course.course_code}"
+                    self.log.info(note)
+                    self.finish({"success": False, "note": note})
+                    return
+                record_release(
+                    session,
+                    course=course,
+                    assignment_code=upload_session.assignment_code,
+                    user_id=this_user["id"],
+                    location=location,
+                    notebooks=json.loads(upload_session.notebooks or "[]"),
+                    timestamp=datetime.strptime(self.get_timestamp(), self.timestamp_format),
+                    log=self.log,
+                    checksum=checksum,
+                )
+                note = "Released"
+            else:
+                assignment = AssignmentModel.find_by_code(
+                    db=session, code=upload_session.assignment_code, course_id=course.id
+                )
+                if assignment is None:
+                    note = f"User not fetched assignment {upload_session.assignment_code}"
+                    self.log.info(note)
+                    self.finish({"success": False, "note": note})
+                    return
+                timestamp = self.check_timezone(upload_session.timestamp)
+                self.log.info(
+                    f"Adding action {AssignmentActions.submitted.value} for user {this_user['id']} against assignment {assignment.id} at time {timestamp}"  # noqa: E501
+                )
+                # The action timestamp _must_ be the same value as in the timestamp.txt file in the submission
+                action = Action(
+                    user_id=this_user["id"],
+                    assignment_id=assignment.id,
+                    action=AssignmentActions.submitted,
+                    location=location,
+                    checksum=checksum,
+                    timestamp=timestamp,
+                )
+                session.add(action)
+                note = "Submitted"
+
+            # The file now belongs to the action
+            session.delete(upload_session)
+
+        self.finish({"success": True, "note": note})
+
+    # Abandon the upload
+    @authenticated
+    def delete(self):
+        [session_id] = self.get_params(["session_id"])
+        with scoped_session() as session:
+            upload_session = self.find_upload_session(session, session_id)
+            remove_upload_session(session, upload_session, self.log)
+        self.finish({"success": True, "note": f"Upload session {session_id} removed"})
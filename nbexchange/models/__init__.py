@@ -13,10 +13,14 @@ Base = declarative_base()
 
 # E402 : module level import not at top of file
 # F401 : module imported but unused
+from .action_archive import ActionArchive  # noqa: E402 F401
 from .actions import Action  # noqa: E402 F401
+from .assignment_counts import AssignmentCounts  # noqa: E402 F401
+from .assignment_states import AssignmentState  # noqa: E402 F401
 from .assignments import Assignment  # noqa: E402 F401
 from .courses import Course  # noqa: E402 F401
 from .feedback import Feedback  # noqa: E402 F401
 from .notebooks import Notebook  # noqa: E402 F401
 from .subscriptions import Subscription  # noqa: E402 F401
+from .upload_sessions import UploadSession  # noqa: E402 F401
 from .users import User  # noqa: E402 F401
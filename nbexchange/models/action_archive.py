@@ -0,0 +1,136 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Enum,
+    ForeignKey,
+    Integer,
+    Unicode,
+    delete,
+    func,
+    insert,
+    select,
+    union_all,
+)
+from sqlalchemy.orm import aliased
+
+from nbexchange.models import Base
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.assignment_states import AssignmentState
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+class ActionArchive(Base):
+    """Actions moved out of the `action` table, so the hot table (and its indexes) only hold the
+    assignments that are still in use.
+
+    An assignment is closed once it's been deleted (it's not `active`) and has had no actions for a while
+    (`NbExchange.action_archive_after_days`), and then its actions are moved here, in batches (see
+    `archive_batch`.) They keep their ids, so history from both tables is still in action order.
+
+    The listings only read `action` (and only list active assignments.) History can opt in to reading
+    the archive too (see `with_actions`.)
+
+    for assignment_id in ActionArchive.find_closed_assignments(db=session, before=cutoff):
+        ActionArchive.archive_batch(db=session, assignment_id=assignment_id, batch_size=1000)
+    """
+
+    __tablename__ = "action_archive"
+
+    # The columns copied from `action`
+    columns = ["id", "user_id", "assignment_id", "action", "location", "location_hash", "checksum", "timestamp"]
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # the id it had in `action`
+    user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), index=True)
+    assignment_id = Column(Integer, ForeignKey("assignment.id", ondelete="CASCADE"), index=True)
+    action = Column(Enum(AssignmentActions), nullable=False)
+    location = Column(Unicode(200), nullable=True)
+    location_hash = Column(Unicode(64), nullable=True)
+    checksum = Column(Unicode(200), nullable=True)
+    timestamp = Column(DateTime(timezone=True))
+    archived_at = Column(DateTime(timezone=True), default=_utcnow)
+
+    def __repr__(self):
+        return f"Archived assignment #{self.assignment_id} {self.action} by {self.user_id} at {self.timestamp}"
+
+    @classmethod
+    def find_closed_assignments(cls, db, before, log=None):
+        """Find the inactive (deleted) assignments whose last action was before `before` (a datetime), and
+        which have actions left to archive.
+
+        Returns a list of assignment ids, oldest first
+        """
+        if log:
+            log.debug(f"ActionArchive.find_closed_assignments - before:{before}")
+        if before is None or not isinstance(before, datetime):
+            raise TypeError("before must be defined, and a datetime")
+        newest = db.query(func.max(Action.id)).scalar()
+        if newest is None:
+            return []
+        return [
+            assignment_id
+            for (assignment_id,) in db.query(Action.assignment_id)
+            .filter(Action.assignment_id.isnot(None), Action.assignment.has(active=False))
+            .group_by(Action.assignment_id)
+            # An assignment with only the newest action left has nothing more to archive (see archive_batch)
+            .having(func.max(Action.timestamp) < before, func.min(Action.id) < newest).order_by(
+                func.max(Action.timestamp)
+            )
+        ]
+
+    @classmethod
+    def archive_batch(cls, db, assignment_id, batch_size, log=None):
+        """Move (at most) `batch_size` of an assignment's actions to the archive, and drop its
+        `assignment_state` rows (which point at those actions.)
+
+        Returns how many actions were moved: 0 once the assignment has none left in `action`
+        """
+        if log:
+            log.debug(f"ActionArchive.archive_batch - assignment_id:{assignment_id}, batch_size:{batch_size}")
+        if assignment_id is None or not isinstance(assignment_id, int):
+            raise TypeError("assignment_id must be defined, and an Int")
+        if batch_size is None or not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("batch_size must be a positive Int")
+
+        # The newest action always stays: SQLite would re-use its id for the next action added
+        newest = db.query(func.max(Action.id)).scalar()
+        ids = [
+            action_id
+            for (action_id,) in db.query(Action.id)
+            .filter(Action.assignment_id == assignment_id, Action.id < newest)
+            .order_by(Action.id)
+            .limit(batch_size)
+        ]
+        if ids:
+            table = Action.__table__
+            db.execute(
+                insert(cls).from_select(
+                    cls.columns + ["archived_at"],
+                    select(*[table.c[column] for column in cls.columns], func.now()).where(table.c.id.in_(ids)),
+                )
+            )
+            db.execute(delete(table).where(table.c.id.in_(ids)))
+            db.execute(delete(AssignmentState).where(AssignmentState.assignment_id == assignment_id))
+        if log:
+            log.debug(f"ActionArchive.archive_batch - {len(ids)} actions archived")
+        return len(ids)
+
+    @classmethod
+    def with_actions(cls):
+        """An `Action` entity for both tables: every action, archived or not.
+
+        Use it in place of `Action` in a query - `actions.id`, `actions.action`, etc.
+        """
+        action = Action.__table__
+        archive = cls.__table__
+        return aliased(
+            Action,
+            union_all(
+                select(*[action.c[column] for column in cls.columns]),
+                select(*[archive.c[column] for column in cls.columns]),
+            ).subquery("all_actions"),
+        )
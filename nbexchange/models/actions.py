@@ -1,12 +1,19 @@
 import enum
+import hashlib
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 from dateutil.tz import gettz
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, Unicode
+from sqlalchemy import Column, DateTime, Enum, ForeignKey, Index, Integer, Unicode, or_
 from sqlalchemy.orm import relationship, validates
 
 from nbexchange.models import Base
+from nbexchange.models.users import User
+
+
+def hash_location(location):
+    """The sha256 of a file location: an indexable key for `Action.location`, which is too long to index"""
+    return hashlib.sha256(location.encode("utf-8")).hexdigest() if location else None
 
 
 # This is the action: a user does something with an assignment, at a given time
@@ -50,15 +57,25 @@ class Action(Base):
     tz = gettz(time_zone)
 
     __tablename__ = "action"
+    # Composite indexes for the hot finders: the most recent action of a kind for an assignment
+    # (find_most_recent_action), and a user's actions on assignments (find_visible_to_user)
+    __table_args__ = (
+        Index("ix_action_assignment_id_action_id", "assignment_id", "action", "id"),
+        Index("ix_action_assignment_id_user_id_action", "assignment_id", "user_id", "action"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), index=True)
     assignment_id = Column(Integer, ForeignKey("assignment.id", ondelete="CASCADE"), index=True)
     action = Column(Enum(AssignmentActions), nullable=False, index=True)
     location = Column(Unicode(200), nullable=True)  # Location for the file of this action
+    location_hash = Column(Unicode(64), nullable=True, index=True)  # so files can be looked up by location
     checksum = Column(Unicode(200), nullable=True)  # Checksum for the saved file
     timestamp = Column(DateTime(timezone=True), default=datetime.now(tz))
 
+    # Not a column: who a `collected` or `feedback_released` action is for (see AssignmentState), if not the user
+    student_id = None
+
     # These are the relationship handles: a specific subscription has a single user to a single course
     user = relationship("User", back_populates="actions")
     assignment = relationship("Assignment", back_populates="actions")
@@ -106,6 +123,109 @@ class Action(Base):
             filters.append(cls.action == action)
         return db.query(cls).filter(*filters).order_by(cls.id.desc()).first()
 
+    @classmethod
+    def find_visible_to_user(cls, db, assignment_ids, user_id, after_id=None, limit=None, log=None):
+        """Find the actions a user gets to see, for several assignments at once: the `released` actions,
+        and the user's own actions.
+
+        actions = orm.Action.find_visible_to_user(
+            db=session, assignment_ids=[a.id for a in assignments], user_id=user.id
+        )
+
+        optional parameters:
+            'after_id' & 'limit' give a page of the actions: at most 'limit' of them, starting after the
+                action with id 'after_id' (see `page`.) Not used if set to None. Default to None
+
+        Returns a list, in the order the actions were recorded
+        """
+        if log:
+            log.debug(
+                f"Action.find_visible_to_user - {len(assignment_ids)} assignments, user_id:{user_id}, "
+                f"after_id:{after_id}, limit:{limit}"
+            )
+        if assignment_ids is None:
+            raise TypeError("assignment_ids must be defined")
+        if user_id is not None and not isinstance(user_id, int):
+            raise TypeError("user_id, if defined, must be an Int")
+        filters = [
+            cls.assignment_id.in_(assignment_ids),
+            or_(cls.action == AssignmentActions.released, cls.user_id == user_id),
+        ]
+        return cls.page(db.query(cls).filter(*filters).order_by(cls.id), after_id, limit).all()
+
+    @classmethod
+    def find_all_with_users(
+        cls, db, assignment_id, action, user_name=None, org_id=None, after_id=None, limit=None, log=None
+    ):
+        """Find the actions of one kind for an assignment, with the details of the users that did them, in one query.
+        Only the columns needed to list the actions are selected.
+
+        rows = orm.Action.find_all_with_users(
+            db=session, assignment_id=assignment.id, action=AssignmentActions.submitted
+        )
+
+        optional parameters:
+            'user_name' restricts the actions to those by the named user. Not used if set to None.
+            'org_id' the organisation the named user is in (user names are only unique within an org.)
+            'after_id' & 'limit' give a page of the actions (see `page`.) Not used if set to None.
+
+        Returns a list of (id, name, full_name, email, lms_user_id, action, location, checksum, timestamp) rows,
+        in the order the actions were recorded
+        """
+        if log:
+            log.debug(
+                f"Action.find_all_with_users - assignment_id:{assignment_id}, action:{action}, user:{user_name}, "
+                f"after_id:{after_id}, limit:{limit}"
+            )
+        if assignment_id is None or not isinstance(assignment_id, int):
+            raise TypeError("assignment_id must be defined, and an Int")
+        if action is None or not (isinstance(action, str) or isinstance(action, AssignmentActions)):
+            raise TypeError("action must be defined, and a string")
+        filters = [cls.assignment_id == assignment_id, cls.action == action]
+        if user_name is not None:
+            filters.append(User.name == user_name)
+            if org_id is not None:
+                filters.append(User.org_id == org_id)
+        query = (
+            db.query(
+                cls.id,
+                User.name,
+                User.full_name,
+                User.email,
+                User.lms_user_id,
+                cls.action,
+                cls.location,
+                cls.checksum,
+                cls.timestamp,
+            )
+            .join(User, User.id == cls.user_id)
+            .filter(*filters)
+            .order_by(cls.id)
+        )
+        return cls.page(query, after_id, limit).all()
+
+    @classmethod
+    def page(cls, query, after_id=None, limit=None, actions=None):
+        """Restrict a query (ordered by action id) to a page: at most `limit` actions, after the one with
+        id `after_id`. Keyset pagination, so a page is an index range scan however far in it is.
+
+        `actions` is the Action entity the query uses, if it's not Action (eg `ActionArchive.with_actions()`)
+        """
+        if after_id is not None and not isinstance(after_id, int):
+            raise TypeError("after_id, if defined, must be an Int")
+        if limit is not None and not isinstance(limit, int):
+            raise TypeError("limit, if defined, must be an Int")
+        if after_id is not None:
+            query = query.filter((actions or cls).id > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @validates("location")
+    def validate_location(self, key, value):
+        self.location_hash = hash_location(value)
+        return value
+
     @validates("timestamp")  # a datetime object, need to ensure it's returned with a timezone!
     def validate_timestamp(self, key, value):
         if value.tzinfo is None or value.tzinfo.utcoffset(value) is None:
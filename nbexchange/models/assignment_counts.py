@@ -0,0 +1,201 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, event, func
+from sqlalchemy.orm import Session
+
+from nbexchange.models import Base
+from nbexchange.models.action_archive import ActionArchive
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.assignments import Assignment
+from nbexchange.models.upsert import upsert
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+class AssignmentCounts(Base):
+    """How many of each action an assignment has had, and how many students have submitted it - so
+    they can be read without counting the actions.
+
+    They're added to as actions are added (see `_count_actions`), and `reconcile` corrects any drift
+    by recounting from the actions (the app does this every `assignment_counts_reconcile_interval`.)
+
+    counts = AssignmentCounts.find_for_assignment(db=session, assignment_id=assignment.id)
+    print(f"{counts.submitters} students have submitted {counts.submitted} times")
+    """
+
+    __tablename__ = "assignment_counts"
+
+    # The action kinds that are counted, and their columns
+    kinds = {
+        AssignmentActions.released: "released",
+        AssignmentActions.fetched: "fetched",
+        AssignmentActions.submitted: "submitted",
+        AssignmentActions.collected: "collected",
+        AssignmentActions.feedback_released: "feedback_released",
+        AssignmentActions.feedback_fetched: "feedback_fetched",
+    }
+    columns = list(kinds.values()) + ["submitters"]
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    assignment_id = Column(Integer, ForeignKey("assignment.id", ondelete="CASCADE"), nullable=False, unique=True)
+    released = Column(Integer, nullable=False, default=0)
+    fetched = Column(Integer, nullable=False, default=0)
+    submitted = Column(Integer, nullable=False, default=0)
+    submitters = Column(Integer, nullable=False, default=0)  # unique students with a submission
+    collected = Column(Integer, nullable=False, default=0)
+    feedback_released = Column(Integer, nullable=False, default=0)
+    feedback_fetched = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), default=_utcnow, onupdate=_utcnow)
+
+    def __repr__(self):
+        return f"AssignmentCounts for assignment #{self.assignment_id}"
+
+    def as_dict(self):
+        return {column: getattr(self, column) for column in self.columns}
+
+    @classmethod
+    def find_for_assignment(cls, db, assignment_id, log=None):
+        """Find the counts for an assignment.
+        Returns None if not found (the assignment has no actions.)
+        """
+        if log:
+            log.debug(f"AssignmentCounts.find_for_assignment - assignment_id:{assignment_id}")
+        if assignment_id is None or not isinstance(assignment_id, int):
+            raise TypeError("assignment_id must be defined, and an Int")
+        return db.query(cls).filter(cls.assignment_id == assignment_id).first()
+
+    @classmethod
+    def find_for_course(cls, db, course_id, assignment_code=None, log=None):
+        """Find the counts for the active assignments of a course, in one query.
+
+        optional params:
+            'assignment_code' restricts it to the one assignment. Not used if set to None. Defaults to None
+
+        Returns a list of (assignment_code, counts) rows, in the order the assignments were made. counts is
+        None for an assignment with no actions yet.
+        """
+        if log:
+            log.debug(f"AssignmentCounts.find_for_course - course_id:{course_id}, code:{assignment_code}")
+        if course_id is None or not isinstance(course_id, int):
+            raise TypeError("course_id must be defined, and an Int")
+        filters = [Assignment.course_id == course_id, Assignment.active.is_(True)]
+        if assignment_code is not None:
+            filters.append(Assignment.assignment_code == assignment_code)
+        return (
+            db.query(Assignment.assignment_code, cls)
+            .select_from(Assignment)
+            .outerjoin(cls, cls.assignment_id == Assignment.id)
+            .filter(*filters)
+            .order_by(Assignment.id)
+            .all()
+        )
+
+    @classmethod
+    def add(cls, connection, assignment_id, increments):
+        """Add to an assignment's counts ({column: how many more}), adding the row if needed"""
+        table = cls.__table__
+
+        def updates(new):
+            return dict({column: table.c[column] + new[column] for column in increments}, updated_at=new["updated_at"])
+
+        upsert(
+            connection,
+            table,
+            keys={"assignment_id": assignment_id},
+            values=dict({column: 0 for column in cls.columns}, updated_at=_utcnow(), **increments),
+            updates=updates,
+        )
+
+    @classmethod
+    def count(cls, db):
+        """Count everything from the actions (archived or not): {assignment_id: {column: count}}"""
+        actions = ActionArchive.with_actions()
+        counts = {}
+        for assignment_id, kind, n in db.query(actions.assignment_id, actions.action, func.count(actions.id)).group_by(
+            actions.assignment_id, actions.action
+        ):
+            if assignment_id is not None and kind in cls.kinds:
+                counts.setdefault(assignment_id, {column: 0 for column in cls.columns})[cls.kinds[kind]] = n
+        for assignment_id, n in (
+            db.query(actions.assignment_id, func.count(func.distinct(actions.user_id)))
+            .filter(actions.action == AssignmentActions.submitted)
+            .group_by(actions.assignment_id)
+        ):
+            if assignment_id is not None:
+                counts[assignment_id]["submitters"] = n
+        return counts
+
+    @classmethod
+    def reconcile(cls, db, log=None):
+        """Recount from the actions, and correct any counts that have drifted. Returns how many rows were fixed
+
+        The counts rows are locked (SELECT .. FOR UPDATE) before the actions are counted, so an action being
+        added meanwhile either is in the recount, or adds to the row once it's been corrected - it's not lost.
+        """
+        rows = db.query(cls).with_for_update().all()
+        counts = cls.count(db)
+        fixed = 0
+        for row in rows:
+            expected = counts.pop(row.assignment_id, {column: 0 for column in cls.columns})
+            if row.as_dict() != expected:
+                if log:
+                    log.warning(f"AssignmentCounts.reconcile - assignment #{row.assignment_id}: {row.as_dict()}")
+                for column, n in expected.items():
+                    setattr(row, column, n)
+                fixed += 1
+        # A row another transaction adds meanwhile is kept, as it has actions the recount may not
+        table = cls.__table__
+        for assignment_id, expected in counts.items():
+            upsert(
+                db.connection(),
+                table,
+                keys={"assignment_id": assignment_id},
+                values=dict(expected, updated_at=_utcnow()),
+                updates=lambda new: {"updated_at": table.c.updated_at},
+            )
+            fixed += 1
+        if log:
+            log.info(f"AssignmentCounts.reconcile - {fixed} assignments corrected")
+        return fixed
+
+
+@event.listens_for(Session, "after_flush")
+def _count_actions(session, flush_context):
+    """Add the new actions to AssignmentCounts, in the same transaction"""
+    increments = {}
+    submissions = {}
+    for obj in session.new:
+        if not isinstance(obj, Action) or obj.action is None or obj.assignment_id is None:
+            continue
+        kind = AssignmentActions(obj.action)
+        if kind not in AssignmentCounts.kinds:
+            continue
+        counts = increments.setdefault(obj.assignment_id, {})
+        counts[AssignmentCounts.kinds[kind]] = counts.get(AssignmentCounts.kinds[kind], 0) + 1
+        if kind == AssignmentActions.submitted and obj.user_id is not None:
+            key = (obj.assignment_id, obj.user_id)
+            submissions[key] = min(obj.id, submissions.get(key, obj.id))
+    if not increments:
+        return
+
+    connection = session.connection()
+    table = Action.__table__
+    for (assignment_id, user_id), first_id in submissions.items():
+        # A new submitter, if they've no earlier submission (ix_action_assignment_id_user_id_action)
+        earlier = connection.execute(
+            table.select()
+            .with_only_columns(table.c.id)
+            .where(
+                table.c.assignment_id == assignment_id,
+                table.c.user_id == user_id,
+                table.c.action == AssignmentActions.submitted,
+                table.c.id < first_id,
+            )
+            .limit(1)
+        ).first()
+        if earlier is None:
+            increments[assignment_id]["submitters"] = increments[assignment_id].get("submitters", 0) + 1
+    for assignment_id, counts in increments.items():
+        AssignmentCounts.add(connection, assignment_id, counts)
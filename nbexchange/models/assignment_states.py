@@ -0,0 +1,240 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    UniqueConstraint,
+    and_,
+    delete,
+    event,
+    func,
+    insert,
+)
+from sqlalchemy.orm import Session, aliased, relationship
+
+from nbexchange.models import Base
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.feedback import Feedback
+from nbexchange.models.notebooks import Notebook
+from nbexchange.models.upsert import greatest, upsert
+from nbexchange.models.users import User
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+class AssignmentState(Base):
+    """The latest action of each kind, for each user on each assignment: what `action` would tell you,
+    one row per student rather than every fetch & resubmission.
+
+    The row belongs to the user the action is for: the student who fetched or submitted, whose
+    submission was collected, or whose feedback was released - and the instructor, for a release.
+
+    It's kept up to date as actions are added (see `_record_actions`), and can be recomputed from
+    the actions with `rebuild` (`nbexchange --rebuild-assignment-state`)
+
+    state = AssignmentState.find_for_user(db=session, assignment_id=assignment.id, user_id=student.id)
+    if state and state.submitted_id:
+        print(f"Last submitted in action {state.submitted_id}")
+    """
+
+    __tablename__ = "assignment_state"
+    __table_args__ = (UniqueConstraint("assignment_id", "user_id"),)
+
+    # The action kinds with a pointer, and their columns
+    kinds = {
+        AssignmentActions.released: "released_id",
+        AssignmentActions.fetched: "fetched_id",
+        AssignmentActions.submitted: "submitted_id",
+        AssignmentActions.collected: "collected_id",
+        AssignmentActions.feedback_released: "feedback_released_id",
+        AssignmentActions.feedback_fetched: "feedback_fetched_id",
+    }
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    assignment_id = Column(Integer, ForeignKey("assignment.id", ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+    released_id = Column(Integer, ForeignKey("action.id", ondelete="SET NULL"), nullable=True)
+    fetched_id = Column(Integer, ForeignKey("action.id", ondelete="SET NULL"), nullable=True)
+    submitted_id = Column(Integer, ForeignKey("action.id", ondelete="SET NULL"), nullable=True)
+    collected_id = Column(Integer, ForeignKey("action.id", ondelete="SET NULL"), nullable=True)
+    feedback_released_id = Column(Integer, ForeignKey("action.id", ondelete="SET NULL"), nullable=True)
+    feedback_fetched_id = Column(Integer, ForeignKey("action.id", ondelete="SET NULL"), nullable=True)
+    updated_at = Column(DateTime(timezone=True), default=_utcnow, onupdate=_utcnow)
+
+    user = relationship("User")
+    submitted = relationship("Action", foreign_keys=[submitted_id])
+
+    def __repr__(self):
+        return f"AssignmentState for assignment #{self.assignment_id}, user {self.user_id}"
+
+    @classmethod
+    def find_for_user(cls, db, assignment_id, user_id, log=None):
+        """Find the state of a user's work on an assignment.
+        Returns None if not found.
+        """
+        if log:
+            log.debug(f"AssignmentState.find_for_user - assignment_id:{assignment_id}, user_id:{user_id}")
+        if assignment_id is None or not isinstance(assignment_id, int):
+            raise TypeError("assignment_id must be defined, and an Int")
+        if user_id is None or not isinstance(user_id, int):
+            raise TypeError("user_id must be defined, and an Int")
+        return db.query(cls).filter(cls.assignment_id == assignment_id, cls.user_id == user_id).first()
+
+    @classmethod
+    def find_latest_submissions(
+        cls, db, assignment_id, user_name=None, org_id=None, after_id=None, limit=None, log=None
+    ):
+        """Find each student's latest submission for an assignment - one row per student, read from the state.
+
+        rows = orm.AssignmentState.find_latest_submissions(db=session, assignment_id=assignment.id)
+
+        optional parameters are as for `Action.find_all_with_users`
+
+        Returns a list of (id, name, full_name, email, lms_user_id, action, location, checksum, timestamp) rows
+        (as `Action.find_all_with_users` does), in the order the submissions were made
+        """
+        if log:
+            log.debug(
+                f"AssignmentState.find_latest_submissions - assignment_id:{assignment_id}, user:{user_name}, "
+                f"after_id:{after_id}, limit:{limit}"
+            )
+        if assignment_id is None or not isinstance(assignment_id, int):
+            raise TypeError("assignment_id must be defined, and an Int")
+        filters = [cls.assignment_id == assignment_id]
+        if user_name is not None:
+            filters.append(User.name == user_name)
+            if org_id is not None:
+                filters.append(User.org_id == org_id)
+        query = (
+            db.query(
+                Action.id,
+                User.name,
+                User.full_name,
+                User.email,
+                User.lms_user_id,
+                Action.action,
+                Action.location,
+                Action.checksum,
+                Action.timestamp,
+            )
+            .select_from(cls)
+            .join(Action, Action.id == cls.submitted_id)
+            .join(User, User.id == cls.user_id)
+            .filter(*filters)
+            .order_by(Action.id)
+        )
+        return Action.page(query, after_id, limit).all()
+
+    @classmethod
+    def record(cls, connection, assignment_id, user_id, pointers):
+        """Point a user's state on an assignment at new actions ({column: action id}), adding the row if needed.
+
+        A pointer only moves forward: if another transaction has already pointed it at a later action, it stays.
+        """
+        table = cls.__table__
+
+        def updates(new):
+            latest = {
+                column: greatest(connection, func.coalesce(table.c[column], 0), new[column]) for column in pointers
+            }
+            latest["updated_at"] = greatest(
+                connection, func.coalesce(table.c.updated_at, new["updated_at"]), new["updated_at"]
+            )
+            return latest
+
+        upsert(
+            connection,
+            table,
+            keys={"assignment_id": assignment_id, "user_id": user_id},
+            values=dict(pointers, updated_at=_utcnow()),
+            updates=updates,
+        )
+
+    @classmethod
+    def rebuild(cls, db, log=None):
+        """Recompute every user's state from the actions. Returns the number of rows"""
+        if log:
+            log.info("AssignmentState.rebuild - recomputing the state from the actions")
+        pointers = {}
+
+        def latest(kind, user_id, query):
+            for assignment_id, user, action_id in query.group_by(Action.assignment_id, user_id):
+                if user is not None:
+                    pointers.setdefault((assignment_id, user), {})[cls.kinds[kind]] = action_id
+
+        for kind in (
+            AssignmentActions.released,
+            AssignmentActions.fetched,
+            AssignmentActions.submitted,
+            AssignmentActions.feedback_fetched,
+        ):
+            latest(
+                kind,
+                Action.user_id,
+                db.query(Action.assignment_id, Action.user_id, func.max(Action.id)).filter(Action.action == kind),
+            )
+
+        # A collection is for whoever made the submission at that location
+        submitted = aliased(Action)
+        latest(
+            AssignmentActions.collected,
+            submitted.user_id,
+            db.query(Action.assignment_id, submitted.user_id, func.max(Action.id))
+            .join(
+                submitted,
+                and_(
+                    submitted.assignment_id == Action.assignment_id,
+                    submitted.action == AssignmentActions.submitted,
+                    submitted.location_hash == Action.location_hash,
+                ),
+            )
+            .filter(Action.action == AssignmentActions.collected),
+        )
+        # Released feedback is for the student the feedback file is for
+        latest(
+            AssignmentActions.feedback_released,
+            Feedback.student_id,
+            db.query(Action.assignment_id, Feedback.student_id, func.max(Action.id))
+            .join(Feedback, Feedback.location == Action.location)
+            .join(Notebook, and_(Notebook.id == Feedback.notebook_id, Notebook.assignment_id == Action.assignment_id))
+            .filter(Action.action == AssignmentActions.feedback_released),
+        )
+
+        db.execute(delete(cls))
+        now = _utcnow()
+        rows = [
+            dict({column: None for column in cls.kinds.values()}, assignment_id=a, user_id=u, updated_at=now, **p)
+            for (a, u), p in pointers.items()
+        ]
+        if rows:
+            db.execute(insert(cls), rows)
+        if log:
+            log.info(f"AssignmentState.rebuild - {len(rows)} rows")
+        return len(rows)
+
+
+@event.listens_for(Session, "after_flush")
+def _record_actions(session, flush_context):
+    """Keep AssignmentState up to date, in the same transaction as the actions being added"""
+    states = {}
+    for obj in session.new:
+        if not isinstance(obj, Action) or obj.action is None:
+            continue
+        kind = AssignmentActions(obj.action)
+        if kind not in AssignmentState.kinds:
+            continue
+        user_id = obj.student_id if obj.student_id is not None else obj.user_id
+        if obj.assignment_id is None or user_id is None:
+            continue
+        pointers = states.setdefault((obj.assignment_id, user_id), {})
+        column = AssignmentState.kinds[kind]
+        pointers[column] = max(obj.id, pointers.get(column, 0))
+    if not states:
+        return
+    connection = session.connection()
+    for (assignment_id, user_id), pointers in states.items():
+        AssignmentState.record(connection, assignment_id, user_id, pointers)
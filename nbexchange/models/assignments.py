@@ -1,8 +1,20 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, Text, UniqueConstraint
+from sqlalchemy import (
+    Boolean,
+    Column,
+    ForeignKey,
+    Integer,
+    Text,
+    UniqueConstraint,
+    and_,
+    func,
+    or_,
+)
 from sqlalchemy.orm import relationship
 
 from nbexchange.models import Base
-from nbexchange.models.actions import Action
+from nbexchange.models.action_archive import ActionArchive
+from nbexchange.models.actions import Action, AssignmentActions, hash_location
+from nbexchange.models.users import User
 
 
 class Assignment(Base):
@@ -119,5 +131,143 @@ class Assignment(Base):
             filters.append(cls.actions.any(Action.location == path))
         return db.query(cls).filter(*filters).order_by(cls.id.desc())
 
+    @classmethod
+    def find_submission(cls, db, course_id, assignment_code, submission_id=None, path=None, log=None):
+        """Find a submitted file, and its assignment, by the submission's id or its path - in one index lookup
+
+        assignment, action = orm.Assignment.find_submission(
+            db=session, course_id=course.id, assignment_code="assign_a", submission_id=42
+        )
+
+        One of 'submission_id' (the id of the `submitted` action) or 'path' (its location) is needed.
+        A path is found through `Action.location_hash`.
+
+        Returns an (assignment, action) pair, or None if not found
+        """
+        if log:
+            log.debug(
+                f"Assignment.find_submission - course_id:{course_id}, code:{assignment_code}, "
+                f"submission_id:{submission_id}, path:{path}"
+            )
+        if course_id is None or not isinstance(course_id, int):
+            raise TypeError("course_id must be defined, and an Int")
+        if submission_id is None and not path:
+            raise ValueError("Either submission_id or path needs to be defined")
+        if submission_id is not None and not isinstance(submission_id, int):
+            raise TypeError("submission_id, if defined, must be an Int")
+
+        filters = [
+            cls.course_id == course_id,
+            cls.assignment_code == assignment_code,
+            cls.active.is_(True),
+            Action.action == AssignmentActions.submitted,
+        ]
+        if submission_id is not None:
+            filters.append(Action.id == submission_id)
+        if path:
+            filters.extend([Action.location_hash == hash_location(path), Action.location == path])
+        return (
+            db.query(cls, Action)
+            .join(Action, Action.assignment_id == cls.id)
+            .filter(*filters)
+            .order_by(Action.id.desc())
+            .first()
+        )
+
+    @classmethod
+    def find_history_for_course(
+        cls, db, course_id, user_id=None, action=None, after_id=None, limit=None, archived=False, log=None
+    ):
+        """The history of a course, in one query: every active assignment, with its actions (and who did them.)
+
+        rows = orm.Assignment.find_history_for_course(
+            db=session, course_id=course.id, user_id=student.id
+        )
+
+        optional params:
+            'user_id' restricts the actions to the `released` ones, and those by this user (what a student
+                sees.) Not used if set to None (what an instructor sees.) Defaults to None
+            'action' Allows one to restrict the actions to a specific action. Not used
+                if set to None. Defaults to None
+            'after_id' & 'limit' give a page of the history: at most 'limit' actions, starting after the action
+                with id 'after_id' (see `Action.page`.) A page only has assignments with actions in it, and is in
+                action order. Not used if 'limit' is None. Default to None
+            'archived' includes the archived actions (see `ActionArchive`) - and so the deleted assignments,
+                which are the ones that get archived. Defaults to False
+
+        Returns a list of (assignment_id, assignment_code, action, timestamp, location, user_name, action_id)
+        rows, in assignment then action order. An assignment with no (matching) actions still has a row, with
+        None for the action columns.
+        """
+        if log:
+            log.debug(
+                f"Assignment.find_history_for_course - course_id:{course_id}, user_id:{user_id}, action:{action}, "
+                f"after_id:{after_id}, limit:{limit}, archived:{archived}"
+            )
+        if course_id is None or not isinstance(course_id, int):
+            raise TypeError("course_id must be defined, and an Int")
+
+        actions = ActionArchive.with_actions() if archived else Action
+        query = db.query(
+            cls.id, cls.assignment_code, actions.action, actions.timestamp, actions.location, User.name, actions.id
+        ).select_from(cls)
+        if limit is None:
+            query = query.outerjoin(actions, cls._history_join(user_id, action, actions))
+        else:
+            query = query.join(actions, cls._history_join(user_id, action, actions))
+        query = query.outerjoin(User, User.id == actions.user_id).filter(*cls._history_filters(course_id, archived))
+        if limit is None:
+            return query.order_by(cls.id, actions.id).all()
+        return Action.page(query.order_by(actions.id), after_id, limit, actions=actions).all()
+
+    @classmethod
+    def find_history_summary_for_course(cls, db, course_id, user_id=None, action=None, archived=False, log=None):
+        """Just the action counts from `find_history_for_course`, counted in the database
+
+        rows = orm.Assignment.find_history_summary_for_course(
+            db=session, course_id=course.id, user_id=student.id
+        )
+
+        optional params are as for `find_history_for_course`
+
+        Returns a list of (assignment_id, assignment_code, action, count) rows, in assignment order. An
+        assignment with no (matching) actions still has a row, with None for the action (and a count of 0.)
+        """
+        if log:
+            log.debug(
+                f"Assignment.find_history_summary_for_course - course_id:{course_id}, "
+                f"user_id:{user_id}, action:{action}, archived:{archived}"
+            )
+        if course_id is None or not isinstance(course_id, int):
+            raise TypeError("course_id must be defined, and an Int")
+
+        actions = ActionArchive.with_actions() if archived else Action
+        return (
+            db.query(cls.id, cls.assignment_code, actions.action, func.count(actions.id))
+            .select_from(cls)
+            .outerjoin(actions, cls._history_join(user_id, action, actions))
+            .filter(*cls._history_filters(course_id, archived))
+            .group_by(cls.id, cls.assignment_code, actions.action)
+            .order_by(cls.id, actions.action)
+            .all()
+        )
+
+    @classmethod
+    def _history_filters(cls, course_id, archived):
+        # Deleted assignments are only listed with the archive, which is where their actions end up
+        if archived:
+            return [cls.course_id == course_id]
+        return [cls.course_id == course_id, cls.active.is_(True)]
+
+    @classmethod
+    def _history_join(cls, user_id, action, actions=Action):
+        # The action predicates go in the join, so assignments without any matching actions are still listed
+        join_on = [actions.assignment_id == cls.id]
+        if user_id is not None:
+            join_on.append(or_(actions.action == AssignmentActions.released, actions.user_id == user_id))
+        if action:
+            join_on.append(actions.action == action)
+        return and_(*join_on)
+
     def __repr__(self):
         return f"Assignment {self.assignment_code} for course {self.course_id}"
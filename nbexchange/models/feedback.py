@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, Unicode
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, Unicode
 from sqlalchemy.orm import relationship
 
 from nbexchange.models import Base
@@ -9,6 +9,10 @@ from nbexchange.models.notebooks import Notebook
 
 class Feedback(Base):
     __tablename__ = "feedback_2"
+    # For find_notebook_for_student
+    __table_args__ = (
+        Index("ix_feedback_2_notebook_id_student_id_timestamp", "notebook_id", "student_id", "timestamp"),
+    )
 
     #: Unique id of the feedback (automatically incremented)
     id = Column(Integer(), primary_key=True, autoincrement=True)
@@ -95,3 +99,24 @@ class Feedback(Base):
             cls.student_id == student_id,
         ]
         return db.query(cls).join(Notebook).filter(*filters).all()
+
+    @classmethod
+    def find_all_for_student_notebooks(cls, db, student_id, notebook_ids, log=None):
+        """Find all the pieces of feedback for a student, on any of the given notebooks, in one query
+
+        results = orm.Feedback.find_all_for_student_notebooks(
+            db=session, student_id=some_user.id, notebook_ids=[nb.id for nb in notebooks]
+        )
+
+        Returns a list, oldest first
+        """
+        if log:
+            log.debug(
+                f"Feedback.find_all_for_student_notebooks - student_id:{student_id}, {len(notebook_ids)} notebooks"
+            )
+        if student_id is None or not isinstance(student_id, int):
+            raise TypeError("student_id must be defined, and an Int")
+        if notebook_ids is None:
+            raise TypeError("notebook_ids must be defined")
+        filters = [cls.student_id == student_id, cls.notebook_id.in_(notebook_ids)]
+        return db.query(cls).filter(*filters).order_by(cls.id).all()
@@ -60,6 +60,26 @@ class Notebook(Base):
         # I think it should be this to be safe:
         # return db.query(cls).filter(*filters).order_by(cls.id.desc()).first()
 
+    @classmethod
+    def find_all_by_names(cls, db, names, assignment_id, log=None):
+        """Finds several named notebooks for a given assignment, in one query
+
+        notebooks = orm.Notebook.find_all_by_names(
+            db=session, assignment_id=current_assignment.id, names=['Some string', 'Another']
+        )
+
+        Returns a list, in id order (so the first of any repeated name is what `find_by_name` would find)
+
+        """
+        if log:
+            log.debug(f"Notebook.find_all_by_names - assignment_id:{assignment_id}, {len(names)} names")
+        if assignment_id is None or not isinstance(assignment_id, int):
+            raise TypeError("assignment_id must be defined, and an Int")
+        if names is None:
+            raise TypeError("names must be defined")
+        filters = [cls.assignment_id == assignment_id, cls.name.in_(names)]
+        return db.query(cls).filter(*filters).order_by(cls.id).all()
+
     @classmethod
     def find_all_for_assignment(cls, db, assignment_id, log=None):
         """Finds all the notebooks for a given assignment
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Integer, Text, Unicode
+from sqlalchemy.orm import relationship
+
+from nbexchange.models import Base
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+class UploadSession(Base):
+    """A resumable upload of a release or a submission
+
+    The client creates a session, sends the file in chunks (each saying what offset it starts at),
+    and then finalizes the session - which records the file in the normal way (as a released or
+    submitted Action.)
+
+    The file is written to its final location as the chunks arrive, and `received` records how
+    much of it we have - so a client whose connection drops only needs to send the rest.
+    Sessions that aren't finalized expire: `find_expired` finds them, so they can be removed (along
+    with their partial file) by `nbexchange.handlers.upload_session.remove_expired_upload_sessions`
+
+    sess = UploadSession(
+        session_id=str(uuid.uuid4()), user_id=user.id, course_id=course.id,
+        assignment_code='assign_a', action='submitted', location=path
+    )
+    """
+
+    __tablename__ = "upload_session"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # The (unguessable) handle the client uses to refer to the session
+    session_id = Column(Unicode(36), nullable=False, unique=True, index=True)
+    user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), index=True)
+    course_id = Column(Integer, ForeignKey("course.id", ondelete="CASCADE"), index=True)
+    assignment_code = Column(Text(), nullable=False)
+    # The AssignmentActions value this upload becomes when finalized: 'released' or 'submitted'
+    action = Column(Unicode(20), nullable=False)
+    filename = Column(Unicode(200), nullable=True)
+    location = Column(Unicode(200), nullable=False)  # Where the file is being written
+    notebooks = Column(Text(), nullable=True)  # json list of notebook names, for a release
+    timestamp = Column(DateTime(timezone=True), nullable=True)  # The submission timestamp
+    size = Column(BigInteger, nullable=True)  # The expected size of the file, if the client told us
+    received = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), default=_utcnow)
+    updated_at = Column(DateTime(timezone=True), default=_utcnow, index=True)
+
+    user = relationship("User")
+    course = relationship("Course")
+
+    def __repr__(self):
+        return f"UploadSession {self.session_id} ({self.action} {self.assignment_code}) by {self.user_id}"
+
+    @classmethod
+    def find_by_session_id(cls, db, session_id, log=None):
+        """Find an upload session by the id given to the client.
+        Returns None if not found.
+        """
+        if log:
+            log.debug(f"UploadSession.find_by_session_id - session_id:{session_id}")
+        if session_id is None:
+            raise ValueError("session_id needs to be defined")
+        return db.query(cls).filter(cls.session_id == session_id).first()
+
+    @classmethod
+    def find_expired(cls, db, max_age, log=None):
+        """Find the sessions that haven't been touched for `max_age` seconds"""
+        if log:
+            log.debug(f"UploadSession.find_expired - max_age:{max_age}")
+        cutoff = _utcnow() - timedelta(seconds=max_age)
+        return db.query(cls).filter(cls.updated_at < cutoff).all()
@@ -0,0 +1,48 @@
+"""Insert-or-update, for the tables the after_flush hooks keep up to date (AssignmentState & AssignmentCounts.)
+
+An UPDATE, then an INSERT if nothing was updated, races: two transactions can both find no row, and
+the second INSERT fails on the unique key - rolling back the user's action along with it. So these
+use the database's own upsert: INSERT .. ON CONFLICT DO UPDATE (SQLite & PostgreSQL) or INSERT .. ON
+DUPLICATE KEY UPDATE (MySQL.) Anything else gets the INSERT in a savepoint, and the UPDATE if it fails.
+"""
+
+from sqlalchemy import func, literal
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+
+def greatest(connection, *clauses):
+    """The largest of the clauses (SQLite's is the many-argument `max`)"""
+    if connection.dialect.name == "sqlite":
+        return func.max(*clauses)
+    return func.greatest(*clauses)
+
+
+def upsert(connection, table, keys, values, updates):
+    """Insert a row (`keys` & `values`, dicts of column: value), or update the row that already has those
+    unique `keys`.
+
+    `updates(new)` gives the update ({column: expression}), where `new[column]` is the value the insert
+    would have set - eg `{"count": table.c.count + new["count"]}`
+    """
+    dialect = connection.dialect.name
+    row = dict(keys, **values)
+    if dialect in ("sqlite", "postgresql"):
+        insert = (sqlite if dialect == "sqlite" else postgresql).insert(table).values(**row)
+        statement = insert.on_conflict_do_update(index_elements=list(keys), set_=updates(insert.excluded))
+    elif dialect in ("mysql", "mariadb"):
+        insert = mysql.insert(table).values(**row)
+        statement = insert.on_duplicate_key_update(**updates(insert.inserted))
+    else:
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(**row))
+            return
+        except IntegrityError:
+            new = {column: literal(value, type_=table.c[column].type) for column, value in row.items()}
+            statement = (
+                table.update()
+                .where(*[table.c[column] == value for column, value in keys.items()])
+                .values(**updates(new))
+            )
+    connection.execute(statement)
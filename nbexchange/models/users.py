@@ -67,6 +67,20 @@ class User(Base):
             raise ValueError("Name needs to be defined")
         return db.query(cls).filter(cls.name == name).first()
 
+    @classmethod
+    def find_all_by_names(cls, db, names, log=None):
+        """Find several users by name, in one query.
+
+        users = User.find_all_by_names(db, ["freddy", "bert"])
+
+        Returns a list (which is empty if none are found.)
+        """
+        if log:
+            log.debug(f"User.find_all_by_names - {len(names)} names")
+        if names is None:
+            raise ValueError("Names need to be defined")
+        return db.query(cls).filter(cls.name.in_(names)).all()
+
     @classmethod
     def find_by_org(cls, db, org_id, log=None):
         """Find all users for an organisation.
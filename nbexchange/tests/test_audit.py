@@ -0,0 +1,107 @@
+import logging
+import shutil
+
+import pytest
+from mock import patch
+from prometheus_client import REGISTRY
+from tornado import gen
+
+from nbexchange.audit import AuditQueue
+from nbexchange.handlers.base import BaseHandler
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
+    async_requests,
+    clear_database,
+    get_files_dict,
+    user_kiz_instructor,
+    user_kiz_student,
+)
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.ERROR)
+
+# set up the file to be uploaded as part of the testing later
+release_files, notebooks, timestamp = get_files_dict()
+
+
+@pytest.fixture
+def audit_queue(app):
+    queue = AuditQueue(batch_size=100, log=logger)
+    app.tornado_application.settings["audit_queue"] = queue
+    yield queue
+    app.tornado_application.settings["audit_queue"] = None
+
+
+def fetched_actions(db):
+    db.expire_all()
+    return db.query(Action).filter(Action.action == AssignmentActions.fetched).all()
+
+
+def release_and_fetch(app, fetches=1):
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        for _ in range(fetches):
+            r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+            assert r.status_code == 200
+
+
+# The fetch doesn't wait for its action: it's written when the queue is flushed
+@pytest.mark.gen_test
+def test_fetch_action_is_queued(app, db, clear_database, audit_queue):  # noqa: F811
+    yield from release_and_fetch(app)
+    assert fetched_actions(db) == []
+    assert len(audit_queue) == 1
+    assert REGISTRY.get_sample_value("nbexchange_audit_queue_depth") == 1
+
+    assert audit_queue.flush() == 1
+    [action] = fetched_actions(db)
+    assert action.user.name == user_kiz_student["name"]
+    assert action.location_hash is not None
+    assert len(audit_queue) == 0
+    shutil.rmtree(app.base_storage_location)
+
+
+# A full batch is written without waiting for the timer
+@pytest.mark.gen_test
+def test_full_batch_is_flushed(app, db, clear_database, audit_queue):  # noqa: F811
+    audit_queue.batch_size = 3
+    yield from release_and_fetch(app, fetches=3)
+    for _ in range(100):
+        if not len(audit_queue):
+            break
+        yield gen.sleep(0.01)
+    assert len(fetched_actions(db)) == 3
+    shutil.rmtree(app.base_storage_location)
+
+
+# The app drains the queue (it does so when it's stopped)
+@pytest.mark.gen_test
+def test_app_flushes_audit_queue(app, db, clear_database, audit_queue):  # noqa: F811
+    yield from release_and_fetch(app, fetches=2)
+    app.tornado_settings["audit_queue"] = audit_queue
+    app.flush_audit_queue()
+    assert len(fetched_actions(db)) == 2
+    shutil.rmtree(app.base_storage_location)
+
+
+# If the write fails, the actions stay queued
+@pytest.mark.gen_test
+def test_failed_flush_keeps_actions(app, db, clear_database, audit_queue):  # noqa: F811
+    yield from release_and_fetch(app)
+    with patch("nbexchange.audit.scoped_session", side_effect=RuntimeError("database has gone")):
+        assert audit_queue.flush() == 0
+    assert len(audit_queue) == 1
+    assert audit_queue.flush() == 1
+    assert len(fetched_actions(db)) == 1
+    shutil.rmtree(app.base_storage_location)
+
+
+# Only the audit actions can be queued
+def test_only_audit_actions_are_queued():
+    with pytest.raises(ValueError):
+        AuditQueue().put(user_id=1, assignment_id=1, action=AssignmentActions.submitted, location=None)
@@ -0,0 +1,185 @@
+import logging
+import threading
+
+import pytest
+from mock import patch
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool, StaticPool
+from tornado import gen
+
+from nbexchange import database
+from nbexchange.handlers.base import BaseHandler
+from nbexchange.models import Base
+from nbexchange.models.users import User
+from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
+    async_requests,
+    clear_database,
+    user_kiz_student,
+)
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.ERROR)
+
+
+def test_engine_kwargs_memory_uses_one_connection():
+    kwargs = database.engine_kwargs("sqlite:///:memory:", pool_size=5, max_overflow=10, pool_timeout=30)
+    assert kwargs["poolclass"] is StaticPool
+    assert "pool_size" not in kwargs
+    assert "max_overflow" not in kwargs
+    assert "pool_timeout" not in kwargs
+    assert kwargs["connect_args"] == {"check_same_thread": False}
+
+
+def test_engine_kwargs_keeps_pool_settings():
+    kwargs = database.engine_kwargs(
+        "postgresql://user:pass@db/nbexchange", pool_size=20, max_overflow=5, pool_timeout=3, pool_recycle=None
+    )
+    assert kwargs["pool_size"] == 20
+    assert kwargs["max_overflow"] == 5
+    assert kwargs["pool_timeout"] == 3
+    assert kwargs["pool_pre_ping"] is True
+    assert "pool_recycle" not in kwargs
+    assert "poolclass" not in kwargs
+
+
+def test_engine_kwargs_mysql_recycles_connections():
+    assert database.engine_kwargs("mysql://user:pass@db/nbexchange", pool_recycle=None)["pool_recycle"] == 60
+    assert database.engine_kwargs("mysql://user:pass@db/nbexchange", pool_recycle=600)["pool_recycle"] == 600
+
+
+def test_engine_kwargs_file_sqlite_is_pooled():
+    kwargs = database.engine_kwargs("sqlite:////tmp/nbexchange.sqlite", pool_size=2)
+    assert kwargs.get("poolclass", QueuePool) is QueuePool
+    assert kwargs["pool_size"] == 2
+
+
+# The app configures the same engine the handlers' sessions use
+@pytest.mark.gen_test
+def test_app_configures_the_session_engine(app, clear_database):  # noqa: F811
+    engine = database.engine
+    assert database.Session.kw["bind"] is engine
+    assert database.configure_engine(app.db_url, **app.db_engine_kwargs()) is engine
+
+
+@pytest.mark.gen_test
+def test_db_kwargs_override_pool_settings(app, clear_database):  # noqa: F811
+    app.db_pool_size = 7
+    app.db_kwargs = {"pool_size": 3, "pool_recycle": 120}
+    kwargs = app.db_engine_kwargs()
+    assert kwargs["pool_size"] == 3
+    assert kwargs["pool_recycle"] == 120
+    assert kwargs["max_overflow"] == app.db_max_overflow
+
+
+@pytest.mark.gen_test
+def test_pool_metrics(app, clear_database):  # noqa: F811
+    before = REGISTRY.get_sample_value("nbexchange_db_pool_checkout_seconds_count") or 0
+    with database.scoped_session():
+        pass
+    assert REGISTRY.get_sample_value("nbexchange_db_pool_checkout_seconds_count") == before + 1
+    assert REGISTRY.get_sample_value("nbexchange_db_pool_checked_out") is not None
+
+
+def test_sqlite_pragmas_are_set_on_connect(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'nbexchange.sqlite'}")
+    database.register_sqlite_pragmas(engine, database.SQLITE_PROFILE)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == -65536
+    engine.dispose()
+
+
+@pytest.mark.gen_test
+def test_sqlite_profile_is_off_by_default(app, clear_database):  # noqa: F811
+    assert app.db_sqlite_pragmas() == {}
+
+
+@pytest.mark.gen_test
+def test_sqlite_pragmas_override_the_profile(app, clear_database):  # noqa: F811
+    app.sqlite_profile = True
+    app.sqlite_pragmas = {"busy_timeout": 10000, "temp_store": "MEMORY"}
+    pragmas = app.db_sqlite_pragmas()
+    assert pragmas["journal_mode"] == "WAL"
+    assert pragmas["busy_timeout"] == 10000
+    assert pragmas["temp_store"] == "MEMORY"
+
+
+# A second, empty, SQLite file stands in for a replica that hasn't caught up
+@pytest.fixture
+def replica(tmp_path):
+    url = f"sqlite:///{tmp_path / 'replica.sqlite'}"
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    yield url
+    database.configure_replica_engine(None)
+
+
+def test_wrote_recently():
+    database.replica_staleness = 5.0
+    assert not database.wrote_recently("1/someone")
+    database.record_write("1/someone")
+    assert database.wrote_recently("1/someone")
+    database.replica_staleness = 0
+    assert not database.wrote_recently("1/someone")
+    database.replica_staleness = 5.0
+
+
+def test_read_session_is_read_only(clear_database):  # noqa: F811
+    with database.read_session() as session:
+        session.add(User(name="1-reader", org_id=1))
+        with pytest.raises(RuntimeError):
+            session.flush()
+
+
+@pytest.mark.gen_test
+def test_listings_read_from_the_replica(app, clear_database, replica):  # noqa: F811
+    # Never fall back to the primary: the replica doesn't have the course the first request made
+    database.configure_replica_engine(replica, staleness=0)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+    assert r.json() == {"success": False, "note": "Course course_2 does not exist", "value": []}
+
+
+@pytest.mark.gen_test
+def test_listings_read_from_the_primary_after_a_write(app, clear_database, replica):  # noqa: F811
+    # The first request adds the user, course & subscription, so their reads go to the primary
+    database.configure_replica_engine(replica, staleness=60)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+    assert r.json()["success"] is True
+
+
+@pytest.mark.gen_test
+def test_run_in_db_thread(app, clear_database):  # noqa: F811
+    def work():
+        writer = database.current_writer.get()
+        database.current_writer.set("1/someone-else")
+        return threading.current_thread(), writer
+
+    # As a handler would: the writer is carried into the work, and back
+    async def handler():
+        database.current_writer.set("1/someone")
+        result = await database.run_in_db_thread(work)
+        return result, database.current_writer.get()
+
+    # The in-memory test database runs on the IOLoop thread, so (once the app's startup work is done, so
+    # nothing else is on the thread) give it a thread just for this
+    yield gen.moment
+    database.configure_db_executor(1)
+    try:
+        (thread, writer), writer_after = yield handler()
+    finally:
+        database.configure_db_executor(0)
+    assert thread is not threading.current_thread()
+    assert writer == "1/someone"
+    assert writer_after == "1/someone-else"
+
+
+@pytest.mark.gen_test
+def test_run_in_db_thread_without_threads(app, clear_database):  # noqa: F811
+    thread = yield database.run_in_db_thread(threading.current_thread)
+    assert thread is threading.current_thread()
@@ -279,6 +279,36 @@ def test_get_collection_confirm_instructor_does_download(app, clear_database):
     shutil.rmtree(app.base_storage_location)
 
 
+# An interrupted collection can be resumed with a Range request
+@pytest.mark.gen_test
+def test_get_collection_range_request(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+        r = yield async_requests.post(
+            app.url + params,
+            files=release_files,
+        )
+    submitted = release_files["assignment"][1]
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/collections?course_id=course_2&assignment_id=assign_a")
+        collected_data = r.json()["value"][0]
+        params = f"/collection?course_id={collected_data['course_id']}&path={collected_data['path']}&assignment_id={collected_data['assignment_id']}"  # noqa: E501 W503
+        r = yield async_requests.get(app.url + params, headers={"Range": "bytes=100-"})
+    assert r.status_code == 206
+    assert r.headers["Accept-Ranges"] == "bytes"
+    assert r.headers["Content-Range"] == f"bytes 100-{len(submitted) - 1}/{len(submitted)}"
+    assert int(r.headers["Content-Length"]) == len(submitted) - 100
+    assert r.content == submitted[100:]
+    shutil.rmtree(app.base_storage_location)
+
+
 # broken nbex_user throws a 500 error on the server
 # (needs to be submitted before it can listed for collection )
 # (needs to be fetched before it can be submitted )
@@ -561,3 +591,70 @@ def test_get_collection_unable_to_read_file(app, clear_database, caplog):  # noq
     assert r.status_code == 500
     assert "No such file or directory:" in caplog.text
     shutil.rmtree(app.base_storage_location)
+
+
+# The submission_id from .../collections/ can be used instead of the path
+@pytest.mark.gen_test
+def test_get_collection_by_submission_id(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+        r = yield async_requests.post(app.url + params, files=release_files)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/collections?course_id=course_2&assignment_id=assign_a")
+        submission_id = r.json()["value"][0]["submission_id"]
+
+        r = yield async_requests.get(
+            app.url + f"/collection?course_id=course_2&assignment_id=assign_a&submission_id={submission_id}"
+        )
+        assert r.status_code == 200
+        assert r.content == release_files["assignment"][1]
+
+        # The submission has to be for the assignment asked for
+        r = yield async_requests.get(
+            app.url + f"/collection?course_id=course_2&assignment_id=assign_b&submission_id={submission_id}"
+        )
+        assert r.status_code == 200
+        assert int(r.headers["Content-Length"]) == 0
+
+        r = yield async_requests.get(app.url + "/collection?course_id=course_2&assignment_id=assign_a&submission_id=x")
+        assert r.json() == {"success": False, "note": "Submission id x is not a number"}
+    shutil.rmtree(app.base_storage_location)
+
+
+# If the collection can't be recorded, the file that was opened for it is closed again
+@pytest.mark.gen_test
+def test_get_collection_closes_file_when_record_fails(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+        r = yield async_requests.post(app.url + params, files=release_files)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/collections?course_id=course_2&assignment_id=assign_a")
+        submission_id = r.json()["value"][0]["submission_id"]
+    handles = []
+
+    def opener(*args, **kwargs):
+        handles.append(open(*args, **kwargs))
+        return handles[-1]
+
+    with (
+        patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor),
+        patch("nbexchange.handlers.collection.open", side_effect=opener, create=True),
+        patch.object(BaseHandler, "record_audit_action", side_effect=RuntimeError("database has gone")),
+    ):
+        r = yield async_requests.get(
+            app.url + f"/collection?course_id=course_2&assignment_id=assign_a&submission_id={submission_id}"
+        )
+    assert r.status_code == 500
+    assert len(handles) == 1
+    assert handles[0].closed
+    shutil.rmtree(app.base_storage_location)
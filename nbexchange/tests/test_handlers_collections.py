@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import shutil
 
@@ -5,9 +6,11 @@ import pytest
 from mock import patch
 
 from nbexchange.handlers.base import BaseHandler
+from nbexchange.models.users import User
 from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
     async_requests,
     clear_database,
+    count_queries,
     get_files_dict,
     user_brobbere_instructor,
     user_brobbere_student,
@@ -447,3 +450,151 @@ def test_collections_with_a_blank_feedback_path_injected(app, clear_database):
     assert response_data["success"] is True
     assert len(response_data["value"]) == 3
     shutil.rmtree(app.base_storage_location)
+
+
+# The checksum of each submission is computed as it's uploaded, and listed for the collector
+@pytest.mark.gen_test
+def test_collections_lists_checksum(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_zik_student):
+        params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+        r = yield async_requests.post(app.url + params, files=release_files)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/collections?course_id=course_2&assignment_id=assign_a")
+    response_data = r.json()
+    assert [value["checksum"] for value in response_data["value"]] == [
+        hashlib.sha256(release_files["assignment"][1]).hexdigest()
+    ]
+    with open(response_data["value"][0]["path"], "rb") as handle:
+        assert hashlib.sha256(handle.read()).hexdigest() == response_data["value"][0]["checksum"]
+    shutil.rmtree(app.base_storage_location)
+
+
+# user_id names a user in the course's org - user names are only unique within an org
+@pytest.mark.gen_test
+def test_collections_named_user_is_in_the_course_org(app, db, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_zik_student):
+        params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+        r = yield async_requests.post(app.url + params, files=release_files)
+    db.add(User(name=user_zik_student["name"], org_id=2))
+    db.commit()
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(
+            app.url + f"/collections?course_id=course_2&assignment_id=assign_a&user_id={user_zik_student['name']}"
+        )
+        assert [value["email"] for value in r.json()["value"]] == [user_zik_student["email"]]
+
+        # An unknown user has nothing to collect
+        r = yield async_requests.get(
+            app.url + "/collections?course_id=course_2&assignment_id=assign_a&user_id=1-nobody"
+        )
+        assert r.json() == {"success": True, "value": []}
+    shutil.rmtree(app.base_storage_location)
+
+
+# The number of queries doesn't grow with the number of submissions
+@pytest.mark.gen_test
+def test_collections_query_count_is_flat(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+
+    def submit(user):
+        with patch.object(BaseHandler, "get_current_user", return_value=user):
+            params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+            yield async_requests.post(app.url + params, files=release_files)
+
+    def list_collections():
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            with count_queries() as queries:
+                r = yield async_requests.get(app.url + "/collections?course_id=course_2&assignment_id=assign_a")
+        assert r.json()["success"] is True
+        return len(r.json()["value"]), len(queries)
+
+    yield from submit(user_kiz_student)
+    few_models, few_queries = yield from list_collections()
+
+    for user in [user_zik_student, user_brobbere_student]:
+        yield from submit(user)
+    many_models, many_queries = yield from list_collections()
+
+    assert (few_models, many_models) == (1, 3)
+    assert many_queries == few_queries
+    shutil.rmtree(app.base_storage_location)
+
+
+# limit & cursor page through the submissions, in the order they were made
+@pytest.mark.gen_test
+def test_collections_paginated(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    for user in [user_kiz_student, user_zik_student, user_brobbere_student]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user):
+            params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+            yield async_requests.post(app.url + params, files=release_files)
+
+    collections = app.url + "/collections?course_id=course_2&assignment_id=assign_a"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(collections)
+        everything = [model["submission_id"] for model in r.json()["value"]]
+
+        r = yield async_requests.get(collections + "&limit=2")
+        first = r.json()
+        r = yield async_requests.get(collections + f"&limit=2&cursor={first['next_cursor']}")
+        second = r.json()
+
+    assert [model["submission_id"] for model in first["value"]] == everything[:2]
+    assert first["next_cursor"] == everything[1]
+    assert [model["submission_id"] for model in second["value"]] == everything[2:]
+    assert second["next_cursor"] is None
+    shutil.rmtree(app.base_storage_location)
+
+
+# latest_only lists each student's latest submission, from the assignment state
+@pytest.mark.gen_test
+def test_collections_latest_only(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    for user in [user_kiz_student, user_brobbere_student, user_kiz_student]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user):
+            params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+            yield async_requests.post(app.url + params, files=release_files)
+
+    collections = app.url + "/collections?course_id=course_2&assignment_id=assign_a"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(collections)
+        everything = r.json()["value"]
+        r = yield async_requests.get(collections + "&latest_only=true")
+        latest = r.json()["value"]
+        r = yield async_requests.get(collections + "&latest_only=false")
+        not_latest = r.json()["value"]
+
+    assert len(everything) == 3
+    assert not_latest == everything
+    assert [(model["student_id"], model["submission_id"]) for model in latest] == [
+        (model["student_id"], model["submission_id"]) for model in everything[1:]
+    ]
+    assert latest[0].keys() == everything[0].keys()
+    shutil.rmtree(app.base_storage_location)
@@ -0,0 +1,95 @@
+import logging
+import shutil
+
+import pytest
+from mock import patch
+
+from nbexchange.handlers.base import BaseHandler
+from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
+    async_requests,
+    clear_database,
+    get_files_dict,
+    user_brobbere_student,
+    user_kiz_instructor,
+    user_kiz_student,
+)
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.ERROR)
+
+# set up the file to be uploaded as part of the testing later
+release_files, notebooks, timestamp = get_files_dict()
+
+submission_params = "course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+
+
+# #### POST /assignment_counts #### #
+# No method available (501, because we've hard-coded it)
+@pytest.mark.gen_test
+def test_assignment_counts_no_post_action(app):
+    r = yield async_requests.post(app.url + "/assignment_counts")
+    assert r.status_code == 501
+
+
+# #### GET /assignment_counts #### #
+# require authenticated user
+@pytest.mark.gen_test
+def test_assignment_counts_unauthenticated_user_blocked(app, clear_database):  # noqa: F811
+    r = yield async_requests.get(app.url + "/assignment_counts?course_id=course_2")
+    assert r.status_code == 403
+
+
+# Requires a course code
+@pytest.mark.gen_test
+def test_assignment_counts_fails_with_no_course(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/assignment_counts")
+    assert r.json() == {"success": False, "note": "Assignment counts call requires a course code"}
+
+
+# Students can't see the counts
+@pytest.mark.gen_test
+def test_assignment_counts_blocks_students(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignment_counts?course_id=course_2")
+    assert r.json() == {"success": False, "note": "User not an instructor to course course_2"}
+
+
+# The counts follow the release, fetch & submissions
+@pytest.mark.gen_test
+def test_assignment_counts(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        for code in ["assign_a", "assign_b"]:
+            yield async_requests.post(
+                app.url + f"/assignment?course_id=course_2&assignment_id={code}",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    for user in [user_kiz_student, user_brobbere_student, user_kiz_student]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user):
+            yield async_requests.post(app.url + "/submission?" + submission_params, files=release_files)
+
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/assignment_counts?course_id=course_2")
+        everything = r.json()
+        r = yield async_requests.get(app.url + "/assignment_counts?course_id=course_2&assignment_id=assign_a")
+        one = r.json()
+
+    assert everything["success"] is True
+    assert [model["assignment_id"] for model in everything["value"]] == ["assign_a", "assign_b"]
+    assert one["value"] == everything["value"][:1]
+    assert one["value"][0] == {
+        "assignment_id": "assign_a",
+        "released": 1,
+        "fetched": 1,
+        "submitted": 3,
+        "submitters": 2,
+        "collected": 0,
+        "feedback_released": 0,
+        "feedback_fetched": 0,
+    }
+    assert everything["value"][1]["released"] == 1
+    assert everything["value"][1]["submitted"] == 0
+    shutil.rmtree(app.base_storage_location)
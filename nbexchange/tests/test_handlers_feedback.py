@@ -1,5 +1,7 @@
 import base64
+import json
 import os
+import pathlib
 import shutil
 from datetime import datetime
 
@@ -8,6 +10,8 @@ from mock import patch
 from nbgrader.utils import make_unique_key, notebook_hash
 
 from nbexchange.handlers.base import BaseHandler
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.feedback import Feedback
 from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
     async_requests,
     clear_database,
@@ -20,6 +24,7 @@ from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
     user_kiz_instructor,
     user_kiz_student,
     user_lkihlman_instructor,
+    user_zik_student,
 )
 
 #################################
@@ -759,3 +764,242 @@ def test_feedback_get_correct_assignment_across_courses(app, clear_database):  #
     assert len(response_data["feedback"]) >= 1
     assert response_data["feedback"][0].get("content") == feedback_base64.decode("utf-8")
     shutil.rmtree(app.base_storage_location)
+
+
+# Fetching several pieces of feedback records all their actions together
+@pytest.mark.gen_test
+def test_feedback_get_records_fetches_together(app, db, clear_database):  # noqa: F811
+    assignment_id = "assign_a"
+    course_id = "course_2"
+    notebooks = ["notebook", "notebook2"]
+    student = user_kiz_student
+    timestamp = datetime.now(tz).strftime(timestamp_format)
+
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + f"/assignment?course_id={course_id}&assignment_id={assignment_id}",
+            files=released_files,
+            data={"notebooks": notebooks},
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + f"/assignment?course_id={course_id}&assignment_id={assignment_id}")
+        r = yield async_requests.post(
+            app.url + f"/submission?course_id={course_id}&assignment_id={assignment_id}&timestamp={timestamp}",
+            files=released_files,
+        )
+    for notebook in notebooks:
+        checksum = notebook_hash(
+            feedback_filename,
+            make_unique_key(course_id, assignment_id, notebook, student["name"], timestamp),
+        )
+        url = (
+            f"/feedback?assignment_id={assignment_id}&course_id={course_id}&notebook={notebook}"
+            f"&student={student['name']}&timestamp={timestamp}&checksum={checksum}"
+        )
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            r = yield async_requests.post(app.url + url, files=feedbacks)
+            assert r.json()["success"] is True
+
+    with (
+        patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student),
+        patch.object(
+            BaseHandler, "record_audit_actions", autospec=True, side_effect=BaseHandler.record_audit_actions
+        ) as record_audit_actions,
+    ):
+        r = yield async_requests.get(app.url + f"/feedback?assignment_id={assignment_id}&course_id={course_id}")
+    assert r.status_code == 200
+    assert len(r.json()["feedback"]) == 2
+    [(_, _, fetches)] = [call.args for call in record_audit_actions.call_args_list]
+    assert len(fetches) == 2
+    assert db.query(Action).filter(Action.action == AssignmentActions.feedback_fetched).count() == 2
+    shutil.rmtree(app.base_storage_location)
+
+
+# The manifest lists the feedback (without the content), and each file is then downloaded on its own
+@pytest.mark.gen_test
+def test_feedback_manifest_and_download(app, db, clear_database):  # noqa: F811
+    assignment_id = "assign_a"
+    course_id = "course_2"
+    notebook = "notebook"
+    student = user_kiz_student
+    timestamp = datetime.now(tz).strftime(timestamp_format)
+    checksum = notebook_hash(
+        feedback_filename,
+        make_unique_key(course_id, assignment_id, notebook, student["name"], timestamp),
+    )
+
+    kwargs = {"data": {"notebooks": [notebook]}}
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + f"/assignment?course_id={course_id}&assignment_id={assignment_id}",
+            files=released_files,
+            **kwargs,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + f"/assignment?course_id={course_id}&assignment_id={assignment_id}")
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.post(
+            app.url + f"/submission?course_id={course_id}&assignment_id={assignment_id}&timestamp={timestamp}",
+            files=released_files,
+        )
+
+    url = (
+        f"/feedback?assignment_id={assignment_id}"
+        f"&course_id={course_id}"
+        f"&notebook={notebook}"
+        f"&student={student['name']}"
+        f"&timestamp={timestamp}"
+        f"&checksum={checksum}"
+    )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(app.url + url, files=feedbacks)
+
+    with open(feedback_filename, "rb") as handle:
+        feedback_content = handle.read()
+
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        # manifest=false is the full feedback, content & all
+        r = yield async_requests.get(
+            app.url + f"/feedback?assignment_id={assignment_id}&course_id={course_id}&manifest=false"
+        )
+        [full] = r.json()["feedback"]
+        assert base64.b64decode(full["content"]) == feedback_content
+        assert "feedback_id" not in full
+        assert db.query(Action).filter(Action.action == AssignmentActions.feedback_fetched).count() == 1
+
+        r = yield async_requests.get(
+            app.url + f"/feedback?assignment_id={assignment_id}&course_id={course_id}&manifest=true"
+        )
+        response_data = r.json()
+        assert response_data["success"] is True
+        [manifest] = response_data["feedback"]
+        assert "content" not in manifest
+        assert manifest["filename"] == "notebook.html"
+        assert manifest["timestamp"] == timestamp
+        assert manifest["checksum"] == checksum
+        assert manifest["size"] == len(feedback_content)
+
+        # Listing the feedback isn't fetching it
+        assert db.query(Action).filter(Action.action == AssignmentActions.feedback_fetched).count() == 1
+
+        r = yield async_requests.get(app.url + f"/feedback_file?feedback_id={manifest['feedback_id']}")
+        assert r.status_code == 200
+        assert r.headers["Content-Type"] == "text/html"
+        assert r.content == feedback_content
+        assert db.query(Action).filter(Action.action == AssignmentActions.feedback_fetched).count() == 2
+
+        r = yield async_requests.get(
+            app.url + f"/feedback_file?feedback_id={manifest['feedback_id']}", headers={"Range": "bytes=0-99"}
+        )
+        assert r.status_code == 206
+        assert r.content == feedback_content[:100]
+
+    # Students can't download someone else's feedback
+    with patch.object(BaseHandler, "get_current_user", return_value=user_zik_student):
+        r = yield async_requests.get(app.url + f"/feedback_file?feedback_id={manifest['feedback_id']}")
+    assert r.status_code == 404
+    shutil.rmtree(app.base_storage_location)
+
+
+@pytest.mark.gen_test
+def test_feedback_file_requires_feedback_id(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/feedback_file")
+    assert r.status_code == 200
+    assert r.json() == {"success": False, "note": "Feedback download requires a feedback id"}
+
+
+# #### POST /feedback_batch ##### #
+
+
+def feedback_batch(students, notebook, timestamp):
+    """The manifest & files for a batch of feedback, one per student"""
+    with open(feedback_filename, "rb") as handle:
+        content = handle.read()
+    manifest, files = [], []
+    for student in students:
+        checksum = notebook_hash(
+            feedback_filename, make_unique_key("course_2", "assign_a", notebook, student, timestamp)
+        )
+        manifest.append({"notebook": notebook, "student": student, "timestamp": timestamp, "checksum": checksum})
+        files.append((checksum, (f"{notebook}.html", content)))
+    return {"manifest": json.dumps(manifest)}, files
+
+
+@pytest.mark.gen_test
+def test_feedback_batch_releases_for_the_class(app, db, clear_database):  # noqa: F811
+    timestamp = datetime.now(tz).strftime(timestamp_format)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=released_files,
+            data={"notebooks": ["notebook"]},
+        )
+    # Both students need to be known to the exchange
+    for student in (user_kiz_student, user_zik_student):
+        with patch.object(BaseHandler, "get_current_user", return_value=student):
+            r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+
+    data, files = feedback_batch([user_kiz_student["name"], user_zik_student["name"]], "notebook", timestamp)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/feedback_batch?course_id=course_2&assignment_id=assign_a", data=data, files=files
+        )
+    assert r.json() == {"success": True, "note": "Feedback released", "count": 2}
+    assert db.query(Feedback).count() == 2
+    assert db.query(Action).filter(Action.action == AssignmentActions.feedback_released).count() == 2
+
+    # ... and each student gets their own
+    for student in (user_kiz_student, user_zik_student):
+        with patch.object(BaseHandler, "get_current_user", return_value=student):
+            r = yield async_requests.get(app.url + "/feedback?course_id=course_2&assignment_id=assign_a")
+        [feedback] = r.json()["feedback"]
+        assert feedback["timestamp"] == timestamp
+        assert feedback["content"] == feedback_base64.decode("utf-8")
+    shutil.rmtree(app.base_storage_location)
+
+
+# One bad entry, and none of the batch is released
+@pytest.mark.gen_test
+def test_feedback_batch_all_or_nothing(app, db, clear_database):  # noqa: F811
+    timestamp = datetime.now(tz).strftime(timestamp_format)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=released_files,
+            data={"notebooks": ["notebook"]},
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+
+    data, files = feedback_batch([user_kiz_student["name"], "1-nobody"], "notebook", timestamp)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/feedback_batch?course_id=course_2&assignment_id=assign_a", data=data, files=files
+        )
+    assert r.json() == {"success": False, "note": "Feedback batch rejected: student 1-nobody not found"}
+    assert db.query(Feedback).count() == 0
+    assert list(pathlib.Path(app.base_storage_location).rglob("*.html")) == []
+    shutil.rmtree(app.base_storage_location)
+
+
+@pytest.mark.gen_test
+def test_feedback_batch_needs_instructor(app, clear_database):  # noqa: F811
+    data, files = feedback_batch([user_kiz_student["name"]], "notebook", "2020-01-01 00:00:00.0 UTC")
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.post(
+            app.url + "/feedback_batch?course_id=course_2&assignment_id=assign_a", data=data, files=files
+        )
+    assert r.json() == {"success": False, "note": "User not an instructor to course course_2"}
+
+
+@pytest.mark.gen_test
+def test_feedback_batch_invalid_manifest(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/feedback_batch?course_id=course_2&assignment_id=assign_a",
+            files={"manifest": (None, json.dumps([{"notebook": "notebook"}]))},
+        )
+    response_data = r.json()
+    assert response_data["success"] is False
+    assert response_data["note"].startswith("Feedback batch manifest is not valid")
@@ -5,6 +5,7 @@ import pytest
 from mock import patch
 
 from nbexchange.handlers.base import BaseHandler
+from nbexchange.models.actions import Action
 from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
     async_requests,
     clear_database,
@@ -179,6 +180,106 @@ def test_student_can_fetch(app, clear_database):  # noqa: F811
     shutil.rmtree(app.base_storage_location)
 
 
+# The file is sent in chunks, but arrives intact
+@pytest.mark.gen_test
+def test_fetch_streams_in_chunks(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["download_chunk_size"] = 100
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    assert r.status_code == 200
+    assert int(r.headers["Content-Length"]) == len(release_files["assignment"][1])
+    assert r.content == release_files["assignment"][1]
+    shutil.rmtree(app.base_storage_location)
+
+
+# A single byte range can be requested, so an interrupted fetch can be resumed
+@pytest.mark.gen_test
+def test_fetch_range_request(app, clear_database):  # noqa: F811
+    released = release_files["assignment"][1]
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student):
+        r = yield async_requests.get(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a", headers={"Range": "bytes=10-19"}
+        )
+        assert r.status_code == 206
+        assert r.headers["Accept-Ranges"] == "bytes"
+        assert r.headers["Content-Range"] == f"bytes 10-19/{len(released)}"
+        assert int(r.headers["Content-Length"]) == 10
+        assert r.content == released[10:20]
+
+        r = yield async_requests.get(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a", headers={"Range": "bytes=-15"}
+        )
+        assert r.status_code == 206
+        assert r.content == released[-15:]
+
+        # The whole file is a normal 200
+        r = yield async_requests.get(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a", headers={"Range": "bytes=0-"}
+        )
+        assert r.status_code == 200
+        assert r.content == released
+
+        r = yield async_requests.get(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            headers={"Range": f"bytes={len(released)}-"},
+        )
+        assert r.status_code == 416
+        assert r.headers["Content-Range"] == f"bytes */{len(released)}"
+    shutil.rmtree(app.base_storage_location)
+
+
+# Repeat fetches of the same release can be answered with a 304
+@pytest.mark.gen_test
+def test_fetch_conditional_get(app, clear_database):  # noqa: F811
+    url = app.url + "/assignment?course_id=course_2&assignment_id=assign_a"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(url, files=release_files)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student):
+        r = yield async_requests.get(url)
+        assert r.status_code == 200
+        etag = r.headers["Etag"]
+        last_modified = r.headers["Last-Modified"]
+        assert etag.startswith('"') and etag.endswith('"')
+
+        r = yield async_requests.get(url, headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.content == b""
+        assert r.headers["Etag"] == etag
+
+        r = yield async_requests.get(url, headers={"If-None-Match": '"something-else"'})
+        assert r.status_code == 200
+        assert r.content == release_files["assignment"][1]
+
+        r = yield async_requests.get(url, headers={"If-Modified-Since": last_modified})
+        assert r.status_code == 304
+
+        # A stale partial copy gets the whole file, not the range
+        r = yield async_requests.get(url, headers={"Range": "bytes=10-19", "If-Range": '"something-else"'})
+        assert r.status_code == 200
+        assert r.content == release_files["assignment"][1]
+        r = yield async_requests.get(url, headers={"Range": "bytes=10-19", "If-Range": etag})
+        assert r.status_code == 206
+
+    # A new release is a new ETag
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(url, files=release_files)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student):
+        r = yield async_requests.get(url, headers={"If-None-Match": etag})
+        assert r.status_code == 200
+        assert r.headers["Etag"] != etag
+    shutil.rmtree(app.base_storage_location)
+
+
 # Confirm that a fetch always matches the last release
 @pytest.mark.gen_test
 def test_fetch_after_rerelease_gets_different_file(app, clear_database):  # noqa: F811
@@ -268,3 +369,46 @@ def test_fetch_errors_when_file_physically_missing(app, clear_database, caplog):
         assert r.status_code == 500
         assert "No such file or directory:" in caplog.text
     shutil.rmtree(app.base_storage_location)
+
+
+# The assignment is released, but the release action can't be found (eg it's been archived)
+@pytest.mark.gen_test
+def test_fetch_404_when_release_action_missing(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with (
+        patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student),
+        patch.object(Action, "find_most_recent_action", return_value=None),
+    ):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    assert r.status_code == 404
+    shutil.rmtree(app.base_storage_location)
+
+
+# If the fetch can't be recorded, the file that was opened for it is closed again
+@pytest.mark.gen_test
+def test_fetch_closes_file_when_record_fails(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    handles = []
+
+    def opener(*args, **kwargs):
+        handles.append(open(*args, **kwargs))
+        return handles[-1]
+
+    with (
+        patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student),
+        patch("nbexchange.handlers.assignment.open", side_effect=opener, create=True),
+        patch.object(BaseHandler, "record_audit_action", side_effect=RuntimeError("database has gone")),
+    ):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    assert r.status_code == 500
+    assert len(handles) == 1
+    assert handles[0].closed
+    shutil.rmtree(app.base_storage_location)
@@ -58,6 +58,7 @@ released_match = {
         },
     ],
     "path": ANY,
+    "checksum": ANY,
     "status": "released",
     "student_id": 1,
     "timestamp": ANY,
@@ -80,6 +81,7 @@ fetched_match = {
         },
     ],
     "path": ANY,
+    "checksum": ANY,
     "status": "fetched",
     "student_id": 1,
     "timestamp": ANY,
@@ -102,6 +104,7 @@ feedback_released_match = {
         },
     ],
     "path": ANY,
+    "checksum": ANY,
     "status": "feedback_released",
     "student_id": 1,
     "timestamp": ANY,
@@ -124,6 +127,7 @@ submit_with_no_feedback_match = {
         },
     ],
     "path": ANY,
+    "checksum": ANY,
     "status": "submitted",
     "student_id": 1,
     "timestamp": ANY,
@@ -300,6 +304,7 @@ class TestHandlersFetchFullCycle(BaseTestHandlers):
                     },
                 ],
                 "path": ANY,
+                "checksum": ANY,
                 "status": "submitted",
                 "student_id": 1,
                 "timestamp": ANY,
@@ -362,6 +367,7 @@ class TestHandlersFetchFullCycle(BaseTestHandlers):
                     },
                 ],
                 "path": ANY,
+                "checksum": ANY,
                 "status": "submitted",
                 "student_id": 1,
                 "timestamp": ANY,
@@ -10,11 +10,14 @@ from mock import patch
 from nbgrader.utils import make_unique_key, notebook_hash
 
 from nbexchange.handlers.base import BaseHandler
+from nbexchange.models.actions import Action
+from nbexchange.models.assignments import Assignment as AssignmentModel
 
 # from nbexchange.tests.test_handlers_base import BaseTestHandlers
 from nbexchange.tests.utils import (  # noqa: F401 "action_*" & "clear_database"
     async_requests,
     clear_database,
+    count_queries,
     get_feedback_dict,
     get_files_dict,
     timestamp_format,
@@ -677,3 +680,172 @@ def test_history_action_students_much_limited(app, clear_database):  # noqa: F81
         },
     ]
     shutil.rmtree(app.base_storage_location)
+
+
+# The number of queries doesn't grow with the number of actions (or their users)
+@pytest.mark.gen_test
+def test_history_query_count_is_flat(app, clear_database):  # noqa: F811
+    def add_assignment(code):
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            yield async_requests.post(
+                app.url + f"/assignment?course_id=course_2&assignment_id={code}",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+        for user in [user_kiz_student, user_brobbere_student]:
+            with patch.object(BaseHandler, "get_current_user", return_value=user):
+                yield async_requests.get(app.url + f"/assignment?course_id=course_2&assignment_id={code}")
+
+    def list_history():
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            with count_queries() as queries:
+                r = yield async_requests.get(app.url + "/history")
+        assert r.json()["success"] is True
+        actions = sum(len(a["actions"]) for course in r.json()["value"] for a in course["assignments"])
+        return actions, len(queries)
+
+    yield from add_assignment("assign_a")
+    few_actions, few_queries = yield from list_history()
+
+    for code in ["assign_b", "assign_c", "assign_d"]:
+        yield from add_assignment(code)
+    many_actions, many_queries = yield from list_history()
+
+    assert many_actions == 4 * few_actions
+    assert many_queries == few_queries
+    shutil.rmtree(app.base_storage_location)
+
+
+# summary_only gives the same action_summary counts, without the actions
+@pytest.mark.gen_test
+def test_history_summary_only(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        for code in ["assign_a", "assign_a", "assign_b"]:
+            r = yield async_requests.post(
+                app.url + f"/assignment?course_id=course_2&assignment_id={code}",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+    for user in [user_kiz_student, user_brobbere_student]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user):
+            r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+            params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+            r = yield async_requests.post(app.url + params, files=release_files)
+
+    for user, query in [
+        (user_kiz_instructor, ""),
+        (user_brobbere_student, ""),
+        (user_kiz_instructor, "&action=submitted"),
+    ]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user):
+            r = yield async_requests.get(app.url + f"/history?course_id=course_2{query}")
+            full = r.json()["value"]
+            r = yield async_requests.get(app.url + f"/history?course_id=course_2{query}&summary_only=true")
+            summary = r.json()["value"]
+            r = yield async_requests.get(app.url + f"/history?course_id=course_2{query}&summary_only=false")
+            assert r.json()["value"] == full
+        for course in full:
+            for assignment in course["assignments"]:
+                del assignment["actions"]
+        assert summary == full
+
+    assert summary[0]["assignments"] == [
+        {"assignment_id": 1, "assignment_code": "assign_a", "action_summary": {"submitted": 2}},
+        {"assignment_id": 2, "assignment_code": "assign_b", "action_summary": {}},
+    ]
+    shutil.rmtree(app.base_storage_location)
+
+
+# limit & cursor page through the actions, across all the courses
+@pytest.mark.gen_test
+def test_history_paginated(app, clear_database):  # noqa: F811
+    for code in ["assign_a", "assign_b"]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            yield async_requests.post(
+                app.url + f"/assignment?course_id=course_2&assignment_id={code}",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+        for user in [user_kiz_student, user_brobbere_student]:
+            with patch.object(BaseHandler, "get_current_user", return_value=user):
+                yield async_requests.get(app.url + f"/assignment?course_id=course_2&assignment_id={code}")
+
+    def actions(value):
+        return sorted(
+            (a["assignment_code"], action["action"], action["user"], action["timestamp"])
+            for course in value
+            for a in course["assignments"]
+            for action in a["actions"]
+        )
+
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/history")
+        everything = r.json()
+        assert "next_cursor" not in everything
+
+        pages, cursor = [], ""
+        while cursor is not None:
+            r = yield async_requests.get(app.url + f"/history?limit=4{cursor}")
+            page = r.json()
+            assert page["success"] is True
+            pages.append(actions(page["value"]))
+            cursor = f"&cursor={page['next_cursor']}" if page["next_cursor"] is not None else None
+
+        r = yield async_requests.get(app.url + "/history?cursor=4")
+        assert r.json() == {"success": False, "note": "cursor needs a limit", "value": []}
+
+    assert [len(page) for page in pages] == [4, 2]
+    assert sorted(action for page in pages for action in page) == actions(everything["value"])
+    shutil.rmtree(app.base_storage_location)
+
+
+# Archived actions (of deleted assignments) drop out of the history, unless include_archived is given
+@pytest.mark.gen_test
+def test_history_include_archived(app, clear_database, db):  # noqa: F811
+    for code in ["assign_a", "assign_b"]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            yield async_requests.post(
+                app.url + f"/assignment?course_id=course_2&assignment_id={code}",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+            yield async_requests.get(app.url + f"/assignment?course_id=course_2&assignment_id={code}")
+
+    # assign_a was deleted, and last used in 2020
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        yield async_requests.delete(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    assign_a = db.query(AssignmentModel).filter_by(assignment_code="assign_a").one()
+    db.query(Action).filter_by(assignment_id=assign_a.id).update({"timestamp": datetime(2020, 1, 1, tzinfo=tz)})
+    db.commit()
+
+    def actions(value):
+        return {
+            a["assignment_code"]: [action["action"].replace("AssignmentActions.", "") for action in a["actions"]]
+            for a in value[0]["assignments"]
+        }
+
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/history?course_id=course_2&include_archived=true")
+        before = actions(r.json()["value"])
+
+        app.action_archive_after_days = 30
+        app.action_archive_batch_size = 1
+        archived = yield app.archive_actions()
+
+        r = yield async_requests.get(app.url + "/history?course_id=course_2")
+        after = actions(r.json()["value"])
+        r = yield async_requests.get(app.url + "/history?course_id=course_2&include_archived=false")
+        assert actions(r.json()["value"]) == after
+        r = yield async_requests.get(app.url + "/history?course_id=course_2&include_archived=true")
+        everything = actions(r.json()["value"])
+        r = yield async_requests.get(app.url + "/history?course_id=course_2&include_archived=true&limit=1")
+        first_page = r.json()
+
+    assert archived == 2
+    assert before == {"assign_a": ["released", "fetched"], "assign_b": ["released", "fetched"]}
+    assert after == {"assign_b": ["released", "fetched"]}
+    assert everything == before
+    assert actions(first_page["value"]) == {"assign_a": ["released"]}
+    assert first_page["next_cursor"] is not None
+    shutil.rmtree(app.base_storage_location)
@@ -1,15 +1,24 @@
+import copy
 import logging
+import shutil
+import threading
 
 import pytest
 from mock import patch
+from sqlalchemy import event
 
+from nbexchange import database
+from nbexchange.app import NbExchange
 from nbexchange.handlers.base import BaseHandler
 from nbexchange.tests.test_handlers_base import BaseTestHandlers
 from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
     async_requests,
     clear_database,
+    count_queries,
+    get_files_dict,
     user_kiz,
     user_kiz_instructor,
+    user_kiz_student,
 )
 
 logger = logging.getLogger(__file__)
@@ -65,3 +74,143 @@ class TestHandlersFetch(BaseTestHandlers):
         assert (
             "Both current_course ('None') and current_role ('None') must have values. User was '1-kiz'" in caplog.text
         )
+
+
+# The number of queries doesn't grow with the number of assignments (or actions, or notebooks)
+@pytest.mark.gen_test
+def test_assignments_query_count_is_flat(app, clear_database):  # noqa: F811
+    release_files, notebooks, timestamp = get_files_dict()
+
+    def add_assignment(code):
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            yield async_requests.post(
+                app.url + f"/assignment?course_id=course_2&assignment_id={code}",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+            yield async_requests.get(app.url + f"/assignment?course_id=course_2&assignment_id={code}")
+            yield async_requests.post(
+                app.url + f"/submission?course_id=course_2&assignment_id={code}&timestamp={timestamp}",
+                files=release_files,
+            )
+
+    def list_assignments():
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+            with count_queries() as queries:
+                r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+        assert r.json()["success"] is True
+        return len(r.json()["value"]), len(queries)
+
+    for code in ["assign_a", "assign_b"]:
+        yield from add_assignment(code)
+    few_models, few_queries = yield from list_assignments()
+
+    for code in ["assign_c", "assign_d", "assign_e", "assign_f"]:
+        yield from add_assignment(code)
+    many_models, many_queries = yield from list_assignments()
+
+    assert many_models == 3 * few_models
+    assert many_queries == few_queries
+    shutil.rmtree(app.base_storage_location)
+
+
+# limit & cursor page through the same actions as the unpaginated list
+@pytest.mark.gen_test
+def test_assignments_paginated(app, clear_database):  # noqa: F811
+    release_files, notebooks, timestamp = get_files_dict()
+    for code in ["assign_a", "assign_b", "assign_c"]:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            yield async_requests.post(
+                app.url + f"/assignment?course_id=course_2&assignment_id={code}",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+            yield async_requests.get(app.url + f"/assignment?course_id=course_2&assignment_id={code}")
+
+    def key(model):
+        return (model["assignment_id"], model["status"], model["timestamp"])
+
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+        everything = r.json()
+        assert "next_cursor" not in everything
+
+        pages, cursor = [], ""
+        while cursor is not None:
+            r = yield async_requests.get(app.url + f"/assignments?course_id=course_2&limit=4{cursor}")
+            page = r.json()
+            assert page["success"] is True
+            pages.append(page["value"])
+            cursor = f"&cursor={page['next_cursor']}" if page["next_cursor"] is not None else None
+
+    assert [len(page) for page in pages] == [4, 2]
+    assert sorted(key(model) for page in pages for model in page) == sorted(key(model) for model in everything["value"])
+    shutil.rmtree(app.base_storage_location)
+
+
+@pytest.mark.gen_test
+def test_assignments_bad_page_params(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        for params, note in [
+            ("&limit=0", "limit 0 is not a positive number"),
+            ("&limit=ten", "limit ten is not a positive number"),
+            ("&limit=10&cursor=x", "cursor x is not a number"),
+            ("&cursor=10", "cursor needs a limit"),
+        ]:
+            r = yield async_requests.get(app.url + f"/assignments?course_id=course_2{params}")
+            assert r.json() == {"success": False, "note": note, "value": []}
+
+
+# The in-memory test database runs everything on the IOLoop thread, so this app has a database file
+@pytest.fixture
+def file_db_app(request, io_loop, tmp_path, _nbexchange_config):
+    config = copy.deepcopy(_nbexchange_config)
+    config.NbExchange.db_url = f"sqlite:///{tmp_path}/nbexchange.sqlite"
+    config.NbExchange.db_threads = 2
+    memory_engine = database.engine
+    # Unset, so the in-memory database isn't disposed of when the app replaces the engine
+    with patch.object(database, "engine", None), patch.object(database, "_engine_config", None):
+        nbexchange = NbExchange.instance(config=config)
+        nbexchange.initialize([])
+        nbexchange.start(run_loop=False)
+        nbexchange.url = f"http://127.0.0.1:{nbexchange.port}{nbexchange.base_url}".rstrip("/")
+        yield nbexchange
+        nbexchange.stop()
+        NbExchange.clear_instance()
+        database.engine.dispose()
+    database.configure_db_executor(0)
+    database.Session.configure(bind=memory_engine)
+    database.ReadSession.configure(bind=memory_engine)
+
+
+# The user lookup and the listing's queries run on the db threads
+@pytest.mark.gen_test
+def test_assignments_on_db_threads(file_db_app):
+    app = file_db_app
+    release_files, notebooks, timestamp = get_files_dict()
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    assert r.json()["success"] is True
+
+    threads = set()
+
+    def record_thread(*args):
+        threads.add(threading.current_thread().name)
+
+    event.listen(database.engine, "before_cursor_execute", record_thread)
+    try:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+            r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record_thread)
+    assert r.json()["success"] is True
+    assert [model["assignment_id"] for model in r.json()["value"]] == ["assign_a"]
+    assert threads
+    assert all(name.startswith("nbexchange-db") for name in threads)
+    shutil.rmtree(app.base_storage_location)
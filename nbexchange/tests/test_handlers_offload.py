@@ -0,0 +1,106 @@
+import logging
+import os
+import shutil
+from urllib.parse import unquote
+
+import pytest
+from mock import patch
+
+from nbexchange.handlers.base import BaseHandler
+from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
+    async_requests,
+    clear_database,
+    get_files_dict,
+    user_brobbere_student,
+    user_kiz_instructor,
+    user_kiz_student,
+)
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.ERROR)
+
+# set up the file to be uploaded as part of the testing later
+release_files, notebooks, timestamp = get_files_dict()
+
+
+def stand_in_proxy(app, response):
+    """Does what the front proxy would: swaps the internal redirect for the file it names"""
+    assert response.content == b""
+    if "X-Accel-Redirect" in response.headers:
+        prefix = app.tornado_application.settings["file_offload_prefix"]
+        internal_uri = response.headers["X-Accel-Redirect"]
+        assert internal_uri.startswith(prefix)
+        path = os.path.join(app.base_storage_location, unquote(internal_uri[len(prefix) :]))
+    else:
+        path = response.headers["X-Sendfile"]
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+# #### file_offload = "x-accel-redirect" ##### #
+
+
+@pytest.mark.gen_test
+def test_fetch_offloaded_with_x_accel_redirect(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["file_offload"] = "x-accel-redirect"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    assert r.status_code == 200
+    assert r.headers["Content-Type"] == "application/gzip"
+    assert r.headers["X-Accel-Redirect"].startswith("/protected/1/released/course_2/assign_a/")
+    assert stand_in_proxy(app, r) == release_files["assignment"][1]
+
+    # The fetch is still authorised, and recorded, by the exchange
+    with patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student):
+        r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+    assert [x["status"] for x in r.json()["value"]] == ["released", "fetched"]
+    shutil.rmtree(app.base_storage_location)
+
+
+# Files outside the storage location can't be mapped, so are sent by the exchange
+@pytest.mark.gen_test
+def test_offload_falls_back_for_unmapped_files(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    app.tornado_application.settings["file_offload"] = "x-accel-redirect"
+    app.tornado_application.settings["base_storage_location"] = "/somewhere/else"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_brobbere_student):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+    assert r.status_code == 200
+    assert "X-Accel-Redirect" not in r.headers
+    assert r.content == release_files["assignment"][1]
+    shutil.rmtree(app.base_storage_location)
+
+
+# #### file_offload = "x-sendfile" ##### #
+
+
+@pytest.mark.gen_test
+def test_collection_offloaded_with_x_sendfile(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["file_offload"] = "x-sendfile"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+        params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+        r = yield async_requests.post(app.url + params, files=release_files)
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.get(app.url + "/collections?course_id=course_2&assignment_id=assign_a")
+        collected_data = r.json()["value"][0]
+        params = f"/collection?course_id={collected_data['course_id']}&path={collected_data['path']}&assignment_id={collected_data['assignment_id']}"  # noqa: E501 W503
+        r = yield async_requests.get(app.url + params)
+    assert r.status_code == 200
+    assert r.headers["X-Sendfile"] == os.path.abspath(collected_data["path"])
+    assert stand_in_proxy(app, r) == release_files["assignment"][1]
+    shutil.rmtree(app.base_storage_location)
@@ -224,8 +224,7 @@ def test_105MB_not_blocked(app, clear_database):  # noqa: F811
     shutil.rmtree(app.base_storage_location)
 
 
-# Note, the web HTTPServer just throws a 400 error for an oversized file
-# There is no way to catch/handle that _server side_
+# An oversized file is rejected (with a 413) before any of it is read
 @pytest.mark.skip
 @pytest.mark.gen_test
 def test_5point1GB_is_blocked__long_test(app, clear_database):  # noqa: F811
@@ -237,8 +236,7 @@ def test_5point1GB_is_blocked__long_test(app, clear_database):  # noqa: F811
             data={"notebooks": notebooks},
             files=faked_files,
         )
-    assert r.status_code == 400
-    assert r.content == b""
+    assert r.status_code == 413
 
 
 # fakes something going wrong in the "write to disk" code
@@ -1,10 +1,13 @@
 import logging
+import os
 import shutil
+from datetime import datetime, timezone
 
 import pytest
 from mock import patch
 
 from nbexchange.handlers.base import BaseHandler
+from nbexchange.models.actions import Action
 from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
     async_requests,
     clear_database,
@@ -137,7 +140,7 @@ def test_post_submision_student_can_submit(app, clear_database):  # noqa: F811
 # (needs to be fetched before it can be submitted )
 # (needs to be released before it can be fetched )
 @pytest.mark.gen_test
-def test_post_submision_timestamp_autocreated(app, clear_database):  # noqa: F811
+def test_post_submision_timestamp_autocreated(app, db, clear_database):  # noqa: F811
     with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
         r = yield async_requests.post(
             app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
@@ -145,7 +148,10 @@ def test_post_submision_timestamp_autocreated(app, clear_database):  # noqa: F81
         )
     with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
         r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
-    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+    with (
+        patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student),
+        patch.object(BaseHandler, "get_timestamp", return_value="2020-01-01 00:00:00.000000 UTC"),
+    ):
         params = "/submission?course_id=course_2&assignment_id=assign_a"
         r = yield async_requests.post(
             app.url + params,
@@ -155,6 +161,12 @@ def test_post_submision_timestamp_autocreated(app, clear_database):  # noqa: F81
     response_data = r.json()
     assert response_data["success"] is True
     assert response_data["note"] == "Submitted"
+    # The one timestamp is used for both the action, and the path the submission is stored in
+    action = db.query(Action).filter(Action.action == "submitted").one()
+    assert action.timestamp.replace(tzinfo=None) == datetime(2020, 1, 1)
+    assert os.path.basename(os.path.dirname(action.location)) == str(
+        int(datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp())
+    )
     shutil.rmtree(app.base_storage_location)
 
 
@@ -308,8 +320,7 @@ def test_105MB_not_blocked(app, clear_database):  # noqa: F811
     shutil.rmtree(app.base_storage_location)
 
 
-# Note, the web HTTPServer just throws a 400 error for an oversized file
-# There is no way to catch/handle that _server side_
+# An oversized file is rejected (with a 413) before any of it is read
 @pytest.mark.skip
 @pytest.mark.gen_test
 def test_5point1GB_is_blocked__long_test(app, clear_database):  # noqa: F811
@@ -328,6 +339,5 @@ def test_5point1GB_is_blocked__long_test(app, clear_database):  # noqa: F811
             app.url + params,
             files=faked_files,
         )
-    assert r.status_code == 400
-    assert r.content == b""
+    assert r.status_code == 413
     shutil.rmtree(app.base_storage_location)
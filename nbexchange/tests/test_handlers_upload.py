@@ -0,0 +1,345 @@
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+from urllib.parse import quote_plus
+
+import pytest
+import requests
+from mock import patch
+from tornado import web
+
+from nbexchange.handlers.base import BaseHandler
+from nbexchange.handlers.upload import MultipartStreamParser, UploadHandler
+from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
+    async_requests,
+    clear_database,
+    get_files_dict,
+    user_kiz_instructor,
+    user_kiz_student,
+)
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.ERROR)
+
+# set up the file to be uploaded as part of the testing later
+release_files, notebooks, timestamp = get_files_dict()
+
+boundary = b"------nbexchangeboundary"
+file_content = os.urandom(300000) + b"\r\n--" + boundary[:-2] + b"\r\n"
+multipart_body = (
+    b"--" + boundary + b"\r\n"
+    b'Content-Disposition: form-data; name="notebooks"\r\n\r\n'
+    b"assignment-0.6\r\n"
+    b"--" + boundary + b"\r\n"
+    b'Content-Disposition: form-data; name="notebooks"\r\n\r\n'
+    b"assignment-0.6-2\r\n"
+    b"--" + boundary + b"\r\n"
+    b'Content-Disposition: form-data; name="assignment"; filename="assignment.tar.gz"\r\n'
+    b"Content-Type: application/gzip\r\n\r\n" + file_content + b"\r\n"
+    b"--" + boundary + b"--\r\n"
+)
+
+
+def feed(parser, body, chunk_size):
+    for i in range(0, len(body), chunk_size):
+        parser.data_received(body[i : i + chunk_size])
+
+
+# #### MultipartStreamParser ##### #
+
+
+# The delimiter can be split across chunks at any point, and the file content is still intact
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1000, 65536, len(multipart_body)])
+def test_parser_writes_file_and_fields(tmp_path, chunk_size):
+    parser = MultipartStreamParser(boundary, lambda name, filename: str(tmp_path / "sub" / filename))
+    feed(parser, multipart_body, chunk_size)
+    assert parser.complete
+    assert parser.arguments == {"notebooks": [b"assignment-0.6", b"assignment-0.6-2"]}
+    file_info = parser.files["assignment"][0]
+    assert file_info["filename"] == "assignment.tar.gz"
+    assert file_info["content_type"] == "application/gzip"
+    assert file_info["size"] == len(file_content)
+    assert file_info["checksum"] == hashlib.sha256(file_content).hexdigest()
+    with open(file_info["path"], "rb") as handle:
+        assert handle.read() == file_content
+
+
+def test_parser_discards_unwanted_files(tmp_path):
+    parser = MultipartStreamParser(boundary, lambda name, filename: None)
+    feed(parser, multipart_body, 4096)
+    assert parser.complete
+    assert parser.files == {}
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_parser_rejects_malformed_boundary(tmp_path):
+    parser = MultipartStreamParser(boundary, lambda name, filename: str(tmp_path / filename))
+    with pytest.raises(web.HTTPError):
+        parser.data_received(b"--" + boundary + b"XX")
+
+
+def test_parser_abort_removes_partial_file(tmp_path):
+    parser = MultipartStreamParser(boundary, lambda name, filename: str(tmp_path / filename))
+    parser.data_received(multipart_body[: len(multipart_body) // 2])
+    assert (tmp_path / "assignment.tar.gz").exists()
+    parser.abort()
+    assert not (tmp_path / "assignment.tar.gz").exists()
+
+
+def test_parser_rejects_oversize_field(tmp_path):
+    parser = MultipartStreamParser(boundary, lambda name, filename: str(tmp_path / filename))
+    parser.max_field_size = 4
+    with pytest.raises(web.HTTPError):
+        feed(parser, multipart_body, 4096)
+
+
+# #### UploadHandler ##### #
+
+
+# Students can't release, so the upload is never written to the exchange
+@pytest.mark.gen_test
+def test_student_release_upload_not_stored(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=release_files,
+        )
+    assert r.status_code == 200
+    assert r.json()["success"] is False
+    assert list(pathlib.Path(app.base_storage_location).rglob("*.gz")) == []
+
+
+# The submission is rejected after it's been streamed to disk, so the stored file is removed again
+@pytest.mark.gen_test
+def test_rejected_submission_upload_removed(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+        r = yield async_requests.post(app.url + params, files=release_files)
+    assert r.status_code == 200
+    response_data = r.json()
+    assert response_data["success"] is False
+    assert response_data["note"] == "User not fetched assignment assign_a"
+    assert list(pathlib.Path(app.base_storage_location).rglob("*.gz")) == []
+
+
+@pytest.mark.gen_test
+def test_release_upload_streamed_to_storage(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    assert r.status_code == 200
+    assert r.json()["success"] is True
+    stored = list(pathlib.Path(app.base_storage_location).rglob("*.gz"))
+    assert len(stored) == 1
+    assert stored[0].read_bytes() == release_files["assignment"][1]
+    shutil.rmtree(app.base_storage_location)
+
+
+# #### Per-route body limits ##### #
+
+
+# An oversized release is refused from its Content-Length, before any of it is stored
+@pytest.mark.gen_test
+def test_oversize_release_rejected_before_read(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["max_release_size"] = 1000
+    try:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            r = yield async_requests.post(
+                app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+                data={"notebooks": notebooks},
+                files=release_files,
+            )
+    finally:
+        del app.tornado_application.settings["max_release_size"]
+    assert r.status_code == 413
+    assert not os.path.exists(app.base_storage_location) or not list(
+        pathlib.Path(app.base_storage_location).rglob("*.gz")
+    )
+
+
+# Limits are per-route: the release limit doesn't apply to submissions
+@pytest.mark.gen_test
+def test_release_limit_not_applied_to_submissions(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["max_release_size"] = 1000
+    try:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+            params = "/submission?course_id=course_2&assignment_id=assign_a&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC"
+            r = yield async_requests.post(app.url + params, files=release_files)
+    finally:
+        del app.tornado_application.settings["max_release_size"]
+    assert r.status_code == 200
+    assert r.json()["note"] == "User not fetched assignment assign_a"
+
+
+# Feedback has its own (much smaller) limit
+@pytest.mark.gen_test
+def test_oversize_feedback_rejected_before_read(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["max_feedback_size"] = 1000
+    url = "/feedback?course_id=course_2&assignment_id=assign_a&notebook=nb&student=1-kiz&timestamp=ts&checksum=abc"
+    try:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            r = yield async_requests.post(app.url + url, files={"feedback": ("feedback.html", b"x" * 2000)})
+    finally:
+        del app.tornado_application.settings["max_feedback_size"]
+    assert r.status_code == 413
+
+
+# Students can't release, so only get to send a small request
+@pytest.mark.gen_test
+def test_student_release_limited_to_form_fields(app, clear_database):  # noqa: F811
+    faked_files = {"assignment": ("assignment.tar.gz", b"x" * (UploadHandler.max_unprivileged_size + 1))}
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            files=faked_files,
+        )
+    assert r.status_code == 413
+
+
+# A chunked body (no Content-Length) is stopped once it passes the limit
+@pytest.mark.gen_test
+def test_chunked_oversize_release_stopped(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["max_release_size"] = 1000
+
+    def body():
+        yield b"--" + boundary + b"\r\n"
+        yield b'Content-Disposition: form-data; name="assignment"; filename="assignment.tar.gz"\r\n\r\n'
+        for _ in range(10):
+            yield b"x" * 500
+
+    try:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            try:
+                r = yield async_requests.post(
+                    app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+                    data=body(),
+                    headers={"Content-Type": "multipart/form-data; boundary=" + boundary.decode()},
+                )
+                assert r.status_code == 400
+            except requests.exceptions.ConnectionError:
+                pass  # The server may just drop the connection
+    finally:
+        del app.tornado_application.settings["max_release_size"]
+    assert not os.path.exists(app.base_storage_location) or not list(
+        pathlib.Path(app.base_storage_location).rglob("*.gz")
+    )
+
+
+# A malformed body is the client's error (400), not the server's (500)
+@pytest.mark.gen_test
+def test_malformed_upload_is_a_bad_request(app, clear_database):  # noqa: F811
+    malformed = {
+        "data": b"--" + boundary + b"XX\r\n",
+        "headers": {"Content-Type": "multipart/form-data; boundary=" + boundary.decode()},
+    }
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(app.url + "/assignment?course_id=course_2&assignment_id=assign_a", **malformed)
+        assert r.status_code == 400
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+        assert r.json()["success"] is True
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+        assert r.status_code == 200
+        r = yield async_requests.post(
+            app.url + f"/submission?course_id=course_2&assignment_id=assign_a&timestamp={quote_plus(timestamp)}",
+            **malformed,
+        )
+    assert r.status_code == 400
+    shutil.rmtree(app.base_storage_location)
+
+
+# #### Upload locations ##### #
+
+
+# Codes are stored as they are - spaces, dots & all
+@pytest.mark.gen_test
+def test_release_and_submit_with_spaces_and_dots_in_codes(app, clear_database):  # noqa: F811
+    course_code, assignment_code = "PHYS101.2024", "Lab 1"
+    params = f"course_id={quote_plus(course_code)}&assignment_id={quote_plus(assignment_code)}"
+    with patch.object(BaseHandler, "get_current_user", return_value=dict(user_kiz_instructor, course_id=course_code)):
+        r = yield async_requests.post(
+            app.url + f"/assignment?{params}", data={"notebooks": notebooks}, files=release_files
+        )
+    assert r.json() == {"success": True, "note": "Released"}
+    with patch.object(BaseHandler, "get_current_user", return_value=dict(user_kiz_student, course_id=course_code)):
+        r = yield async_requests.get(app.url + f"/assignment?{params}")
+        assert r.status_code == 200
+        r = yield async_requests.post(
+            app.url + f"/submission?{params}&timestamp=2020-01-01%2000%3A00%3A00.0%20UTC", files=release_files
+        )
+    assert r.json() == {"success": True, "note": "Submitted"}
+    stored = list(pathlib.Path(app.base_storage_location).rglob("*.gz"))
+    assert len(stored) == 2
+    assert all(course_code in s.parts and assignment_code in s.parts for s in stored)
+    shutil.rmtree(app.base_storage_location)
+
+
+# The codes that make up the path can't step outside the exchange's storage
+def escaped_location(app):
+    """Where the uploads below would land, if their paths weren't checked"""
+    return os.path.join(os.path.dirname(os.path.realpath(app.base_storage_location)), "nbexchange-escaped")
+
+
+@pytest.mark.gen_test
+def test_release_course_code_traversal_not_stored(app, clear_database):  # noqa: F811
+    course_code = "../../../nbexchange-escaped"
+    user = dict(user_kiz_instructor, course_id=course_code)
+    with patch.object(BaseHandler, "get_current_user", return_value=user):
+        r = yield async_requests.post(
+            app.url + f"/assignment?course_id={quote_plus(course_code)}&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    assert r.status_code == 412
+    assert not os.path.exists(escaped_location(app))
+
+
+@pytest.mark.gen_test
+def test_submission_assignment_code_traversal_not_stored(app, clear_database):  # noqa: F811
+    assignment_code = "../../../../nbexchange-escaped"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield async_requests.post(
+            app.url + f"/submission?course_id=course_2&assignment_id={quote_plus(assignment_code)}",
+            files=release_files,
+        )
+    assert r.json()["success"] is False
+    assert not os.path.exists(escaped_location(app))
+
+
+@pytest.mark.gen_test
+def test_feedback_checksum_traversal_not_stored(app, clear_database):  # noqa: F811
+    checksum = "../../../../../../nbexchange-escaped"
+    url = (
+        "/feedback?course_id=course_2&assignment_id=assign_a&notebook=nb&student=1-kiz&timestamp=ts"
+        f"&checksum={quote_plus(checksum)}"
+    )
+    # The request fails (there's no such notebook), so keep what was written for us to look for
+    with (
+        patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor),
+        patch.object(UploadHandler, "_remove_unkept_uploads"),
+    ):
+        r = yield async_requests.post(app.url + url, files={"feedback": ("feedback.html", b"<html></html>")})
+    assert r.status_code == 404
+    assert not os.path.exists(escaped_location(app) + ".html")
+
+
+@pytest.mark.gen_test
+def test_upload_session_traversal_rejected(app, clear_database):  # noqa: F811
+    assignment_code = "../../../../nbexchange-escaped"
+    url = f"/upload_sessions?course_id=course_2&assignment_id={quote_plus(assignment_code)}&kind=assignment"
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(app.url + url, data={"notebooks": notebooks})
+    assert r.json() == {
+        "success": False,
+        "note": f"Upload session can't be stored for course course_2 and assignment {assignment_code}",
+    }
+    assert not os.path.exists(escaped_location(app))
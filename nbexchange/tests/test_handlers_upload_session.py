@@ -0,0 +1,301 @@
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from mock import patch
+from tornado.tcpclient import TCPClient
+
+from nbexchange.handlers.base import BaseHandler
+from nbexchange.handlers.upload_session import remove_expired_upload_sessions
+from nbexchange.models.actions import Action
+from nbexchange.models.upload_sessions import UploadSession
+from nbexchange.tests.utils import (  # noqa: F401 "clear_database"
+    async_requests,
+    clear_database,
+    get_files_dict,
+    user_kiz_instructor,
+    user_kiz_student,
+    user_zik_student,
+)
+
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.ERROR)
+
+# set up the file to be uploaded as part of the testing later
+release_files, notebooks, timestamp = get_files_dict()
+file_content = os.urandom(200000)
+
+
+def create_session(app, kind="assignment", size=len(file_content), **extra):
+    params = f"/upload_sessions?course_id=course_2&assignment_id=assign_a&kind={kind}&size={size}"
+    return async_requests.post(app.url + params, data={"notebooks": notebooks, **extra})
+
+
+def put_chunk(app, session_id, offset, chunk):
+    return async_requests.put(app.url + f"/upload_session?session_id={session_id}&offset={offset}", data=chunk)
+
+
+# #### POST /upload_sessions ##### #
+
+
+# Requires both params (none)
+@pytest.mark.gen_test
+def test_create_upload_session_needs_params(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(app.url + "/upload_sessions")
+    assert r.status_code == 200
+    response_data = r.json()
+    assert response_data["success"] is False
+    assert response_data["note"].startswith("Upload session requires a course code")
+
+
+# Students can't make a release session
+@pytest.mark.gen_test
+def test_create_release_session_needs_instructor(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield create_session(app)
+    assert r.status_code == 200
+    response_data = r.json()
+    assert response_data["success"] is False
+    assert response_data["note"] == "User not an instructor to course course_2"
+
+
+# Sessions can't be bigger than the max_buffer_size (the default for the route limits)
+@pytest.mark.gen_test
+def test_create_upload_session_oversize(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app, size=app.max_buffer_size + 1)
+    assert r.json() == {"success": False, "note": "File upload oversize, and rejected."}
+
+
+# Sessions have the same limits as POST /assignment and /submission
+@pytest.mark.gen_test
+def test_create_upload_session_over_route_limit(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["max_release_size"] = 1000
+    app.tornado_application.settings["max_submission_size"] = 2000
+    try:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            r = yield create_session(app, size=1001)
+            assert r.json() == {"success": False, "note": "File upload oversize, and rejected."}
+            r = yield create_session(app, size=1000)
+            assert r.json()["success"] is True
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+            r = yield create_session(app, kind="submission", size=2001)
+            assert r.json() == {"success": False, "note": "File upload oversize, and rejected."}
+    finally:
+        del app.tornado_application.settings["max_release_size"]
+        del app.tornado_application.settings["max_submission_size"]
+    shutil.rmtree(app.base_storage_location)
+
+
+# Can't submit an assignment that doesn't exist
+@pytest.mark.gen_test
+def test_create_submission_session_needs_assignment(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield create_session(app, kind="submission")
+    response_data = r.json()
+    assert response_data["success"] is False
+    assert response_data["note"] == "User not fetched assignment assign_a"
+
+
+# #### PUT, GET, POST /upload_session ##### #
+
+
+# The file arrives in chunks, and the release is only recorded when the session is finalized
+@pytest.mark.gen_test
+def test_release_in_chunks(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app)
+        response_data = r.json()
+        assert response_data["success"] is True
+        assert response_data["offset"] == 0
+        session_id = response_data["session_id"]
+
+        for offset in range(0, len(file_content), 65536):
+            r = yield put_chunk(app, session_id, offset, file_content[offset : offset + 65536])
+            assert r.status_code == 200
+            assert r.json()["offset"] == min(offset + 65536, len(file_content))
+
+        r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+        assert r.json()["value"] == []
+
+        r = yield async_requests.post(app.url + f"/upload_session?session_id={session_id}")
+        assert r.json() == {"success": True, "note": "Released"}
+
+        r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+        assert [a["status"] for a in r.json()["value"]] == ["released"]
+
+        r = yield async_requests.get(app.url + "/assignment?course_id=course_2&assignment_id=assign_a")
+        assert r.content == file_content
+
+        # The session has gone
+        r = yield async_requests.get(app.url + f"/upload_session?session_id={session_id}")
+        assert r.status_code == 404
+    shutil.rmtree(app.base_storage_location)
+
+
+# A dropped connection is resumed from the offset the session reports
+@pytest.mark.gen_test
+def test_upload_session_resumes(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app)
+        session_id = r.json()["session_id"]
+        r = yield put_chunk(app, session_id, 0, file_content[:100000])
+
+        r = yield async_requests.get(app.url + f"/upload_session?session_id={session_id}")
+        response_data = r.json()
+        assert response_data["offset"] == 100000
+        assert response_data["size"] == len(file_content)
+
+        # Finalizing early says how much is missing
+        r = yield async_requests.post(app.url + f"/upload_session?session_id={session_id}")
+        response_data = r.json()
+        assert response_data["success"] is False
+        assert response_data["offset"] == 100000
+
+        # A chunk that doesn't start where the session is, is a conflict
+        r = yield put_chunk(app, session_id, 50000, file_content[50000:])
+        assert r.status_code == 409
+
+        r = yield put_chunk(app, session_id, 100000, file_content[100000:])
+        assert r.json()["offset"] == len(file_content)
+        r = yield async_requests.post(app.url + f"/upload_session?session_id={session_id}")
+        assert r.json()["success"] is True
+    stored = list(pathlib.Path(app.base_storage_location).rglob("*.gz"))
+    assert [s.read_bytes() for s in stored] == [file_content]
+    shutil.rmtree(app.base_storage_location)
+
+
+# Chunks can't take the file past the size given when the session was made
+@pytest.mark.gen_test
+def test_upload_session_chunk_too_big(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app, size=10)
+        session_id = r.json()["session_id"]
+        r = yield put_chunk(app, session_id, 0, file_content[:11])
+    assert r.status_code == 413
+
+
+# A chunk's Content-Length has to be a number (the request is checked before its body is read)
+@pytest.mark.gen_test
+def test_upload_session_chunk_bad_content_length(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app, size=10)
+        session_id = r.json()["session_id"]
+        stream = yield TCPClient().connect("127.0.0.1", app.port)
+        try:
+            yield stream.write(
+                f"PUT {app.base_url.rstrip('/')}/upload_session?session_id={session_id}&offset=0 HTTP/1.1\r\n"
+                "Host: 127.0.0.1\r\nContent-Length: lots\r\n\r\n".encode()
+            )
+            status_line = yield stream.read_until(b"\r\n")
+        finally:
+            stream.close()
+    assert status_line.split()[1] == b"400"
+
+
+# A session made without a size still can't take the file past the route's limit
+@pytest.mark.gen_test
+def test_upload_session_chunk_over_route_limit(app, clear_database):  # noqa: F811
+    app.tornado_application.settings["max_release_size"] = 1000
+    try:
+        with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+            r = yield create_session(app, size="")
+            session_id = r.json()["session_id"]
+            r = yield put_chunk(app, session_id, 0, file_content[:1000])
+            assert r.json()["offset"] == 1000
+            r = yield put_chunk(app, session_id, 1000, file_content[1000:1001])
+            assert r.status_code == 413
+    finally:
+        del app.tornado_application.settings["max_release_size"]
+    shutil.rmtree(app.base_storage_location)
+
+
+# The limit is checked again when the session is finalized, and an oversize upload removed
+@pytest.mark.gen_test
+def test_finalize_upload_session_over_route_limit(app, db, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app)
+        session_id = r.json()["session_id"]
+        r = yield put_chunk(app, session_id, 0, file_content)
+        app.tornado_application.settings["max_release_size"] = 1000
+        try:
+            r = yield async_requests.post(app.url + f"/upload_session?session_id={session_id}")
+        finally:
+            del app.tornado_application.settings["max_release_size"]
+    assert r.json() == {"success": False, "note": "File upload oversize, and rejected."}
+    assert db.query(UploadSession).count() == 0
+    assert db.query(Action).count() == 0
+    assert list(pathlib.Path(app.base_storage_location).rglob("*.gz")) == []
+    shutil.rmtree(app.base_storage_location)
+
+
+# Submissions are recorded with the timestamp given when the session was made
+@pytest.mark.gen_test
+def test_submission_in_chunks(app, db, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield async_requests.post(
+            app.url + "/assignment?course_id=course_2&assignment_id=assign_a",
+            data={"notebooks": notebooks},
+            files=release_files,
+        )
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_student):
+        r = yield create_session(app, kind="submission", timestamp="2020-01-01 00:00:00.0 UTC")
+        session_id = r.json()["session_id"]
+        r = yield put_chunk(app, session_id, 0, file_content)
+        r = yield async_requests.post(app.url + f"/upload_session?session_id={session_id}")
+    assert r.json() == {"success": True, "note": "Submitted"}
+    action = db.query(Action).filter(Action.action == "submitted").one()
+    assert action.timestamp.replace(tzinfo=None) == datetime(2020, 1, 1)
+    assert action.checksum == hashlib.sha256(file_content).hexdigest()
+    with open(action.location, "rb") as handle:
+        assert handle.read() == file_content
+    shutil.rmtree(app.base_storage_location)
+
+
+# Sessions belong to the user that made them
+@pytest.mark.gen_test
+def test_upload_session_other_user_not_found(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app)
+        session_id = r.json()["session_id"]
+    with patch.object(BaseHandler, "get_current_user", return_value=user_zik_student):
+        r = yield async_requests.get(app.url + f"/upload_session?session_id={session_id}")
+    assert r.status_code == 404
+    shutil.rmtree(app.base_storage_location)
+
+
+# DELETE abandons the session, and the partial file
+@pytest.mark.gen_test
+def test_delete_upload_session(app, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app)
+        session_id = r.json()["session_id"]
+        r = yield put_chunk(app, session_id, 0, file_content[:1000])
+        r = yield async_requests.delete(app.url + f"/upload_session?session_id={session_id}")
+        assert r.json()["success"] is True
+        r = yield async_requests.get(app.url + f"/upload_session?session_id={session_id}")
+        assert r.status_code == 404
+    assert list(pathlib.Path(app.base_storage_location).rglob("*.gz")) == []
+
+
+# Sessions idle for longer than the timeout are removed
+@pytest.mark.gen_test
+def test_expired_upload_sessions_removed(app, db, clear_database):  # noqa: F811
+    with patch.object(BaseHandler, "get_current_user", return_value=user_kiz_instructor):
+        r = yield create_session(app)
+        session_id = r.json()["session_id"]
+        r = yield put_chunk(app, session_id, 0, file_content[:1000])
+    upload_session = db.query(UploadSession).filter(UploadSession.session_id == session_id).one()
+    upload_session.updated_at = datetime.now(timezone.utc) - timedelta(days=2)
+    db.commit()
+
+    remove_expired_upload_sessions(max_age=app.upload_session_timeout, log=logger)
+
+    db.expire_all()
+    assert db.query(UploadSession).count() == 0
+    assert list(pathlib.Path(app.base_storage_location).rglob("*.gz")) == []
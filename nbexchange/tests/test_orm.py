@@ -10,12 +10,22 @@ User -> Course -> Subscription -> Assignment -> Action -> Notebook -> Feedback
 
 """
 
+import datetime
+import threading
+
 import pytest
+from sqlalchemy import create_engine
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
 
 # NOTE: All objects & relationships that are built up remain until the end of
 # the test-run.
-from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange import database
+from nbexchange.models import Base
+from nbexchange.models.action_archive import ActionArchive
+from nbexchange.models.actions import Action, AssignmentActions, hash_location
+from nbexchange.models.assignment_counts import AssignmentCounts
+from nbexchange.models.assignment_states import AssignmentState
 from nbexchange.models.assignments import Assignment as AssignmentModel
 from nbexchange.models.courses import Course
 from nbexchange.models.feedback import Feedback
@@ -604,6 +614,240 @@ def test_action_can_restrict_assignment_searches(db, assignment_tree):
     assert found is None
 
 
+def test_assignment_find_submission(db, assignment_tree, user_johaannes):
+    action = Action(
+        user_id=user_johaannes.id,
+        assignment_id=assignment_tree.id,
+        action=AssignmentActions.submitted,
+        location="/some/submitted/file.gz",
+    )
+    db.add(action)
+    db.commit()
+    assert action.location_hash == hash_location("/some/submitted/file.gz")
+
+    found = AssignmentModel.find_submission(
+        db, course_id=assignment_tree.course_id, assignment_code="tree 1", path="/some/submitted/file.gz"
+    )
+    assert found == (assignment_tree, action)
+    found = AssignmentModel.find_submission(
+        db, course_id=assignment_tree.course_id, assignment_code="tree 1", submission_id=action.id
+    )
+    assert found == (assignment_tree, action)
+    # Has to be a submission, for that assignment
+    found = AssignmentModel.find_submission(
+        db, course_id=assignment_tree.course_id, assignment_code="tree 2", submission_id=action.id
+    )
+    assert found is None
+    with pytest.raises(ValueError):
+        AssignmentModel.find_submission(db, course_id=assignment_tree.course_id, assignment_code="tree 1")
+    with pytest.raises(TypeError):
+        AssignmentModel.find_submission(
+            db, course_id=assignment_tree.course_id, assignment_code="tree 1", submission_id="1"
+        )
+
+
+def test_assignment_state_follows_the_actions(db, assignment_tree, user_johaannes, user_kaylee):
+    actions = [
+        Action(user_id=user_johaannes.id, assignment_id=assignment_tree.id, action=AssignmentActions.fetched),
+        Action(
+            user_id=user_johaannes.id,
+            assignment_id=assignment_tree.id,
+            action=AssignmentActions.submitted,
+            location="/state/first.gz",
+        ),
+        Action(
+            user_id=user_johaannes.id,
+            assignment_id=assignment_tree.id,
+            action=AssignmentActions.submitted,
+            location="/state/second.gz",
+        ),
+    ]
+    db.add_all(actions)
+    db.commit()
+    # The instructor collects the student's (latest) submission
+    collected = Action(
+        user_id=user_kaylee.id,
+        assignment_id=assignment_tree.id,
+        action=AssignmentActions.collected,
+        location="/state/second.gz",
+        student_id=user_johaannes.id,
+    )
+    db.add(collected)
+    db.commit()
+
+    state = AssignmentState.find_for_user(db, assignment_id=assignment_tree.id, user_id=user_johaannes.id)
+    assert state.fetched_id == actions[0].id
+    assert state.submitted_id == actions[2].id
+    assert state.collected_id == collected.id
+    assert state.submitted.location == "/state/second.gz"
+
+    def pointers():
+        db.expire_all()
+        state = AssignmentState.find_for_user(db, assignment_id=assignment_tree.id, user_id=user_johaannes.id)
+        return {column: getattr(state, column) for column in AssignmentState.kinds.values()}
+
+    # Rebuilding from the actions comes to the same place - and picks up the release from
+    # test_action_object_creation_errors, which was only pointed at the assignment after it was added
+    before = pointers()
+    assert before["released_id"] is None
+    assert AssignmentState.rebuild(db) > 0
+    db.commit()
+    assert pointers() == dict(before, released_id=1)
+
+    with pytest.raises(TypeError):
+        AssignmentState.find_for_user(db, assignment_id="tree 1", user_id=user_johaannes.id)
+
+
+# Sessions writing the same student's state at once (on a database file of their own) neither fail
+# nor move the pointers backwards
+def test_assignment_state_concurrent_writers(tmp_path):
+    url = f"sqlite:///{tmp_path / 'state.sqlite'}"
+    engine = create_engine(url, **database.engine_kwargs(url, pool_size=8))
+    database.register_sqlite_pragmas(engine, database.SQLITE_PROFILE)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        student = User(name="concurrent", org_id=1)
+        course = Course(org_id=1, course_code="concurrent")
+        session.add_all([student, course])
+        session.flush()
+        assignment = AssignmentModel(assignment_code="concurrent", course_id=course.id)
+        session.add(assignment)
+        session.commit()
+        student_id, assignment_id = student.id, assignment.id
+
+    errors = []
+
+    def submit():
+        for _ in range(10):
+            with Session() as session:
+                try:
+                    session.add(
+                        Action(user_id=student_id, assignment_id=assignment_id, action=AssignmentActions.submitted)
+                    )
+                    session.commit()
+                except Exception as e:
+                    errors.append(e)
+
+    writers = [threading.Thread(target=submit) for _ in range(8)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    with Session() as session:
+        latest = session.query(Action.id).order_by(Action.id.desc()).first()[0]
+        assert errors == []
+        assert AssignmentState.find_for_user(session, assignment_id, student_id).submitted_id == latest
+        counts = AssignmentCounts.find_for_assignment(session, assignment_id)
+        assert (counts.submitted, counts.submitters) == (80, 1)
+
+        # A flush of an older action that finishes later leaves the pointer where it is
+        AssignmentState.record(session.connection(), assignment_id, student_id, {"submitted_id": 1})
+        session.commit()
+        assert AssignmentState.find_for_user(session, assignment_id, student_id).submitted_id == latest
+    engine.dispose()
+
+
+def test_assignment_counts_follow_the_actions(db, assignment_tree, user_johaannes, user_kaylee, user_fidel):
+    # Earlier tests re-point actions after adding them, so start from the reconciled counts
+    AssignmentCounts.reconcile(db)
+    db.commit()
+    before = AssignmentCounts.find_for_assignment(db, assignment_id=assignment_tree.id).as_dict()
+
+    db.add_all(
+        [
+            Action(user_id=user_johaannes.id, assignment_id=assignment_tree.id, action=AssignmentActions.fetched),
+            Action(user_id=user_fidel.id, assignment_id=assignment_tree.id, action=AssignmentActions.submitted),
+            Action(user_id=user_fidel.id, assignment_id=assignment_tree.id, action=AssignmentActions.submitted),
+        ]
+    )
+    db.commit()
+    db.add(Action(user_id=user_fidel.id, assignment_id=assignment_tree.id, action=AssignmentActions.submitted))
+    db.add(Action(user_id=user_kaylee.id, assignment_id=assignment_tree.id, action=AssignmentActions.collected))
+    db.commit()
+
+    db.expire_all()
+    counts = AssignmentCounts.find_for_assignment(db, assignment_id=assignment_tree.id)
+    # Three more submissions, but only the one more submitter
+    assert counts.as_dict() == dict(
+        before,
+        fetched=before["fetched"] + 1,
+        submitted=before["submitted"] + 3,
+        submitters=before["submitters"] + 1,
+        collected=before["collected"] + 1,
+    )
+    assert AssignmentCounts.reconcile(db) == 0
+
+    # Drift is corrected from the actions
+    counts.submitted = 0
+    db.commit()
+    assert AssignmentCounts.reconcile(db) == 1
+    db.commit()
+    db.expire_all()
+    assert (
+        AssignmentCounts.find_for_assignment(db, assignment_id=assignment_tree.id).submitted == before["submitted"] + 3
+    )
+
+    with pytest.raises(TypeError):
+        AssignmentCounts.find_for_assignment(db, assignment_id="tree 1")
+
+
+def test_action_archive(db, course_strange, assignment_tree, user_johaannes, user_kaylee):
+    old = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    cutoff = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    closed = AssignmentModel(assignment_code="long gone", course_id=course_strange.id)
+    db.add(closed)
+    db.commit()
+    actions = [
+        Action(user_id=user_kaylee.id, assignment_id=closed.id, action=AssignmentActions.released, timestamp=old),
+        Action(user_id=user_johaannes.id, assignment_id=closed.id, action=AssignmentActions.fetched, timestamp=old),
+        Action(user_id=user_johaannes.id, assignment_id=closed.id, action=AssignmentActions.submitted, timestamp=old),
+    ]
+    db.add_all(actions)
+    db.commit()
+    ids = [action.id for action in actions]
+    AssignmentCounts.reconcile(db)
+    db.commit()
+    counts = AssignmentCounts.find_for_assignment(db, assignment_id=closed.id).as_dict()
+
+    # However long it's been idle, an active assignment isn't archived
+    assert closed.id not in ActionArchive.find_closed_assignments(db, before=cutoff)
+    closed.active = False
+    db.commit()
+    assert closed.id in ActionArchive.find_closed_assignments(db, before=cutoff)
+    assert AssignmentState.find_for_user(db, assignment_id=closed.id, user_id=user_johaannes.id) is not None
+
+    # Keep another assignment's action as the newest, as the app would have
+    db.add(Action(user_id=user_johaannes.id, assignment_id=assignment_tree.id, action=AssignmentActions.fetched))
+    db.commit()
+    assert ActionArchive.archive_batch(db, assignment_id=closed.id, batch_size=2) == 2
+    assert ActionArchive.archive_batch(db, assignment_id=closed.id, batch_size=2) == 1
+    assert ActionArchive.archive_batch(db, assignment_id=closed.id, batch_size=2) == 0
+    db.commit()
+
+    assert db.query(Action).filter(Action.assignment_id == closed.id).count() == 0
+    assert [row.id for row in db.query(ActionArchive).filter(ActionArchive.assignment_id == closed.id)] == ids
+    assert AssignmentState.find_for_user(db, assignment_id=closed.id, user_id=user_johaannes.id) is None
+    assert closed.id not in ActionArchive.find_closed_assignments(db, before=cutoff)
+    # The counts still include the archived actions
+    assert AssignmentCounts.reconcile(db) == 0
+    assert AssignmentCounts.find_for_assignment(db, assignment_id=closed.id).as_dict() == counts
+
+    # A closed assignment with only the newest action (which is kept) isn't picked again & again
+    gone = AssignmentModel(assignment_code="just gone", course_id=course_strange.id, active=False)
+    db.add(gone)
+    db.commit()
+    db.add(Action(user_id=user_kaylee.id, assignment_id=gone.id, action=AssignmentActions.released, timestamp=old))
+    db.commit()
+    assert gone.id not in ActionArchive.find_closed_assignments(db, before=cutoff)
+
+    with pytest.raises(TypeError):
+        ActionArchive.find_closed_assignments(db, before="2021-01-01")
+    with pytest.raises(ValueError):
+        ActionArchive.archive_batch(db, assignment_id=closed.id, batch_size=0)
+
+
 # ## Notebook tests
 # Remember Users, Courses, Subscriptions, Assignments, and Actions are already in the DB
 
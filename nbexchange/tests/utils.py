@@ -6,20 +6,26 @@ import os
 import tarfile
 import time
 from concurrent.futures import ThreadPoolExecutor
-from contextlib import closing
+from contextlib import closing, contextmanager
 from functools import partial
 
 import pytest
 import requests
 from dateutil.tz import gettz
+from sqlalchemy import event
 
+from nbexchange import database
 from nbexchange.app import NbExchange
+from nbexchange.models.action_archive import ActionArchive
 from nbexchange.models.actions import Action
+from nbexchange.models.assignment_counts import AssignmentCounts
+from nbexchange.models.assignment_states import AssignmentState
 from nbexchange.models.assignments import Assignment as AssignmentModel
 from nbexchange.models.courses import Course
 from nbexchange.models.feedback import Feedback
 from nbexchange.models.notebooks import Notebook
 from nbexchange.models.subscriptions import Subscription
+from nbexchange.models.upload_sessions import UploadSession
 from nbexchange.models.users import User
 
 # These replicate what's defined in nbexchange/app.py, nbexchange/handlers/base.py.... and nbgrader/exchange/exchange.py
@@ -312,6 +318,26 @@ class AsyncSession(requests.Session):
         return async_requests.executor.submit(super().request, *args, **kwargs)
 
 
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run against the exchange's database inside the block
+
+    with count_queries() as queries:
+        r = yield async_requests.get(app.url + "/assignments?course_id=course_2")
+    assert len(queries) == 5
+    """
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", record)
+    try:
+        yield queries
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record)
+
+
 # fixture to clear the database completely
 @pytest.fixture
 def clear_database(db):
@@ -319,10 +345,14 @@ def clear_database(db):
 
     requires the db handler
     """
+    db.query(AssignmentCounts).delete()
+    db.query(ActionArchive).delete()
+    db.query(AssignmentState).delete()
     db.query(Action).delete()
     db.query(AssignmentModel).delete()
     db.query(Course).delete()
     db.query(Feedback).delete()
     db.query(Notebook).delete()
     db.query(Subscription).delete()
+    db.query(UploadSession).delete()
     db.query(User).delete()
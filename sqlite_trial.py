@@ -0,0 +1,148 @@
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, exc, insert
+from sqlalchemy.orm import sessionmaker
+
+from nbexchange import database
+from nbexchange.models import Base
+from nbexchange.models.actions import Action, AssignmentActions
+from nbexchange.models.assignments import Assignment
+from nbexchange.models.courses import Course
+from nbexchange.models.users import User
+
+"""
+Compare the submit throughput of a SQLite database file with and without the production profile
+(`NbExchange.sqlite_profile`: WAL, synchronous=NORMAL, busy_timeout, mmap_size & cache_size.)
+
+Each worker thread does what a submission does in the database: finds the course & assignment,
+records a `submitted` action, and commits - over and over, for the length of the run. The same
+scratch database file is used for both runs (it's removed first.)
+
+    python sqlite_trial.py                   # 8 workers, 10 seconds each way
+    python sqlite_trial.py -w 32 -t 30       # more contention, for longer
+"""
+
+
+class nbexchangeSqliteTrial:
+    log = logging.getLogger(__name__)
+
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(
+            description="Submit throughput for nbexchange, with & without the SQLite profile."
+        )
+        parser.add_argument(
+            "-f",
+            "--file",
+            type=str,
+            default="sqlite_trial.sqlite",
+            help="The scratch database file. Defaults to sqlite_trial.sqlite (which is removed first, and afterwards)",
+        )
+        parser.add_argument("-w", "--workers", type=int, default=8, help="How many threads submit. Defaults to 8.")
+        parser.add_argument(
+            "-t", "--time", type=float, default=10, help="How many seconds to submit for, each way. Defaults to 10."
+        )
+        parser.add_argument(
+            "-s", "--students", type=int, default=250, help="How many students are in the course. Defaults to 250."
+        )
+        return parser.parse_args(args)
+
+    def remove_database(self):
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(self.args.file + suffix):
+                os.remove(self.args.file + suffix)
+
+    def engine(self, pragmas):
+        url = f"sqlite:///{self.args.file}"
+        engine = create_engine(url, **database.engine_kwargs(url, pool_size=self.args.workers))
+        if pragmas:
+            database.register_sqlite_pragmas(engine, pragmas)
+        return engine
+
+    def seed(self):
+        engine = self.engine({})
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(Course), [{"id": 1, "org_id": 1, "course_code": "course_1"}])
+            conn.execute(insert(Assignment), [{"id": 1, "course_id": 1, "assignment_code": "assign_1", "active": True}])
+            conn.execute(
+                insert(User), [{"id": u, "org_id": 1, "name": f"1-s{u:07d}"} for u in range(1, self.args.students + 1)]
+            )
+        engine.dispose()
+
+    def submit(self, Session, worker, results):
+        """Submit, as student after student, until the time is up"""
+        submitted = locked = 0
+        student = worker
+        deadline = time.perf_counter() + self.args.time
+        while time.perf_counter() < deadline:
+            student = student % self.args.students + 1
+            session = Session()
+            try:
+                course = Course.find_by_code(db=session, code="course_1", org_id=1)
+                assignment = Assignment.find_by_code(db=session, code="assign_1", course_id=course.id)
+                session.add(
+                    Action(
+                        user_id=student,
+                        assignment_id=assignment.id,
+                        action=AssignmentActions.submitted,
+                        location=f"/tmp/courses/1/course_1/outbound/assign_1/{student}/{time.time()}.tar.gz",
+                        timestamp=datetime.now(timezone.utc),
+                    )
+                )
+                session.commit()
+                submitted += 1
+            except exc.OperationalError as e:
+                session.rollback()
+                if "locked" not in str(e):
+                    raise
+                locked += 1
+            finally:
+                session.close()
+        results[worker] = (submitted, locked)
+
+    def measure(self, pragmas):
+        engine = self.engine(pragmas)
+        Session = sessionmaker(bind=engine)
+        results = {}
+        workers = [
+            threading.Thread(target=self.submit, args=(Session, worker, results)) for worker in range(self.args.workers)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+        submitted = sum(result[0] for result in results.values())
+        locked = sum(result[1] for result in results.values())
+        return submitted / elapsed, locked
+
+    def report(self, label, throughput, locked):
+        print(f"  {label}: {throughput:.1f} submits/s, {locked} 'database is locked' errors")
+
+    def main(self):
+        self.args = self.parse_args(sys.argv[1:])
+        self.remove_database()
+        try:
+            self.seed()
+            self.log.warning(f"{self.args.workers} workers submitting for {self.args.time}s, each way")
+            default = self.measure({})
+            # journal_mode=WAL is a property of the file, so the profile has to go second
+            profile = self.measure(database.SQLITE_PROFILE)
+            print("\nSubmit throughput")
+            self.report("default", *default)
+            self.report("profile", *profile)
+        finally:
+            self.remove_database()
+
+
+if __name__ == "__main__":
+    app = nbexchangeSqliteTrial()
+    app.main()